@@ -0,0 +1,41 @@
+"""add artwork renditions
+
+Revision ID: 1d93f7a25c60
+Revises: 4b1e6c0d9a7f
+Create Date: 2026-10-18 20:11:47.220518
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d93f7a25c60'
+down_revision = '4b1e6c0d9a7f'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Integer, Unicode
+
+from floof.model.types import TZDateTime
+
+
+def upgrade():
+    # Existing thumbnails were stored without a fingerprint, so they'll all be
+    # made again, as they're asked for
+    op.create_table('artwork_renditions',
+        sa.Column('id', Integer, primary_key=True, nullable=False),
+        sa.Column('artwork_id', Integer, sa.ForeignKey('artwork.id'),
+            nullable=False),
+        sa.Column('name', Unicode(32), nullable=False),
+        sa.Column('fingerprint', Unicode(16), nullable=False),
+        sa.Column('mime_type', Unicode(255), nullable=False),
+        sa.Column('width', Integer, nullable=False),
+        sa.Column('height', Integer, nullable=False),
+        sa.Column('file_size', Integer, nullable=False),
+        sa.Column('created_time', TZDateTime, nullable=False),
+        sa.UniqueConstraint('artwork_id', 'name'),
+    )
+    op.create_index('ix_artwork_renditions_artwork_id', 'artwork_renditions',
+        ['artwork_id'])
+
+
+def downgrade():
+    op.drop_table('artwork_renditions')
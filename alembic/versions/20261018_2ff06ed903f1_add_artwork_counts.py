@@ -0,0 +1,49 @@
+"""add artwork counts
+
+Revision ID: 2ff06ed903f1
+Revises: 46d6b7d546c
+Create Date: 2026-10-18 17:51:31.007332
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2ff06ed903f1'
+down_revision = '46d6b7d546c'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Enum, Integer
+
+
+def upgrade():
+    op.create_table('artwork_counts',
+        sa.Column('subject_type',
+            Enum(u'user', u'tag', u'album', name='artwork_counts_subject_type'),
+            primary_key=True, nullable=False),
+        sa.Column('subject_id', Integer, primary_key=True, nullable=False,
+            autoincrement=False),
+        sa.Column('artwork_count', Integer, nullable=False),
+    )
+
+    # Backfill from the tables the counts are derived from.  Every subject
+    # gets a row, even with no art, as new ones do when they're created;
+    # otherwise their first art would have to insert one, and could race
+    sources = (
+        (u'user', 'users', 'user_artwork', 'user_id'),
+        (u'tag', 'tags', 'artwork_tags', 'tag_id'),
+        (u'album', 'albums', 'artwork_albums', 'album_id'),
+    )
+    for subject_type, subject_table, source_table, id_column in sources:
+        op.execute(
+            'INSERT INTO artwork_counts '
+            '(subject_type, subject_id, artwork_count) '
+            "SELECT '{0}', {1}.id, COUNT({2}.artwork_id) "
+            'FROM {1} LEFT JOIN {2} ON {2}.{3} = {1}.id '
+            'GROUP BY {1}.id'
+            .format(subject_type, subject_table, source_table, id_column)
+        )
+
+
+def downgrade():
+    op.drop_table('artwork_counts')
+    op.execute('DROP TYPE artwork_counts_subject_type')
@@ -0,0 +1,30 @@
+"""add artwork similarities
+
+Revision ID: 3e8d5f27a1c9
+Revises: 5c2a9e41b7d3
+Create Date: 2026-10-18 21:37:50.114962
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e8d5f27a1c9'
+down_revision = '5c2a9e41b7d3'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Float, Integer
+
+
+def upgrade():
+    # Filled in by bin/build-similarities.py
+    op.create_table('artwork_similarities',
+        sa.Column('artwork_id', Integer, sa.ForeignKey('artwork.id'),
+            primary_key=True, nullable=False, autoincrement=False),
+        sa.Column('similar_artwork_id', Integer, sa.ForeignKey('artwork.id'),
+            primary_key=True, nullable=False, autoincrement=False),
+        sa.Column('similarity', Float, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('artwork_similarities')
@@ -0,0 +1,44 @@
+"""add derivative jobs
+
+Revision ID: 4b1e6c0d9a7f
+Revises: 2ff06ed903f1
+Create Date: 2026-10-18 19:02:14.512907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1e6c0d9a7f'
+down_revision = '2ff06ed903f1'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Enum, Integer, Unicode, UnicodeText
+
+from floof.model.types import TZDateTime
+
+
+def upgrade():
+    op.create_table('derivative_jobs',
+        sa.Column('id', Integer, primary_key=True, nullable=False),
+        sa.Column('artwork_id', Integer, sa.ForeignKey('artwork.id'),
+            nullable=False),
+        sa.Column('class_', Unicode(32), nullable=False),
+        sa.Column('state',
+            Enum(u'queued', u'running', u'failed',
+                name='derivative_job_state'),
+            nullable=False),
+        sa.Column('queued_time', TZDateTime, nullable=False),
+        sa.Column('available_time', TZDateTime, nullable=False),
+        sa.Column('started_time', TZDateTime, nullable=True),
+        sa.Column('attempts', Integer, nullable=False),
+        sa.Column('last_error', UnicodeText, nullable=True),
+        sa.UniqueConstraint('artwork_id', 'class_'),
+    )
+    op.create_index('ix_derivative_jobs_artwork_id', 'derivative_jobs',
+        ['artwork_id'])
+    op.create_index('ix_derivative_jobs_state', 'derivative_jobs', ['state'])
+
+
+def downgrade():
+    op.drop_table('derivative_jobs')
+    op.execute('DROP TYPE derivative_job_state')
@@ -0,0 +1,37 @@
+"""add artwork hot score
+
+Revision ID: 5c2a9e41b7d3
+Revises: 1d93f7a25c60
+Create Date: 2026-10-18 21:04:12.583106
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2a9e41b7d3'
+down_revision = '1d93f7a25c60'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Float
+
+
+def upgrade():
+    op.add_column('artwork',
+        sa.Column('hot_score', Float, nullable=False, server_default='0'))
+    op.alter_column('artwork', 'hot_score', server_default=None)
+
+    # Give everything the score of unrated art, which only depends on when it
+    # was uploaded; see floof.model.extensions.hot_score.  Rated art will get
+    # its real score from running bin/refresh-hot-scores.py --all
+    op.execute(
+        'UPDATE artwork SET hot_score = 1 + EXTRACT(EPOCH FROM '
+        "uploaded_time - TIMESTAMP WITH TIME ZONE '2012-01-01 00:00:00+00') "
+        '/ 43200'
+    )
+
+    op.create_index('ix_artwork_hot_score', 'artwork', ['hot_score'])
+
+
+def downgrade():
+    op.drop_index('ix_artwork_hot_score')
+    op.drop_column('artwork', 'hot_score')
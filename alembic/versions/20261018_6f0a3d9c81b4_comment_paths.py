@@ -0,0 +1,135 @@
+"""replace nested set comment threading with materialized paths
+
+Revision ID: 6f0a3d9c81b4
+Revises: 8b1f4c6d2e07
+Create Date: 2026-10-18 23:58:41.203347
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6f0a3d9c81b4'
+down_revision = '8b1f4c6d2e07'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import bindparam, column, table
+from sqlalchemy.types import Integer, Unicode
+
+# Must match floof.model.COMMENT_PATH_SEGMENT and friends
+SEGMENT = 10
+PATH_LENGTH = 1000
+
+comments = table('comments',
+    column('id', Integer),
+    column('discussion_id', Integer),
+    column('left', Integer),
+    column('right', Integer),
+    column('parent_id', Integer),
+    column('path', Unicode),
+)
+
+
+def upgrade():
+    op.add_column('comments', sa.Column('parent_id', Integer,
+        sa.ForeignKey('comments.id'), nullable=True))
+    op.add_column('comments', sa.Column('path', Unicode(PATH_LENGTH),
+        nullable=True))
+
+    # Walk each discussion in nested set order, keeping a stack of the
+    # comments still open; whatever's on top when a comment turns up is its
+    # parent
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([comments.c.id, comments.c.discussion_id,
+                comments.c.left, comments.c.right])
+        .order_by(comments.c.discussion_id, comments.c.left))
+
+    updates = []
+    stack = []  # (right, id, path)
+    discussion_id = None
+    for row in rows:
+        if row.discussion_id != discussion_id:
+            discussion_id = row.discussion_id
+            stack = []
+        while stack and stack[-1][0] < row.left:
+            stack.pop()
+
+        if stack:
+            parent_right, parent_id, parent_path = stack[-1]
+        else:
+            parent_id, parent_path = None, u''
+        path = parent_path + u'{0:0{1}d}'.format(row.id, SEGMENT)
+
+        updates.append(dict(_id=row.id, _parent_id=parent_id, _path=path))
+        stack.append((row.right, row.id, path))
+
+    if updates:
+        connection.execute(
+            comments.update()
+                .where(comments.c.id == bindparam('_id'))
+                .values(parent_id=bindparam('_parent_id'),
+                    path=bindparam('_path')),
+            updates)
+
+    op.alter_column('comments', 'path', nullable=False)
+    op.create_index('ix_comments_parent_id', 'comments', ['parent_id'])
+    op.create_index('ix_comments_discussion_id_path', 'comments',
+        ['discussion_id', 'path'])
+
+    op.drop_column('comments', 'left')
+    op.drop_column('comments', 'right')
+
+
+def downgrade():
+    op.add_column('comments', sa.Column('left', Integer, nullable=True))
+    op.add_column('comments', sa.Column('right', Integer, nullable=True))
+
+    # Number each discussion's comments depth-first: a comment's left comes
+    # when it turns up in path order, and its right once everything after it
+    # has stopped being below it
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select([comments.c.id, comments.c.discussion_id, comments.c.path])
+        .order_by(comments.c.discussion_id, comments.c.path))
+
+    updates = []
+    stack = []  # (id, left, path)
+    discussion_id = None
+    counter = 0
+    def close():
+        id, left, path = stack.pop()
+        updates.append(dict(_id=id, _left=left, _right=counter))
+
+    for row in rows:
+        if row.discussion_id != discussion_id:
+            while stack:
+                counter += 1
+                close()
+            discussion_id = row.discussion_id
+            counter = 0
+        while stack and not row.path.startswith(stack[-1][2]):
+            counter += 1
+            close()
+
+        counter += 1
+        stack.append((row.id, counter, row.path))
+    while stack:
+        counter += 1
+        close()
+
+    if updates:
+        connection.execute(
+            comments.update()
+                .where(comments.c.id == bindparam('_id'))
+                .values(left=bindparam('_left'), right=bindparam('_right')),
+            updates)
+
+    op.alter_column('comments', 'left', nullable=False)
+    op.alter_column('comments', 'right', nullable=False)
+    op.create_index('ix_comments_left', 'comments', ['left'])
+    op.create_index('ix_comments_right', 'comments', ['right'])
+
+    op.drop_index('ix_comments_discussion_id_path')
+    op.drop_index('ix_comments_parent_id')
+    op.drop_column('comments', 'path')
+    op.drop_column('comments', 'parent_id')
@@ -0,0 +1,40 @@
+"""add search index
+
+Revision ID: 8b1f4c6d2e07
+Revises: 3e8d5f27a1c9
+Create Date: 2026-10-18 23:12:04.530817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8b1f4c6d2e07'
+down_revision = '3e8d5f27a1c9'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Float, Integer, Unicode
+
+
+def upgrade():
+    # Filled in by bin/reindex-search.py, then kept up to date by the app
+    op.create_table('search_terms',
+        sa.Column('term', Unicode(64), primary_key=True, nullable=False),
+        sa.Column('resource_id', Integer, sa.ForeignKey('resources.id'),
+            primary_key=True, nullable=False, autoincrement=False),
+        sa.Column('weight', Float, nullable=False),
+    )
+    op.create_index('ix_search_terms_resource_id', 'search_terms',
+        ['resource_id'])
+
+    # Reindexing looks things up by resource
+    op.create_index('ix_artwork_resource_id', 'artwork', ['resource_id'])
+    op.create_index('ix_users_resource_id', 'users', ['resource_id'])
+    op.create_index('ix_discussions_resource_id', 'discussions',
+        ['resource_id'])
+
+
+def downgrade():
+    op.drop_index('ix_discussions_resource_id')
+    op.drop_index('ix_users_resource_id')
+    op.drop_index('ix_artwork_resource_id')
+    op.drop_table('search_terms')
@@ -0,0 +1,26 @@
+"""add comment content_html
+
+Revision ID: 2a7e5b0c9d14
+Revises: 6f0a3d9c81b4
+Create Date: 2026-10-19 00:41:17.662058
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2a7e5b0c9d14'
+down_revision = '6f0a3d9c81b4'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import UnicodeText
+
+
+def upgrade():
+    # Left empty; existing comments are rendered and filled in the first time
+    # they're shown
+    op.add_column('comments', sa.Column('content_html', UnicodeText,
+        nullable=True))
+
+
+def downgrade():
+    op.drop_column('comments', 'content_html')
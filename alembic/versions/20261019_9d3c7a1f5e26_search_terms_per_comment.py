@@ -0,0 +1,43 @@
+"""index each comment's search terms separately
+
+Revision ID: 9d3c7a1f5e26
+Revises: 2a7e5b0c9d14
+Create Date: 2026-10-19 02:14:52.308116
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d3c7a1f5e26'
+down_revision = '2a7e5b0c9d14'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.types import Float, Integer, Unicode
+
+
+def _create_table(*extra_columns):
+    op.create_table('search_terms',
+        sa.Column('term', Unicode(64), primary_key=True, nullable=False),
+        sa.Column('resource_id', Integer, sa.ForeignKey('resources.id'),
+            primary_key=True, nullable=False, autoincrement=False),
+        *(extra_columns + (sa.Column('weight', Float, nullable=False),))
+    )
+    op.create_index('ix_search_terms_resource_id', 'search_terms',
+        ['resource_id'])
+
+
+# The index is rebuilt from scratch either way; run bin/reindex-search.py
+# afterwards
+
+def upgrade():
+    op.drop_table('search_terms')
+    _create_table(sa.Column('comment_id', Integer, primary_key=True,
+        nullable=False, autoincrement=False, server_default='0'))
+    op.create_index('ix_search_terms_comment_id', 'search_terms',
+        ['comment_id'])
+
+
+def downgrade():
+    op.drop_index('ix_search_terms_comment_id')
+    op.drop_table('search_terms')
+    _create_table()
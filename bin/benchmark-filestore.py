@@ -0,0 +1,398 @@
+"""Benchmark the filestore backends, by storing lots of files through the same
+transaction data manager protocol the app uses.
+
+Each run puts files of one size into one backend from several threads at
+once, committing most transactions, aborting some, and making some fail at
+the vote.  It reports throughput, latency percentiles for whole transactions,
+and the peak memory use of the process, which runs on its own.
+
+MogileFS is benchmarked against a fake tracker and storage node, started in
+another process, that speak just enough of the protocol for pymogile; it
+shows the cost of floof's side of things, not of a real MogileFS install.
+Likewise, S3 is benchmarked against the fake server from the tests, which
+keeps every file in memory.  The tiered storage wraps a local one, and
+caches every file as it's committed."""
+import argparse
+import BaseHTTPServer
+from collections import defaultdict
+from cStringIO import StringIO
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+import transaction
+
+from floof.model.filestore import get_storage_factory
+from floof.tests import s3_server
+
+
+### Fake MogileFS
+
+class FakeTracker(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Keeps track of files in memory, and hands out paths on a
+    :class:`FakeStorageNode` at `storage_url`."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, storage_url):
+        SocketServer.TCPServer.__init__(self, address, FakeTrackerHandler)
+        self.storage_url = storage_url
+        self.paths = {}
+        self.next_fid = 1
+        self.lock = threading.Lock()
+
+class FakeTrackerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            command, _, query = line.strip().partition(' ')
+            args = dict(urlparse.parse_qsl(query))
+            handler = getattr(self, 'do_' + command, None)
+            if handler is None:
+                self.wfile.write('ERR unknown_command unknown_command\r\n')
+                continue
+
+            try:
+                with self.server.lock:
+                    result = handler(args)
+            except KeyError:
+                self.wfile.write('ERR unknown_key unknown_key\r\n')
+            else:
+                self.wfile.write('OK {0}\r\n'.format(urllib.urlencode(result)))
+
+    def do_create_open(self, args):
+        fid = self.server.next_fid
+        self.server.next_fid += 1
+        path = '{0}/dev1/0/000/000/{1:010d}.fid'.format(
+            self.server.storage_url, fid)
+        return dict(fid=fid, devid=1, path=path)
+
+    def do_create_close(self, args):
+        self.server.paths[args['key']] = args['path']
+        return {}
+
+    def do_get_paths(self, args):
+        return dict(paths=1, path1=self.server.paths[args['key']])
+
+    def do_rename(self, args):
+        self.server.paths[args['to_key']] = \
+            self.server.paths.pop(args['from_key'])
+        return {}
+
+    def do_delete(self, args):
+        del self.server.paths[args['key']]
+        return {}
+
+
+class FakeStorageNode(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Stores PUT files in `directory`, flattening their paths."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, directory):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, FakeStorageNodeHandler)
+        self.directory = directory
+
+class FakeStorageNodeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _path(self):
+        return os.path.join(
+            self.server.directory, self.path.strip('/').replace('/', '_'))
+
+    def _read_chunked(self, f):
+        while True:
+            length = int(self.rfile.readline().split(';')[0], 16)
+            if not length:
+                self.rfile.readline()
+                break
+            f.write(self.rfile.read(length))
+            self.rfile.readline()
+
+    def do_PUT(self):
+        with open(self._path(), 'wb') as f:
+            if self.headers.get('Transfer-Encoding') == 'chunked':
+                self._read_chunked(f)
+            else:
+                length = int(self.headers.get('Content-Length', 0))
+                f.write(self.rfile.read(length))
+
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        try:
+            f = open(self._path(), 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_fake_mogilefs(directory, addresses):
+    """Runs a fake tracker and storage node until killed, first putting their
+    addresses on the `addresses` queue."""
+    storage_node = FakeStorageNode(('127.0.0.1', 0), directory)
+    storage_url = 'http://{0}:{1}'.format(*storage_node.server_address)
+    tracker = FakeTracker(('127.0.0.1', 0), storage_url)
+    addresses.put('{0}:{1}'.format(*tracker.server_address))
+
+    thread = threading.Thread(target=tracker.serve_forever)
+    thread.daemon = True
+    thread.start()
+    storage_node.serve_forever()
+
+
+### Fake S3
+
+def run_fake_s3(addresses):
+    """Runs a :class:`floof.tests.s3_server.FakeS3Server` until killed, first
+    putting its address on the `addresses` queue."""
+    server = s3_server.start_server()
+    addresses.put(server.server_address)
+    threading.Event().wait()
+
+
+### Benchmarking
+
+class VoteFailure(Exception):
+    pass
+
+class FailingDataManager(object):
+    """Votes against every transaction it joins, after the storage has done
+    its work."""
+    def abort(self, transaction): pass
+    def tpc_begin(self, transaction): pass
+    def commit(self, transaction): pass
+    def tpc_finish(self, transaction): pass
+    def tpc_abort(self, transaction): pass
+
+    def tpc_vote(self, transaction):
+        raise VoteFailure
+
+    def sortKey(self):
+        return '~~~~last'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+def run_benchmark(settings, size, options, results):
+    """Stores files of `size` bytes in the storage described by `settings`,
+    and puts a dict of statistics on the `results` queue."""
+    storage_factory = get_storage_factory(settings)
+    data = os.urandom(size)
+    timings = defaultdict(list)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for n in xrange(options.transactions):
+            start = time.time()
+
+            storage = storage_factory()
+            trxn = transaction.begin()
+            trxn.join(storage)
+            for m in xrange(options.files):
+                key = uuid.uuid4().hex.decode('ascii')
+                storage.put(u'benchmark', key, StringIO(data))
+
+            roll = rng.random()
+            if roll < options.abort_ratio:
+                transaction.abort()
+                outcome = 'aborted'
+            elif roll < options.abort_ratio + options.fail_ratio:
+                trxn.join(FailingDataManager())
+                try:
+                    transaction.commit()
+                except VoteFailure:
+                    transaction.abort()
+                outcome = 'failed'
+            else:
+                transaction.commit()
+                outcome = 'committed'
+
+            timings[outcome].append(time.time() - start)
+
+    threads = [threading.Thread(target=worker, args=(seed,))
+        for seed in xrange(options.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(sum(timings.values(), []))
+    committed_bytes = len(timings['committed']) * options.files * size
+    results.put(dict(
+        transactions=len(latencies),
+        outcomes=dict((outcome, len(times))
+            for outcome, times in timings.iteritems()),
+        per_second=len(latencies) / elapsed,
+        mib_per_second=committed_bytes / elapsed / 2 ** 20,
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99),
+        # KiB on Linux; bytes on OS X
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    ))
+
+def run_isolated(settings, size, options):
+    """Runs :func:`run_benchmark` in its own process, so each run's peak
+    memory use is its own."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=run_benchmark, args=(settings, size, options, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def parse_size(size):
+    units = dict(k=2 ** 10, m=2 ** 20, g=2 ** 30)
+    size = size.strip().lower().rstrip('b')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def format_size(size):
+    for unit, scale in (('G', 2 ** 30), ('M', 2 ** 20), ('K', 2 ** 10)):
+        if size >= scale and size % scale == 0:
+            return '{0}{1}'.format(size // scale, unit)
+    return str(size)
+
+
+BACKENDS = ('local', 'sharded', 'mogilefs', 's3', 'tiered')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--backend', action='append', dest='backends',
+        choices=BACKENDS,
+        help='backend to benchmark; may be given more than once '
+            '(default: all of them)')
+    parser.add_argument('-s', '--size', action='append', dest='sizes',
+        type=parse_size, metavar='SIZE',
+        help='file size, like 4k or 2m; may be given more than once '
+            '(default: 16k and 1m)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+        help='number of threads storing files at once (default: 4)')
+    parser.add_argument('-n', '--transactions', type=int, default=100,
+        help='transactions per thread (default: 100)')
+    parser.add_argument('-f', '--files', type=int, default=1,
+        help='files stored per transaction (default: 1)')
+    parser.add_argument('--abort-ratio', type=float, default=0.1,
+        help='fraction of transactions to abort (default: 0.1)')
+    parser.add_argument('--fail-ratio', type=float, default=0.05,
+        help='fraction of transactions to fail at the vote (default: 0.05)')
+    parser.add_argument('-d', '--directory',
+        help='where to make the temporary directory for the local stores and '
+            'the fake MogileFS files, which is deleted afterwards '
+            "(default: the system's temporary directory)")
+    options = parser.parse_args()
+
+    if options.abort_ratio + options.fail_ratio > 1:
+        parser.error('abort and fail ratios add up to more than 1')
+
+    backends = options.backends or BACKENDS
+    sizes = options.sizes or [16 * 2 ** 10, 2 ** 20]
+    directory = tempfile.mkdtemp(dir=options.directory)
+
+    # The fake server for the current backend, if it needs one
+    server = None
+    try:
+        print '{0:<10} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10}  {7}'.format(
+            'backend', 'size', 'txn/s', 'MiB/s', 'p50 ms', 'p99 ms',
+            'peak RSS', 'committed/aborted/failed')
+
+        for backend in backends:
+            backend_directory = os.path.join(directory, backend)
+            os.mkdir(backend_directory)
+
+            if backend == 'mogilefs':
+                addresses = multiprocessing.Queue()
+                server = multiprocessing.Process(
+                    target=run_fake_mogilefs,
+                    args=(backend_directory, addresses))
+                server.daemon = True
+                server.start()
+                settings = {
+                    'filestore': 'mogilefs',
+                    'filestore.trackers': addresses.get(),
+                    'filestore.domain': 'benchmark',
+                }
+            elif backend == 's3':
+                addresses = multiprocessing.Queue()
+                server = multiprocessing.Process(
+                    target=run_fake_s3, args=(addresses,))
+                server.daemon = True
+                server.start()
+                host, port = addresses.get()
+                settings = {
+                    'filestore': 's3',
+                    'filestore.bucket': 'benchmark',
+                    'filestore.access_key': 'benchmark',
+                    'filestore.secret_key': 'benchmark',
+                    'filestore.host': host,
+                    'filestore.port': str(port),
+                    'filestore.is_secure': 'false',
+                }
+            elif backend == 'tiered':
+                os.mkdir(os.path.join(backend_directory, 'primary'))
+                settings = {
+                    'filestore': 'tiered',
+                    'filestore.directory':
+                        os.path.join(backend_directory, 'cache'),
+                    'filestore.policy.benchmark': 'always',
+                    'filestore.primary': 'local',
+                    'filestore.primary.directory':
+                        os.path.join(backend_directory, 'primary'),
+                }
+            else:
+                settings = {
+                    'filestore': backend,
+                    'filestore.directory': backend_directory,
+                }
+
+            for size in sizes:
+                result = run_isolated(settings, size, options)
+                outcomes = result['outcomes']
+                print ('{0:<10} {1:>6} {2:>9.1f} {3:>9.2f} {4:>9.2f} {5:>9.2f} '
+                    '{6:>9}K  {7}/{8}/{9}').format(
+                        backend, format_size(size),
+                        result['per_second'], result['mib_per_second'],
+                        result['p50'] * 1000, result['p99'] * 1000,
+                        result['peak_rss'],
+                        outcomes.get('committed', 0),
+                        outcomes.get('aborted', 0),
+                        outcomes.get('failed', 0))
+
+            if server:
+                server.terminate()
+                server = None
+
+    finally:
+        if server:
+            server.terminate()
+        shutil.rmtree(directory)
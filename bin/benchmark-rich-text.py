@@ -0,0 +1,178 @@
+"""Benchmark rendering Markdown with `floof.lib.richtext`, against building a
+new Markdown instance and cleaner for every text as was done originally.
+
+Each run renders the same set of made-up comments, of roughly one size, from
+several threads at once; a "comment page" is one batch of them.  Strategies:
+
+    fresh       a new Markdown instance and cleaner per text
+    pooled      pooled Markdown instances and shared cleaners, no cache
+    cold        `render_rich_text`, with the cache emptied before each page
+    warm        `render_rich_text`, with every text already cached
+    many        `render_many` per page, with the cache emptied before each
+    many-warm   `render_many` per page, with every text already cached
+
+It reports pages rendered per second, and latency percentiles per page."""
+import argparse
+import random
+import threading
+import time
+
+import lxml.html
+import lxml.html.clean
+import markdown
+
+from floof.lib import richtext
+
+
+WORDS = u"""
+    lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+    tempor incididunt ut labore et dolore magna aliqua fox cat art sketch
+""".split()
+
+def make_text(rng, size):
+    """Makes up a comment of about `size` characters, with a bit of everything
+    Markdown and the cleaner have to deal with."""
+    paragraphs = []
+    length = 0
+    while length < size:
+        words = [rng.choice(WORDS) for n in xrange(rng.randint(5, 30))]
+        roll = rng.random()
+        if roll < 0.2:
+            words[0] = u'*{0}*'.format(words[0])
+        elif roll < 0.3:
+            words.append(u'http://example.com/{0}'.format(rng.randint(1, 999)))
+        elif roll < 0.35:
+            words.append(u'<script>alert(1)</script>')
+        elif roll < 0.45:
+            words = [u'- ' + word + u'\n' for word in words[:5]]
+        paragraph = u' '.join(words)
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return u'\n\n'.join(paragraphs)
+
+
+def render_fresh(raw_text):
+    md = markdown.Markdown(extensions=[], output_format='html')
+    html = md.convert(raw_text)
+    fragment = lxml.html.fragment_fromstring(html, create_parent='div')
+    richtext._make_cleaner(richtext._cleaners[False].allow_tags)(fragment)
+    lxml.html.clean.autolink(fragment)
+    return lxml.html.tostring(fragment)
+
+def render_pooled(raw_text):
+    with richtext._markdown_pool.markdown() as md:
+        return richtext._render(md, raw_text, False)
+
+def page_one_at_a_time(render):
+    def render_page(texts):
+        for raw_text in texts:
+            render(raw_text)
+    return render_page
+
+STRATEGIES = (
+    # name, page renderer, whether the cache starts warm, whether each page
+    # starts with an empty cache
+    ('fresh', page_one_at_a_time(render_fresh), False, False),
+    ('pooled', page_one_at_a_time(render_pooled), False, False),
+    ('cold', page_one_at_a_time(richtext.render_rich_text), False, True),
+    ('warm', page_one_at_a_time(richtext.render_rich_text), True, False),
+    ('many', richtext.render_many, False, True),
+    ('many-warm', richtext.render_many, True, False),
+)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+def run_benchmark(render_page, warm, cold, pages, options):
+    """Renders every page in `pages` `options.repeat` times, spread over
+    `options.concurrency` threads.  Returns a dict of statistics."""
+    richtext._cache.invalidate()
+    if warm:
+        for page in pages:
+            richtext.render_many(page)
+
+    timings = []
+    timings_lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        mine = []
+        for n in xrange(options.repeat):
+            page = rng.choice(pages)
+            if cold:
+                richtext._cache.invalidate()
+            start = time.time()
+            render_page(page)
+            mine.append(time.time() - start)
+        with timings_lock:
+            timings.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(seed,))
+        for seed in xrange(options.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    timings.sort()
+    return dict(
+        pages=len(timings),
+        per_second=len(timings) / elapsed,
+        p50=percentile(timings, 0.5),
+        p99=percentile(timings, 0.99),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--strategy', action='append',
+        dest='strategies', choices=[name for name, _, _, _ in STRATEGIES],
+        help='strategy to benchmark; may be given more than once '
+            '(default: all of them)')
+    parser.add_argument('-l', '--length', action='append', dest='lengths',
+        type=int, metavar='CHARS',
+        help='approximate comment length; may be given more than once '
+            '(default: 200 and 2000)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+        help='number of threads rendering at once (default: 4)')
+    parser.add_argument('-p', '--page-size', type=int, default=50,
+        help='comments per page (default: 50)')
+    parser.add_argument('--pages', type=int, default=20,
+        help='number of different pages (default: 20)')
+    parser.add_argument('--duplicates', type=float, default=0.1,
+        help='fraction of comments on a page that repeat another '
+            '(default: 0.1)')
+    parser.add_argument('-n', '--repeat', type=int, default=50,
+        help='pages rendered per thread (default: 50)')
+    options = parser.parse_args()
+
+    strategies = [strategy for strategy in STRATEGIES
+        if not options.strategies or strategy[0] in options.strategies]
+    lengths = options.lengths or [200, 2000]
+    rng = random.Random(0)
+
+    print '{0:<10} {1:>6} {2:>9} {3:>9} {4:>9}'.format(
+        'strategy', 'length', 'pages/s', 'p50 ms', 'p99 ms')
+
+    for length in lengths:
+        pages = []
+        for n in xrange(options.pages):
+            page = []
+            for m in xrange(options.page_size):
+                if page and rng.random() < options.duplicates:
+                    page.append(rng.choice(page))
+                else:
+                    page.append(make_text(rng, length))
+            pages.append(page)
+
+        for name, render_page, warm, cold in strategies:
+            result = run_benchmark(render_page, warm, cold, pages, options)
+            print '{0:<10} {1:>6} {2:>9.1f} {3:>9.2f} {4:>9.2f}'.format(
+                name, length, result['per_second'],
+                result['p50'] * 1000, result['p99'] * 1000)
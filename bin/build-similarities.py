@@ -0,0 +1,48 @@
+"""Rebuild the index of which artwork is like which, used for "art like this"
+and suggestions.  Run it every so often, e.g. nightly.  See
+floof.lib.similarity; needs NumPy and SciPy."""
+import argparse
+import logging
+import os
+
+from paste.deploy import appconfig
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from floof.lib.similarity import build_similarities
+from floof import model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('-k', '--top-k', type=int, default=20,
+        help='neighbors to keep per artwork (default: 20)')
+    parser.add_argument('-b', '--batch-size', type=int, default=500,
+        help='artwork to compare and commit at a time (default: 500)')
+    parser.add_argument('--rating-weight', type=float, default=1.0,
+        help='weight of similar ratings (default: 1)')
+    parser.add_argument('--tag-weight', type=float, default=1.0,
+        help='weight of similar tags (default: 1)')
+    parser.add_argument('--min-similarity', type=float, default=0.01,
+        help='ignore neighbors less similar than this (default: 0.01)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+
+    model.initialize(
+        engine_from_config(conf, 'sqlalchemy.'),
+        extension=ZopeTransactionExtension())
+
+    stored = build_similarities(
+        top_k=args.top_k,
+        batch_size=args.batch_size,
+        rating_weight=args.rating_weight,
+        tag_weight=args.tag_weight,
+        min_similarity=args.min_similarity,
+    )
+
+    print "Stored {0} neighbor(s)".format(stored)
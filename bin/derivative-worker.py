@@ -0,0 +1,52 @@
+"""Generate thumbnails and other derivatives of uploaded artwork in the
+background.  See floof.lib.derivatives."""
+import argparse
+import logging
+import multiprocessing
+import os
+
+from paste.deploy import appconfig
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from floof.lib.derivatives import run_worker
+from floof import model
+
+
+def work(conf, once, poll_interval):
+    # Each process needs its own database connections
+    model.initialize(
+        engine_from_config(conf, 'sqlalchemy.'),
+        extension=ZopeTransactionExtension())
+
+    run_worker(conf, once=once, poll_interval=poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+        help='number of worker processes to run (default: 1)')
+    parser.add_argument('--poll-interval', type=float, default=5,
+        help='seconds to wait between checks of an empty queue')
+    parser.add_argument('--once', action='store_true',
+        help='exit once the queue is empty, rather than waiting for more')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+
+    if args.processes == 1:
+        work(conf, args.once, args.poll_interval)
+    else:
+        workers = [
+            multiprocessing.Process(
+                target=work, args=(conf, args.once, args.poll_interval))
+            for n in xrange(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,42 @@
+"""Recalculate every artwork's rating count, sum and score from its ratings,
+e.g. after importing ratings or changing how scores are calculated.  See
+floof.lib.ratings."""
+import argparse
+import logging
+import os
+
+from paste.deploy import appconfig
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from floof.lib.ratings import recalculate_ratings
+from floof import model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('--from-id', type=int,
+        help='first artwork id to do')
+    parser.add_argument('--to-id', type=int,
+        help='last artwork id to do')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+        help='artwork to recalculate and commit at a time (default: 1000)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+
+    model.initialize(
+        engine_from_config(conf, 'sqlalchemy.'),
+        extension=ZopeTransactionExtension())
+
+    fixed = recalculate_ratings(
+        from_id=args.from_id,
+        to_id=args.to_id,
+        batch_size=args.batch_size,
+    )
+
+    print "Fixed the ratings of {0} artwork(s)".format(fixed)
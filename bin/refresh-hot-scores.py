@@ -0,0 +1,36 @@
+"""Keep the hot scores of recently rated artwork up to date, in the
+background.  See floof.lib.hotness."""
+import argparse
+import logging
+import os
+
+from paste.deploy import appconfig
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from floof.lib.hotness import run_refresher
+from floof import model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('-i', '--interval', type=float, default=300,
+        help='seconds between refreshes (default: 300)')
+    parser.add_argument('-a', '--all', action='store_true',
+        help='start by refreshing all artwork, e.g. after an upgrade or after '
+            'the refresher has been stopped for a while')
+    parser.add_argument('--once', action='store_true',
+        help='exit after one refresh, e.g. when running from cron')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+
+    model.initialize(
+        engine_from_config(conf, 'sqlalchemy.'),
+        extension=ZopeTransactionExtension())
+
+    run_refresher(interval=args.interval, everything=args.all, once=args.once)
@@ -0,0 +1,82 @@
+"""Make thumbnails or other renditions of existing artwork in bulk, e.g.
+after changing their settings.  See floof.lib.derivatives."""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+
+from paste.deploy import appconfig
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from floof.lib.derivatives import backfill_renditions, get_renditions
+from floof.model import filestore
+from floof import model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('-r', '--rendition', action='append',
+        dest='renditions', metavar='NAME',
+        help='rendition to make; may be given more than once (default: '
+            'all the eager ones, i.e. thumbnails)')
+    parser.add_argument('--from-id', type=int,
+        help='first artwork id to do')
+    parser.add_argument('--to-id', type=int,
+        help='last artwork id to do')
+    parser.add_argument('-b', '--batch-size', type=int, default=100,
+        help='artwork to store and commit at a time (default: 100)')
+    parser.add_argument('-p', '--processes', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of processes to resize with (default: one per CPU)')
+    parser.add_argument('-c', '--checkpoint', metavar='PATH',
+        help='file to record progress in, so an interrupted run can pick up '
+            'where it left off')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='remake renditions even if they are up to date')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+
+    all_renditions = get_renditions(conf)
+    if args.renditions:
+        unknown = set(args.renditions) - set(all_renditions)
+        if unknown:
+            parser.error('no such rendition(s): ' + ', '.join(sorted(unknown)))
+        renditions = [all_renditions[name] for name in args.renditions]
+    else:
+        renditions = [rendition for name, rendition
+            in sorted(all_renditions.iteritems()) if rendition.eager]
+
+    # Start the pool before connecting to the database; the workers only
+    # resize, and shouldn't inherit any connections
+    pool = None
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+
+    model.initialize(
+        engine_from_config(conf, 'sqlalchemy.'),
+        extension=ZopeTransactionExtension())
+
+    made, failed = backfill_renditions(
+        filestore.get_storage_factory(conf),
+        renditions,
+        from_id=args.from_id,
+        to_id=args.to_id,
+        batch_size=args.batch_size,
+        pool=pool,
+        checkpoint_path=args.checkpoint,
+        force=args.force,
+    )
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    print "Made {0} rendition(s); {1} failed".format(made, failed)
+    sys.exit(1 if failed else 0)
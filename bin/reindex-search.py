@@ -0,0 +1,33 @@
+"""Rebuild the full-text search index from scratch, e.g. after first adding
+it.  See floof.lib.search."""
+import argparse
+import logging
+import os
+
+from paste.deploy import appconfig
+from sqlalchemy import engine_from_config
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from floof.lib.search import reindex_all
+from floof import model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+        help='resources to reindex and commit at a time (default: 1000)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+
+    model.initialize(
+        engine_from_config(conf, 'sqlalchemy.'),
+        extension=ZopeTransactionExtension())
+
+    done = reindex_all(batch_size=args.batch_size)
+
+    print "Reindexed {0} resource(s)".format(done)
@@ -0,0 +1,32 @@
+"""Move every file in a local filestore to a new shard layout, in place.  See
+floof.model.filestore.sharded.
+
+Stop the app first.  Afterwards, set filestore = sharded, along with
+filestore.depth and filestore.width to match."""
+import argparse
+import os
+
+from paste.deploy import appconfig
+
+from floof.model.filestore.sharded import reshard
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ini_spec', metavar='config-file.ini#app-name')
+    parser.add_argument('-d', '--depth', type=int, default=2,
+        help='number of levels of directories (default: 2)')
+    parser.add_argument('-w', '--width', type=int, default=2,
+        help='characters of the key per level (default: 2)')
+    args = parser.parse_args()
+
+    if args.depth < 0 or args.width < 1:
+        parser.error('depth must be at least 0 and width at least 1')
+
+    # Get paster to interpret the passed config file
+    conf = appconfig('config:' + os.path.abspath(args.ini_spec))
+    if conf['filestore'] not in ('local', 'sharded'):
+        parser.error('filestore is not local')
+
+    moved = reshard(conf['filestore.directory'], args.depth, args.width)
+    print "Moved {0} file(s)".format(moved)
@@ -17,6 +17,9 @@ from zope.sqlalchemy import ZopeTransactionExtension
 from floof.lib.authn import Authenticizer, FloofAuthnPolicy
 from floof.lib.authz import auto_privilege_escalation
 from floof.lib.authz import current_view_permission
+from floof.lib.autocomplete import get_autocompleter
+from floof.lib.cache import get_cache
+from floof.lib.derivatives import get_renditions
 from floof.lib.stash import manage_stashes
 from floof.model import filestore
 from floof.resource import FloofRoot
@@ -150,7 +153,11 @@ def main(global_config, **settings):
 
     # Misc other crap
     settings['rating_radius'] = int(settings['rating_radius'])
+    settings['renditions'] = get_renditions(settings)
     settings['filestore_factory'] = filestore.get_storage_factory(settings)
+    settings['gallery_fragment_cache'] = get_cache(settings, 'gallery_cache')
+    settings['filestore_info_cache'] = get_cache(settings, 'filestore_cache')
+    settings['autocompleter'] = get_autocompleter(settings)
 
     ### Configuratify
     # Session factory needs to subclass our mixin above.  Beaker's
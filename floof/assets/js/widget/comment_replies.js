@@ -0,0 +1,19 @@
+// Collapsed branches of comment threads link to the thread page; with JS,
+// the replies are fetched and filled in where the link was instead
+$(function() {
+    $(document).on('click', '.js-comment-replies a', function(event) {
+        var link = $(this);
+        var container = link.closest('.js-comment-replies');
+        event.preventDefault();
+
+        $.ajax({
+            url: container.data('replies-url'),
+            success: function(html) {
+                container.replaceWith(html);
+            },
+            error: function(xhr) {
+                floofHandleAJAXError(xhr);
+            }
+        });
+    });
+});
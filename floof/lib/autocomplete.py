@@ -0,0 +1,376 @@
+"""Autocompletion of user and tag names, from indexes kept in memory.
+
+Every keystroke in a name field asks for completions, so they're answered
+from a :class:`PrefixIndex` per kind of thing, rather than from the database.
+The indexes are loaded the first time they're needed, and then kept up to date
+with changes committed through this process; see
+`_schedule_autocomplete_changes`.  Changes committed by other processes only
+show up once the indexes are reloaded, every `reload_interval` seconds.
+
+An :class:`Autocompleter` can be constructed from deployment settings with
+:func:`get_autocompleter`.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+from pyramid.threadlocal import get_current_registry
+from sqlalchemy import and_, event
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE, get_history
+import transaction
+
+from floof import model
+
+# No one asking for completions needs more than this many
+MAX_COMPLETIONS = 20
+
+
+class _Node(object):
+    __slots__ = ('children', 'keys', 'best')
+
+    def __init__(self):
+        self.children = {}
+        # Entries with a name ending exactly here
+        self.keys = set()
+        # The best entries anywhere below here, best first, and no more than
+        # MAX_COMPLETIONS of them
+        self.best = []
+
+
+class PrefixIndex(object):
+    """A trie of names, for finding the highest-scoring entries with a name
+    starting with some prefix.
+
+    Each entry has a key, any number of names to be found by, a score, and
+    some data that's handed back when it's found.  Matching ignores case.
+
+    Every node keeps a list of the best `MAX_COMPLETIONS` entries below it,
+    so any completion costs a walk down the trie and no more.  A node's list
+    can be worked out from its own entries and its children's lists, so
+    changing an entry only redoes the lists along its names' paths, from the
+    bottom up; the rest of the trie is left alone.  All methods are safe to
+    call from several threads at once.
+    """
+    def __init__(self):
+        self._root = _Node()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, name, create=False):
+        """Yields every node from the root down to the end of `name`.  Stops
+        early if the path doesn't exist, unless `create` is true."""
+        node = self._root
+        yield node
+        for char in name:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return
+                child = node.children[char] = _Node()
+            node = child
+            yield node
+
+    def _sort_key(self, key):
+        names, score, data = self._entries[key]
+        return -score, min(names), key
+
+    def _rebuild(self, node):
+        """Redoes a node's list of best entries from its children's."""
+        candidates = set(node.keys)
+        for child in node.children.itervalues():
+            candidates.update(child.best)
+        node.best = heapq.nsmallest(
+            MAX_COMPLETIONS, candidates, key=self._sort_key)
+
+    def _rebuild_paths(self, names):
+        """Redoes the lists along the paths of `names`, deepest first, so
+        every node sees its children's new lists."""
+        nodes = {}
+        for name in names:
+            for depth, node in enumerate(self._path(name)):
+                nodes[id(node)] = depth, node
+        for depth, node in sorted(nodes.itervalues(),
+                key=lambda pair: -pair[0]):
+            self._rebuild(node)
+
+    def _unlink(self, key):
+        """Takes an entry out of the trie, returning its names; the lists
+        along their paths are left for the caller to redo."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return frozenset()
+
+        names = entry[0]
+        for name in names:
+            node = None
+            for node in self._path(name):
+                pass
+            if node is not None:
+                node.keys.discard(key)
+        return names
+
+    def _link(self, key, names, score, data):
+        self._entries[key] = names, score, data
+        for name in names:
+            node = None
+            for node in self._path(name, create=True):
+                pass
+            node.keys.add(key)
+
+    def set(self, key, names, score, data):
+        """Adds an entry, or replaces the one with the same key."""
+        names = frozenset(name.lower() for name in names if name)
+        with self._lock:
+            old_names = self._unlink(key)
+            self._link(key, names, score, data)
+            self._rebuild_paths(old_names | names)
+
+    def set_many(self, entries):
+        """Adds a lot of (key, names, score, data) entries at once, redoing
+        every list in the trie just once at the end.  Much faster than
+        calling :meth:`set` for each, when filling a new index."""
+        with self._lock:
+            for key, names, score, data in entries:
+                self._unlink(key)
+                self._link(key,
+                    frozenset(name.lower() for name in names if name),
+                    score, data)
+
+            # Children before parents
+            stack = [(self._root, False)]
+            while stack:
+                node, children_done = stack.pop()
+                if children_done:
+                    self._rebuild(node)
+                else:
+                    stack.append((node, True))
+                    stack.extend(
+                        (child, False) for child in node.children.itervalues())
+
+    def set_score(self, key, score):
+        """Changes the score of an entry, if it's there."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            names, old_score, data = entry
+            if score == old_score:
+                return
+
+            self._entries[key] = names, score, data
+            self._rebuild_paths(names)
+
+    def remove(self, key):
+        """Removes an entry, if it's there."""
+        with self._lock:
+            self._rebuild_paths(self._unlink(key))
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        """Returns the data of the best entries with a name starting with
+        `prefix`, best first, and no more than `limit` of them."""
+        limit = max(0, min(limit, MAX_COMPLETIONS))
+        with self._lock:
+            node = None
+            depth = 0
+            for depth, node in enumerate(self._path(prefix.lower())):
+                pass
+            if depth < len(prefix):
+                return []
+
+            return [self._entries[key][2] for key in node.best[:limit]]
+
+
+### Loading and updating
+
+def _user_names(name, display_name):
+    """A user can be found by their name, their display name, or any word in
+    their display name."""
+    names = [name]
+    if display_name:
+        names.append(display_name)
+        names.extend(display_name.split())
+    return names
+
+def _user_entry(id, name, display_name, artwork_count):
+    return (
+        id,
+        _user_names(name, display_name),
+        artwork_count or 0,
+        dict(id=id, name=name, display_name=display_name),
+    )
+
+def _tag_entry(id, name, artwork_count):
+    return id, [name], artwork_count or 0, dict(id=id, name=name)
+
+def _with_artwork_counts(session, cls, subject_type, *columns):
+    count_table = model.ArtworkCount.__table__
+    return session.query(*(columns + (count_table.c.artwork_count,))) \
+        .outerjoin((count_table, and_(
+            count_table.c.subject_type == subject_type,
+            count_table.c.subject_id == cls.id)))
+
+def _query_users(session, ids=None):
+    query = _with_artwork_counts(session, model.User, u'user',
+        model.User.id, model.User.name, model.User.display_name)
+    if ids is not None:
+        query = query.filter(model.User.id.in_(ids))
+    return [_user_entry(*row) for row in query]
+
+def _query_tags(session, ids=None):
+    query = _with_artwork_counts(session, model.Tag, u'tag',
+        model.Tag.id, model.Tag.name)
+    if ids is not None:
+        query = query.filter(model.Tag.id.in_(ids))
+    return [_tag_entry(*row) for row in query]
+
+
+class Autocompleter(object):
+    """Holds the user and tag indexes, and loads them when they're needed."""
+    def __init__(self, reload_interval=600):
+        self.reload_interval = reload_interval
+        self.users = None
+        self.tags = None
+        self.loaded_time = None
+        self._load_lock = threading.Lock()
+
+    def load(self, session):
+        """(Re)loads both indexes from scratch, with one query each."""
+        users = PrefixIndex()
+        users.set_many(_query_users(session))
+        tags = PrefixIndex()
+        tags.set_many(_query_tags(session))
+
+        self.users, self.tags = users, tags
+        self.loaded_time = time.time()
+
+    def _ensure_loaded(self, session):
+        if self.loaded_time is None:
+            # Everyone has to wait for the first load
+            with self._load_lock:
+                if self.loaded_time is None:
+                    self.load(session)
+        elif time.time() - self.loaded_time > self.reload_interval:
+            # Whoever notices first reloads; everyone else can make do with
+            # the old indexes meanwhile
+            if self._load_lock.acquire(False):
+                try:
+                    self.load(session)
+                finally:
+                    self._load_lock.release()
+
+    def complete_users(self, session, prefix, limit=MAX_COMPLETIONS):
+        """Returns dicts of `id`, `name` and `display_name` of the users with
+        the most art whose names start with `prefix`."""
+        self._ensure_loaded(session)
+        return self.users.complete(prefix, limit)
+
+    def complete_tags(self, session, prefix, limit=MAX_COMPLETIONS):
+        """Returns dicts of `id` and `name` of the most used tags starting
+        with `prefix`."""
+        self._ensure_loaded(session)
+        return self.tags.complete(prefix, limit)
+
+    def apply(self, changes):
+        """Applies what :func:`collect_changes` found, unless nothing's been
+        loaded yet (in which case the load will see it anyway)."""
+        if self.loaded_time is None:
+            return
+
+        for kind, index in (('users', self.users), ('tags', self.tags)):
+            removed, entries, counts = changes[kind]
+            for key in removed:
+                index.remove(key)
+            for entry in entries:
+                index.set(*entry)
+            for key, count in counts.iteritems():
+                index.set_score(key, count)
+
+def get_autocompleter(settings):
+    """Uses a Pyramid deployment settings dictionary to construct an
+    :class:`Autocompleter`."""
+    return Autocompleter(
+        reload_interval=int(settings.get('autocomplete.reload_interval', 600)))
+
+
+def collect_changes(session):
+    """Works out what changes to the indexes the pending flush makes.  Must be
+    called after the flush, so the artwork counts are up to date.
+
+    Returns a dict of `users` and `tags` to (keys to remove, entries to set,
+    dict of key to new artwork count).
+    """
+    removed = dict(users=set(), tags=set())
+    renamed = dict(users=set(), tags=set())
+    recounted = dict(users=set(), tags=set())
+
+    def changed(obj, *attributes):
+        return obj in session.new or any(
+            get_history(obj, attribute, PASSIVE_NO_INITIALIZE).has_changes()
+            for attribute in attributes)
+
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, model.User):
+            if obj in session.deleted:
+                removed['users'].add(obj.id)
+            elif changed(obj, 'name', 'display_name'):
+                renamed['users'].add(obj.id)
+        elif isinstance(obj, model.Tag):
+            if obj in session.deleted:
+                removed['tags'].add(obj.id)
+            elif changed(obj, 'name'):
+                renamed['tags'].add(obj.id)
+        elif isinstance(obj, model.UserArtwork):
+            if obj in session.new or obj in session.deleted:
+                recounted['users'].add(obj.user_id)
+        elif isinstance(obj, model.Artwork):
+            history = get_history(obj, 'tag_objs', PASSIVE_NO_INITIALIZE)
+            for tag in itertools.chain(history.added, history.deleted):
+                recounted['tags'].add(tag.id)
+
+    changes = {}
+    for kind, query in (('users', _query_users), ('tags', _query_tags)):
+        entries = []
+        if renamed[kind]:
+            entries = query(session, renamed[kind])
+
+        counts = {}
+        recount = recounted[kind] - renamed[kind] - removed[kind]
+        if recount:
+            counts = dict(
+                (entry[0], entry[2]) for entry in query(session, recount))
+
+        changes[kind] = removed[kind], entries, counts
+    return changes
+
+def _apply_autocomplete_changes(success, autocompleter, changes):
+    if success:
+        autocompleter.apply(changes)
+
+def _schedule_autocomplete_changes(session, flush_context):
+    """Arranges for this flush's changes to users and tags to reach the
+    autocompletion indexes once the current transaction commits, if the
+    indexes have been loaded."""
+    if not any(isinstance(obj, (model.User, model.Tag, model.UserArtwork,
+            model.Artwork)) for obj in itertools.chain(
+                session.new, session.dirty, session.deleted)):
+        return
+
+    # The indexes are only around when running under the web app
+    settings = get_current_registry().settings or {}
+    autocompleter = settings.get('autocompleter')
+    if autocompleter is None or autocompleter.loaded_time is None:
+        return
+
+    changes = collect_changes(session)
+    if not any(removed or entries or counts
+            for removed, entries, counts in changes.itervalues()):
+        return
+
+    transaction.get().addAfterCommitHook(
+        _apply_autocomplete_changes, (autocompleter, changes))
+
+event.listen(model.session, 'after_flush', _schedule_autocomplete_changes)
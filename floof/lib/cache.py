@@ -0,0 +1,227 @@
+"""Caches for chunks of rendered HTML.
+
+Some pages are expensive to build but look exactly the same to everyone who
+isn't logged in -- galleries are the obvious example.  The caches here hold
+onto those rendered fragments for a while, so the next anonymous visitor can
+skip the database and the template engine entirely.
+
+Every cache has the same small interface:
+
+`get(key)`
+    Returns the unicode fragment stored under `key`, or None if there isn't
+    one or it's expired.
+`set(key, fragment)`
+    Stores a unicode fragment.
+`delete(key)`
+    Throws away a single entry, if it's there.
+`invalidate()`
+    Throws away everything, e.g. because some art was uploaded.
+
+Keys are arbitrary strings; the caches hash them, so length doesn't matter.
+Values needn't be fragments, either; anything picklable will do.
+
+A cache can be constructed from deployment settings with :func:`get_cache`.
+"""
+from __future__ import absolute_import
+from collections import OrderedDict
+import cPickle as pickle
+import errno
+from hashlib import sha1
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from pyramid.util import DottedNameResolver
+
+
+def get_cache(settings, prefix='gallery_cache'):
+    """Uses a Pyramid deployment settings dictionary to construct and return a
+    cache, or None if caching is turned off.
+
+    Works just like :func:`floof.model.filestore.get_storage_factory`: the
+    `$prefix` setting picks the cache, and any `$prefix.$key` settings are
+    passed to its constructor as `$key`.  The cache may be named by the full
+    dotted name of a class, or be one of `memory` or `filesystem`.  If the
+    setting is missing, empty, or `none`, there's no cache.
+    """
+    name = settings.get(prefix, u'').strip()
+    if name.lower() in (u'', u'none'):
+        return None
+
+    kwargs = {}
+    plen = len(prefix)
+    for key, val in settings.iteritems():
+        if key[0:plen] == prefix and len(key) > plen:
+            kwargs[ key[plen+1:] ] = val
+
+    if name in CACHES:
+        cache = CACHES[name]
+    else:
+        cache = DottedNameResolver(None).resolve(name)
+
+    return cache(**kwargs)
+
+
+def _hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf8')
+    return sha1(key).hexdigest()
+
+
+class MemoryCache(object):
+    """Keeps fragments in a dict in this process, evicting the least recently
+    used when it gets too big.
+
+    Fast and simple, but every process has its own copy -- and, more
+    importantly, only sees its own invalidations.  Under a multi-process
+    server, changes made through one process will only show up in another
+    once its copy times out.  Use :class:`FilesystemCache` there instead.
+    """
+    def __init__(self, max_items=1000, timeout=300):
+        self.max_items = int(max_items)
+        self.timeout = int(timeout)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        key = _hash_key(key)
+        with self._lock:
+            try:
+                expiry, fragment = self._entries.pop(key)
+            except KeyError:
+                return None
+
+            if expiry < time.time():
+                return None
+
+            # Re-insert, moving this entry to the most-recently-used end
+            self._entries[key] = expiry, fragment
+            return fragment
+
+    def set(self, key, fragment):
+        key = _hash_key(key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = time.time() + self.timeout, fragment
+
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        key = _hash_key(key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FilesystemCache(object):
+    """Keeps fragments as files in a directory, so every process on the box
+    shares them.
+
+    Entries live in a subdirectory named after the current "generation", and
+    invalidating just starts a new generation and deletes the old one.  Every
+    write goes to a temporary file that's then renamed into place, so readers
+    never see half an entry.
+    """
+    generation_filename = 'generation'
+
+    def __init__(self, directory, timeout=300):
+        self.directory = directory
+        self.timeout = int(timeout)
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # Another process might have beaten us to it
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _write_atomically(self, path, data):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def _generation(self):
+        path = os.path.join(self.directory, self.generation_filename)
+        try:
+            with open(path, 'rb') as f:
+                generation = f.read().strip()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            generation = None
+
+        if not generation:
+            generation = self._new_generation()
+        return generation
+
+    def _new_generation(self):
+        generation = uuid.uuid4().hex
+        self._write_atomically(
+            os.path.join(self.directory, self.generation_filename),
+            generation)
+        return generation
+
+    def _path(self, key, generation):
+        return os.path.join(self.directory, generation, _hash_key(key))
+
+    def get(self, key):
+        path = self._path(key, self._generation())
+        try:
+            with open(path, 'rb') as f:
+                expiry, fragment = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if expiry < time.time():
+            return None
+
+        return fragment
+
+    def set(self, key, fragment):
+        path = self._path(key, self._generation())
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._write_atomically(path, pickle.dumps(
+            (time.time() + self.timeout, fragment),
+            pickle.HIGHEST_PROTOCOL))
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key, self._generation()))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def invalidate(self):
+        self._new_generation()
+
+        # Clean out every other generation.  Some other process may be busy
+        # doing the same thing, so don't worry about what disappears underfoot
+        current = self._generation()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name != current and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+
+CACHES = {
+    u'memory': MemoryCache,
+    u'filesystem': FilesystemCache,
+}
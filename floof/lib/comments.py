@@ -0,0 +1,86 @@
+"""Fetching comment threads a page at a time.
+
+A popular discussion can have far more comments than are worth showing at
+once, so they're shown a page of top-level threads at a time, and only down
+to a few levels below each thread's first comment.  Anything deeper is left
+collapsed, with a count of the replies hidden there; those can be fetched
+later with :func:`load_subtrees` on the comment they're below.
+
+Comments are stored with materialized paths (see `floof.model.Comment`), so
+each page costs the same handful of queries however big the discussion is.
+"""
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import and_, func
+
+from floof import model
+from floof.lib.pager import DiscretePager
+
+# Top-level threads shown per page
+THREADS_PER_PAGE = 20
+# Levels of replies shown below a thread's first comment before collapsing
+VISIBLE_DEPTH = 4
+
+
+def load_subtrees(session, discussion, roots, depth=VISIBLE_DEPTH):
+    """Loads `roots`, which must be siblings and consecutive in path order,
+    and their replies up to `depth` levels below them.
+
+    Returns a list of all those comments in path order, and a dict of how
+    many replies are hidden below the comments at the bottom, by comment id.
+    """
+    if not roots:
+        return [], {}
+
+    # Everything below the roots lies between the first root and the last
+    # root's last possible descendant
+    in_subtrees = and_(
+        model.Comment.discussion_id == discussion.id,
+        model.Comment.path.between(roots[0].path,
+            roots[-1].path.ljust(model.COMMENT_PATH_LENGTH, u'9')),
+    )
+    max_length = len(roots[0].path) + depth * model.COMMENT_PATH_SEGMENT
+    path_length = func.length(model.Comment.path)
+
+    comments = session.query(model.Comment) \
+        .filter(in_subtrees) \
+        .filter(path_length <= max_length) \
+        .order_by(model.Comment.path.asc()) \
+        .options(joinedload('author')) \
+        .all()
+
+    # Everything deeper is hidden; count it up by which visible comment it's
+    # below, which is just a matter of chopping its path off
+    hidden_below = func.substr(model.Comment.path, 1, max_length)
+    hidden_counts = dict(
+        (int(path[-model.COMMENT_PATH_SEGMENT:]), count)
+        for path, count in session.query(hidden_below, func.count())
+            .filter(in_subtrees)
+            .filter(path_length > max_length)
+            .group_by(hidden_below))
+
+    return comments, hidden_counts
+
+
+class CommentPage(object):
+    """One page of a discussion's threads.  Rendered by `comment_tree` and
+    the pager in the templates.
+
+    `pager` pages through the top-level comments; `comments` holds them and
+    their visible replies, in path order; and `hidden_counts` is as returned
+    by :func:`load_subtrees`.
+    """
+    def __init__(self, session, discussion, formdata={},
+            page_size=THREADS_PER_PAGE, depth=VISIBLE_DEPTH):
+        threads = session.query(model.Comment) \
+            .filter(model.Comment.discussion_id == discussion.id) \
+            .filter(model.Comment.parent_id == None) \
+            .order_by(model.Comment.path.asc())
+
+        self.discussion = discussion
+        self.pager = DiscretePager(threads, page_size, formdata,
+            countable=True)
+        self.comments, self.hidden_counts = load_subtrees(
+            session, discussion, self.pager.items, depth)
+
+    def __iter__(self):
+        return iter(self.comments)
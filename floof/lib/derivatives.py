@@ -0,0 +1,577 @@
+# encoding: utf8
+"""Thumbnails and other files derived from uploaded artwork.
+
+Every derivative is a "rendition" of the original: a named combination of
+size, file format and so on.  There's always a `thumbnail`, sized by the
+`thumbnail_size` setting; others are defined by `rendition.$name.$option`
+settings, and all are served from the filestore route with their name as the
+class.  Each rendition that's been made is recorded as an
+:class:`ArtworkRendition`, stored under a key that includes a fingerprint of
+the rendition's options.  Changing the options just means the old files stop
+being used, and new ones are made as they're needed.
+
+Most renditions are made the first time someone asks for them.  "Eager" ones,
+like thumbnails, are wanted almost immediately, but decoding and resizing a
+big image is slow, so it doesn't happen while the uploader waits.  Instead,
+uploading queues up a :class:`DerivativeJob` for each, and a worker process
+(bin/derivative-worker.py) grinds through them in the background.  Until it
+gets to them, the filestore serves a placeholder instead.
+
+Renditions of existing artwork can be made in bulk, e.g. to get new
+thumbnails out of the way after changing their size, with
+bin/regenerate-renditions.py.
+"""
+from __future__ import absolute_import, division
+from cStringIO import StringIO
+from datetime import timedelta
+import errno
+from hashlib import sha1
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib2
+
+from pyramid.settings import asbool
+from sqlalchemy.sql import and_, or_
+import transaction
+
+from floof import model
+from floof.model import filestore
+
+# PIL is an unholy fucking abomination that can't even be imported right
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+
+log = logging.getLogger(__name__)
+
+MAX_ASPECT_RATIO = 2
+
+# PIL formats for the original files we accept
+IMAGE_FORMATS = {
+    u'image/png':   'PNG',
+    u'image/gif':   'GIF',
+    u'image/jpeg':  'JPEG',
+}
+
+# Formats renditions may be converted to, as PIL format and MIME type
+RENDITION_FORMATS = {
+    u'jpeg':    ('JPEG', u'image/jpeg'),
+    u'png':     ('PNG', u'image/png'),
+    u'webp':    ('WEBP', u'image/webp'),
+}
+
+# Give up on a job after this many tries
+MAX_ATTEMPTS = 3
+# Wait this much longer before each retry
+RETRY_DELAY = timedelta(seconds=30)
+# Assume a worker has died if it's been working on something this long
+JOB_LEASE = timedelta(minutes=10)
+
+
+class Rendition(object):
+    """One kind of rendition, as configured by `rendition.$name.$option`
+    settings.  The options are:
+
+    `size`
+        Largest allowed width and height, in pixels.  Smaller images are left
+        alone.
+    `format`
+        `original` (the default) to keep the original file's format, or one
+        of `jpeg`, `png`, or `webp`.
+    `quality`
+        Quality for lossy formats, from 1 to 100.  Defaults to 85.
+    `crop`
+        Whether to crop overly long or tall images to an aspect ratio of 2
+        first, like thumbnails.  Defaults to false.
+    `eager`
+        Whether to make this rendition in the background right after upload,
+        rather than the first time it's asked for.  Defaults to false.
+    """
+    def __init__(self, name, size, format=u'original', quality=85,
+            crop=False, eager=False):
+        self.name = name
+        self.size = int(size)
+        self.format = unicode(format)
+        self.quality = int(quality)
+        self.crop = asbool(crop)
+        self.eager = asbool(eager)
+
+        if self.format != u'original':
+            if self.format not in RENDITION_FORMATS:
+                raise ValueError("Unknown format {0} for rendition {1}"
+                    .format(self.format, name))
+
+            Image.init()
+            if RENDITION_FORMATS[self.format][0] not in Image.SAVE:
+                raise ValueError("PIL can't write {0}, needed for rendition {1}"
+                    .format(self.format, name))
+
+        # Changing anything here changes the fingerprint, which makes
+        # everything made with the old settings obsolete
+        self.fingerprint = sha1(repr(
+            (self.size, self.format, self.quality, self.crop))) \
+            .hexdigest()[:8].decode('ascii')
+
+    def storage_key(self, artwork):
+        """Returns the filestore key for this rendition of `artwork`; the
+        filestore class is the rendition's name."""
+        return u'{0}.{1}'.format(artwork.hash, self.fingerprint)
+
+    def _pil_format(self, original_mime_type):
+        if self.format == u'original':
+            return IMAGE_FORMATS[original_mime_type]
+        return RENDITION_FORMATS[self.format][0]
+
+    def mime_type(self, original_mime_type):
+        """Returns the MIME type of this rendition of a file with the given
+        MIME type."""
+        if self.format == u'original':
+            return original_mime_type
+        return RENDITION_FORMATS[self.format][1]
+
+    def render(self, image):
+        """Returns a resized copy of the PIL `image`."""
+        if self.crop:
+            return make_thumbnail(image, self.size)
+        return _shrink_to_fit(image, self.size)
+
+    def encode(self, image, original_mime_type):
+        """Returns the PIL `image`, presumably from :meth:`render`, as a
+        string in this rendition's format."""
+        pil_format = self._pil_format(original_mime_type)
+
+        save_kwargs = {}
+        if pil_format in ('JPEG', 'WEBP'):
+            save_kwargs['quality'] = self.quality
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = _flatten(image)
+
+        buf = StringIO()
+        image.save(buf, pil_format, **save_kwargs)
+        return buf.getvalue()
+
+
+def get_renditions(settings):
+    """Returns a dict mapping the name of each configured rendition to its
+    :class:`Rendition`.
+    """
+    options = {
+        u'thumbnail': dict(
+            size=settings['thumbnail_size'], crop=True, eager=True),
+    }
+    for key, value in settings.iteritems():
+        parts = key.split('.')
+        if len(parts) == 3 and parts[0] == 'rendition':
+            _, name, option = parts
+            options.setdefault(unicode(name), {})[str(option)] = value
+
+    return dict(
+        (name, Rendition(name, **kwargs))
+        for name, kwargs in options.iteritems()
+    )
+
+
+def _shrink_to_fit(image, size):
+    width, height = image.size
+    if width <= size and height <= size:
+        return image
+
+    if width > height:
+        new_size = (size, max(1, height * size // width))
+    else:
+        new_size = (max(1, width * size // height), size)
+
+    return image.resize(new_size, Image.ANTIALIAS)
+
+def _flatten(image):
+    """Paints an image with transparency onto white, for formats that don't
+    support transparency."""
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.split()[3])
+    return background
+
+def make_thumbnail(image, size):
+    """Crops and shrinks a PIL `image` to fit in a `size`-pixel square, and
+    returns the result.  Images smaller than that are only cropped.
+    """
+    # NOTE: this logic is replicated in the upload JS; please keep in sync
+    width, height = image.size
+    # To avoid super-skinny thumbnails, don't let the aspect ratio go
+    # beyond 2
+    height = min(height, width * MAX_ASPECT_RATIO)
+    width = min(width, height * MAX_ASPECT_RATIO)
+    # crop() takes left, top, right, bottom
+    cropped_image = image.crop((0, 0, width, height))
+    # And resize...  if necessary
+    return _shrink_to_fit(cropped_image, size)
+
+
+def enqueue(artwork, renditions):
+    """Queues up jobs to make the eager ones among `renditions`, a dict like
+    the one returned by :func:`get_renditions`, for `artwork`."""
+    for name, rendition in sorted(renditions.iteritems()):
+        if rendition.eager:
+            artwork.derivative_jobs.append(model.DerivativeJob(class_=name))
+
+
+def current_rendition(session, artwork, rendition):
+    """Returns the :class:`ArtworkRendition` record of the given `rendition`
+    of `artwork`, or None if it hasn't been made with the current settings.
+    """
+    return session.query(model.ArtworkRendition) \
+        .filter_by(
+            artwork_id=artwork.id,
+            name=rendition.name,
+            fingerprint=rendition.fingerprint,
+        ) \
+        .first()
+
+
+def make_rendition_file(storage_url, original_mime_type, rendition,
+        directory=None):
+    """Does the slow part of making a rendition: fetches the original file
+    from `storage_url`, then resizes and encodes it into a new temporary file
+    in `directory`.  Returns the path to that file and the new image's width
+    and height.
+
+    This only needs plain values, so it can run in another process.
+    """
+    # PIL wants to seek around, so make a local copy first
+    with tempfile.TemporaryFile() as original:
+        shutil.copyfileobj(urllib2.urlopen(storage_url), original)
+        original.seek(0)
+
+        image = rendition.render(Image.open(original))
+        data = rendition.encode(image, original_mime_type)
+
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+
+    width, height = image.size
+    return path, width, height
+
+
+def store_rendition(session, storage, artwork, rendition, path, width,
+        height):
+    """Hands the rendition file at `path`, presumably from
+    :func:`make_rendition_file`, to `storage` and records it.  Returns the new
+    :class:`ArtworkRendition`.
+    """
+    file_size = os.path.getsize(path)
+    storage.put_path(rendition.name, rendition.storage_key(artwork), path)
+
+    # Replace whatever was there, whether made with old settings or, when
+    # backfilling with `force`, the same ones.  Two requests might make the
+    # same rendition at once; they'll store the same file, but only one can
+    # add a row, and the other's transaction will fail
+    session.query(model.ArtworkRendition) \
+        .filter_by(artwork_id=artwork.id, name=rendition.name) \
+        .delete(synchronize_session=False)
+
+    artwork_rendition = model.ArtworkRendition(
+        artwork=artwork,
+        name=rendition.name,
+        fingerprint=rendition.fingerprint,
+        mime_type=rendition.mime_type(artwork.mime_type),
+        width=width,
+        height=height,
+        file_size=file_size,
+    )
+    session.add(artwork_rendition)
+    return artwork_rendition
+
+
+def generate_rendition(session, storage, artwork, rendition):
+    """Makes a rendition of `artwork` and puts it in `storage`, which must
+    already be joined to the current transaction.  Returns the new
+    :class:`ArtworkRendition` and the contents of the file, which won't be
+    available from the storage until the transaction is committed.
+    """
+    storage_url = storage.url(u'artwork', artwork.hash)
+    if not storage_url:
+        raise IOError("File artwork:{0} is missing".format(artwork.hash))
+
+    path, width, height = make_rendition_file(
+        storage_url, artwork.mime_type, rendition, storage.tempdir)
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    artwork_rendition = store_rendition(
+        session, storage, artwork, rendition, path, width, height)
+    return artwork_rendition, data
+
+
+def claim_job(session):
+    """Finds the next job that needs doing and marks it as running.  Returns
+    the job, or None if there's nothing to do.
+
+    Commit promptly afterwards, so other workers know the job's taken!
+    """
+    now = model.now()
+    job_table = model.DerivativeJob.__table__
+    claimable = or_(
+        and_(
+            job_table.c.state == u'queued',
+            job_table.c.available_time <= now,
+        ),
+        and_(
+            job_table.c.state == u'running',
+            job_table.c.started_time < now - JOB_LEASE,
+        ),
+    )
+
+    candidate_ids = session.query(model.DerivativeJob.id) \
+        .filter(claimable) \
+        .order_by(model.DerivativeJob.id) \
+        .limit(10)
+
+    for job_id, in candidate_ids.all():
+        # Another worker may have gotten here first; this only succeeds if
+        # the job is still claimable
+        result = session.execute(
+            job_table.update()
+                .where(job_table.c.id == job_id)
+                .where(claimable)
+                .values(
+                    state=u'running',
+                    started_time=now,
+                    attempts=job_table.c.attempts + 1,
+                )
+        )
+        if result.rowcount == 1:
+            job = session.query(model.DerivativeJob).get(job_id)
+            session.refresh(job)
+            return job
+
+    return None
+
+
+def run_job(job_id, storage_factory, renditions):
+    """Does the work for an already-claimed job, in its own transaction.  On
+    success, the job is deleted; on failure, it's put back in the queue for
+    another try later.
+    """
+    session = model.session
+
+    transaction.begin()
+    storage = storage_factory()
+    transaction.get().join(storage)
+    job = session.query(model.DerivativeJob).get(job_id)
+
+    try:
+        rendition = renditions.get(job.class_)
+        if rendition is None:
+            # This rendition isn't configured any more; nothing to do
+            log.warn("Dropping job for unknown rendition {0}"
+                .format(job.class_))
+        elif not current_rendition(session, job.artwork, rendition):
+            generate_rendition(session, storage, job.artwork, rendition)
+
+        session.delete(job)
+        transaction.commit()
+        return True
+
+    except Exception as e:
+        log.exception("Failed to generate {0} for artwork {1}"
+            .format(job.class_, job.artwork_id))
+        error = unicode(repr(e))
+        transaction.abort()
+
+    transaction.begin()
+    job = session.query(model.DerivativeJob).get(job_id)
+    if job.attempts >= MAX_ATTEMPTS:
+        job.state = u'failed'
+    else:
+        job.state = u'queued'
+        job.available_time = model.now() + RETRY_DELAY * job.attempts
+    job.last_error = error
+    transaction.commit()
+    return False
+
+
+def run_worker(settings, once=False, poll_interval=5):
+    """Works through the job queue forever, or until the queue is empty if
+    `once` is true.  The model must already be initialized.
+
+    Several workers may run at once, in as many processes as you like.
+    """
+    storage_factory = filestore.get_storage_factory(settings)
+    renditions = get_renditions(settings)
+
+    while True:
+        transaction.begin()
+        job = claim_job(model.session)
+        job_id = job and job.id
+        transaction.commit()
+
+        if job_id is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job_id, storage_factory, renditions)
+
+
+def _make_rendition_file_safely(task):
+    """Wrapper around :func:`make_rendition_file` for use with a process pool.
+    Errors are returned rather than raised, so one bad file doesn't stop the
+    whole backfill.
+    """
+    artwork_id, rendition_name, args = task
+    try:
+        return artwork_id, rendition_name, make_rendition_file(*args), None
+    except Exception as e:
+        return artwork_id, rendition_name, None, unicode(repr(e))
+
+
+def _fingerprints(renditions):
+    return dict((rendition.name, rendition.fingerprint)
+        for rendition in renditions)
+
+def read_checkpoint(path, renditions):
+    """Returns the id of the last artwork that a previous backfill of the same
+    `renditions`, with the same settings, got through.  Returns None if
+    there's no such checkpoint at `path`.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+    if checkpoint['fingerprints'] != _fingerprints(renditions):
+        log.warn("Ignoring checkpoint {0}, which is for different renditions"
+            .format(path))
+        return None
+
+    return checkpoint['last_id']
+
+def write_checkpoint(path, renditions, last_id):
+    """Records that a backfill of `renditions` has gotten through every
+    artwork up to `last_id`."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(dict(
+            fingerprints=_fingerprints(renditions),
+            last_id=last_id,
+        ), f)
+    os.rename(temp_path, path)
+
+
+def backfill_renditions(storage_factory, renditions, from_id=None,
+        to_id=None, batch_size=100, pool=None, checkpoint_path=None,
+        force=False):
+    """Makes the given `renditions`, a list of :class:`Rendition`s, of every
+    existing artwork with an id between `from_id` and `to_id` inclusive.  The
+    model must already be initialized.
+
+    Artwork is handled in batches of `batch_size`, in order of id, and each
+    batch is stored and committed together.  If a multiprocessing `pool` is
+    given, the decoding and resizing is spread across it.
+
+    Renditions that already exist with the current settings are skipped,
+    unless `force` is true, so running this again only does what's left.
+    If there's a `checkpoint_path`, the progress is also recorded there after
+    every batch, and a later run will start from where this one left off.
+
+    Returns the number of renditions made and the number that failed.
+    """
+    session = model.session
+    renditions_by_name = dict(
+        (rendition.name, rendition) for rendition in renditions)
+    if pool:
+        imap = pool.imap_unordered
+    else:
+        imap = itertools.imap
+
+    last_id = None
+    if from_id is not None:
+        last_id = from_id - 1
+    if checkpoint_path:
+        checkpoint_id = read_checkpoint(checkpoint_path, renditions)
+        if checkpoint_id is not None and (
+                last_id is None or checkpoint_id > last_id):
+            last_id = checkpoint_id
+
+    made = failed = 0
+    while True:
+        transaction.begin()
+        storage = storage_factory()
+        transaction.get().join(storage)
+
+        query = session.query(model.Artwork).order_by(model.Artwork.id)
+        if last_id is not None:
+            query = query.filter(model.Artwork.id > last_id)
+        if to_id is not None:
+            query = query.filter(model.Artwork.id <= to_id)
+        batch = query.limit(batch_size).all()
+        if not batch:
+            transaction.abort()
+            break
+
+        artworks = dict((artwork.id, artwork) for artwork in batch)
+
+        # Find what's already been made with the current settings
+        done = set()
+        if not force:
+            done.update(
+                session.query(
+                    model.ArtworkRendition.artwork_id,
+                    model.ArtworkRendition.name)
+                .filter(model.ArtworkRendition.artwork_id.in_(artworks))
+                .filter(or_(*[
+                    and_(
+                        model.ArtworkRendition.name == rendition.name,
+                        model.ArtworkRendition.fingerprint
+                            == rendition.fingerprint,
+                    )
+                    for rendition in renditions
+                ]))
+            )
+
+        tasks = []
+        for artwork in batch:
+            if artwork.mime_type not in IMAGE_FORMATS:
+                continue
+
+            storage_url = storage.url(u'artwork', artwork.hash)
+            for rendition in renditions:
+                if (artwork.id, rendition.name) in done:
+                    continue
+
+                tasks.append((artwork.id, rendition.name, (
+                    storage_url, artwork.mime_type, rendition,
+                    storage.tempdir)))
+
+        for artwork_id, name, result, error in imap(
+                _make_rendition_file_safely, tasks):
+            if error:
+                log.error("Failed to make {0} for artwork {1}: {2}"
+                    .format(name, artwork_id, error))
+                failed += 1
+                continue
+
+            store_rendition(session, storage, artworks[artwork_id],
+                renditions_by_name[name], *result)
+            made += 1
+
+        last_id = batch[-1].id
+        transaction.commit()
+
+        if checkpoint_path:
+            write_checkpoint(checkpoint_path, renditions, last_id)
+        log.info("Done up to artwork {0}; {1} made, {2} failed so far"
+            .format(last_id, made, failed))
+
+    return made, failed
@@ -0,0 +1,111 @@
+"""Remembers what the filestore view needs to know to serve each file.
+
+Serving a thumbnail only takes its MIME type and where the storage keeps it,
+but finding those out costs a database query and, with some storages, a
+round trip to another server.  Galleries show dozens of thumbnails at once, so
+that adds up fast.  Instead, the answers are kept in a cache, keyed by class
+and key, and galleries fill it in for all their thumbnails at once with
+:func:`warm`.
+
+The cache is whatever the `filestore_cache` setting says, in the manner of
+:func:`floof.lib.cache.get_cache`.  With no cache, everything is looked up
+afresh every time, as before.
+"""
+from __future__ import absolute_import
+from collections import namedtuple
+
+from floof import model
+
+FileInfo = namedtuple('FileInfo', [
+    # MIME type, as a string ready to go in a header
+    'content_type',
+    # Content-Disposition header, or None
+    'disposition',
+    # Where the storage has the file
+    'storage_url',
+    # Entity tag, which is just the storage key; keys are content hashes
+    'etag',
+])
+
+
+def _cache(request):
+    return request.registry.settings.get('filestore_info_cache')
+
+def _cache_key(request, class_, key):
+    # Renditions are stored under their fingerprint, which changes when their
+    # settings do, and a filesystem cache can outlive a restart
+    rendition = request.registry.settings['renditions'].get(class_)
+    if rendition:
+        return u'{0}:{1}:{2}'.format(class_, key, rendition.fingerprint)
+    return u'{0}:{1}'.format(class_, key)
+
+
+def lookup(request, class_, key):
+    """Returns the cached :class:`FileInfo` for a file, or None."""
+    cache = _cache(request)
+    if cache is None:
+        return None
+    return cache.get(_cache_key(request, class_, key))
+
+def remember(request, class_, key, info):
+    """Caches the :class:`FileInfo` for a file.  Only remember files that are
+    actually in storage!
+    """
+    cache = _cache(request)
+    if cache is not None:
+        cache.set(_cache_key(request, class_, key), info)
+
+def forget(request, class_, key):
+    """Drops the cached :class:`FileInfo` for a file, e.g. because the storage
+    no longer has it where it said."""
+    cache = _cache(request)
+    if cache is not None:
+        cache.delete(_cache_key(request, class_, key))
+
+
+def warm(request, class_, artworks):
+    """Caches the info for the `class_` rendition of each of `artworks` (e.g.
+    thumbnails), with one query and one storage lookup for the lot.
+    Renditions that haven't been made yet are skipped.
+    """
+    cache = _cache(request)
+    rendition = request.registry.settings['renditions'].get(class_)
+    if cache is None or rendition is None:
+        return
+
+    artworks = [artwork for artwork in artworks
+        if cache.get(_cache_key(request, class_, artwork.hash)) is None]
+    if not artworks:
+        return
+
+    artwork_renditions = model.session.query(model.ArtworkRendition) \
+        .filter(model.ArtworkRendition.artwork_id.in_(
+            [artwork.id for artwork in artworks])) \
+        .filter_by(name=rendition.name, fingerprint=rendition.fingerprint)
+    mime_types = dict(
+        (artwork_rendition.artwork_id, artwork_rendition.mime_type)
+        for artwork_rendition in artwork_renditions)
+
+    # Ask for the URLs of each MIME type together, since storages that
+    # redirect bake the type into them; a rendition usually has only one
+    by_type = {}
+    for artwork in artworks:
+        if artwork.id in mime_types:
+            content_type = mime_types[artwork.id].encode('utf8')
+            by_type.setdefault(content_type, {})[
+                rendition.storage_key(artwork)] = artwork
+
+    for content_type, artworks_by_key in by_type.iteritems():
+        storage_urls = request.storage.urls(
+            class_, artworks_by_key.keys(), content_type=content_type)
+        for storage_key, artwork in artworks_by_key.iteritems():
+            storage_url = storage_urls.get(storage_key)
+            if not storage_url:
+                continue
+
+            cache.set(_cache_key(request, class_, artwork.hash), FileInfo(
+                content_type=content_type,
+                disposition=None,
+                storage_url=storage_url,
+                etag=storage_key,
+            ))
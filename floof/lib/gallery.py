@@ -6,31 +6,37 @@ Intended to be used and usable from basically all over the place.  You probably
 want the `GallerySieve` class.
 """
 from datetime import timedelta
-
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql import or_
+from hashlib import sha1
+import itertools
+
+from pyramid.threadlocal import get_current_registry
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, joinedload_all, subqueryload
+from sqlalchemy.orm import subqueryload_all
+from sqlalchemy.sql import cast, func, or_
+from sqlalchemy.types import Float, Numeric
+import transaction
 import wtforms.form, wtforms.fields
 
 from floof.lib import pager
+from floof.lib import search
+from floof.lib import tagquery
 from floof import model
 
 # TODO: albums (is there a favorites ticket?)
-# TODO: "art like this" on art page
 # TODO: another special search, elsewhere, for friend-of-friends (watches of everyone in album x)
 
 class GalleryForm(wtforms.form.Form):
     """Form used all over the place for "searching" (really filtering) through
     art.
     """
-    # TODO replace me with a special tag filter field that somehow interacts
-    # correctly with the function below.  syntax should include:
-    # - arbitrary boolean queries
-    #   a | b?  a OR b?  OR(a b)??
-    # - then bogus tags can just error back to the form, if that makes sense.
-    #   or just show nothing, with a warning.  not sure which is less useful.
+    # Boolean tag query; see floof.lib.tagquery.  Bogus tags show nothing,
+    # with a warning
     # TODO this includes user searchin.  so what to do about uploader, if
     # anything?
     tags = wtforms.fields.TextField(u'Tags')
+    # Full-text search; see floof.lib.search
+    text = wtforms.fields.TextField(u'Text')
     # TODO maybe arbitrary-ish date search here?  center+radius.  I often find
     # myself wanting to look for stuff that's "about six months old"
     time_radius = wtforms.fields.SelectField(u'Uploaded within',
@@ -61,10 +67,10 @@ class GalleryForm(wtforms.form.Form):
     sort = wtforms.fields.SelectField(u'Sort by',
         choices=[
             (u'uploaded_time',  u'time uploaded'),
+            (u'hot',            u'popularity right now'),
             (u'rating',         u'rating (restricted to the last 24h)'),
             (u'rating_count',   u'number of ratings'),
-            # TODO implement me
-            #(u'suggest',        u"how much I'd like it"),
+            (u'suggest',        u"how much I'd like it"),
         ],
         default=u'uploaded_time',
     )
@@ -91,6 +97,85 @@ TIME_RADII = {
 
 PAGE_SIZE = 64  # XXX
 
+# Relationships that each display mode renders.  These are loaded for the
+# whole page in bulk, rather than lazily one row at a time, so showing a page
+# of art takes the same number of queries no matter how much is on it
+LOAD_PLANS = {
+    u'thumbnails': (
+        joinedload('uploader'),
+    ),
+    u'succinct': (),
+    u'detailed': (
+        joinedload('uploader'),
+        joinedload_all('resource.discussion'),
+        subqueryload_all('user_artwork.user'),
+        subqueryload('tag_objs'),
+    ),
+}
+
+# Filters whose results are counted ahead of time in the artwork_counts table,
+# and the corresponding subject type there
+PRECOUNTED_FILTERS = {
+    'artist':   u'user',
+    'tag':      u'tag',
+    'album':    u'album',
+}
+
+# Unrated art has no score at all, and NULLs sort differently in different
+# databases.  Scores are always in [-1, 1], so this puts it below everything
+UNRATED_SCORE = -2.0
+
+def _rating_score_or_unrated(artwork):
+    if artwork.rating_score is None:
+        return UNRATED_SCORE
+    return artwork.rating_score
+
+# Changing any of these might change what some gallery shows, so committing
+# one throws away every cached gallery.  Anything else that galleries display
+# (comment counts, user names) is left to go stale until the cache times out
+GALLERY_CLASSES = (
+    model.Artwork,
+    model.ArtworkRating,
+    model.UserArtwork,
+    model.Tag,
+    model.Album,
+    model.UserWatch,
+)
+
+def _invalidate_gallery_cache(success, gallery_cache):
+    if success:
+        gallery_cache.invalidate()
+
+def _schedule_gallery_cache_invalidation(session, flush_context):
+    """Arranges for the gallery cache to be emptied once the current
+    transaction commits, if this flush touched anything that appears in
+    galleries.
+
+    Doing it any earlier would let another request cache the old data again
+    between now and the commit.
+    """
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, GALLERY_CLASSES):
+            break
+    else:
+        return
+
+    # The cache is only around when running under the web app
+    settings = get_current_registry().settings or {}
+    gallery_cache = settings.get('gallery_fragment_cache')
+    if gallery_cache is None:
+        return
+
+    txn = transaction.get()
+    for hook, args, kwargs in txn.getAfterCommitHooks():
+        if hook is _invalidate_gallery_cache:
+            return
+    txn.addAfterCommitHook(_invalidate_gallery_cache, (gallery_cache,))
+
+event.listen(model.session, 'after_flush',
+    _schedule_gallery_cache_invalidation)
+
+
 class GallerySieve(object):
     """Handles filtering art by various criteria.  Different places within the
     site show different chunks of artwork, but ought to function similarly;
@@ -107,13 +192,13 @@ class GallerySieve(object):
     combined arbitrarily; they'll be ANDed together.
     """
 
-    default_order_clauses = (
-        model.Artwork.uploaded_time.desc(),
-        model.Artwork.id.desc(),
+    default_sort_keys = (
+        pager.SortKey(model.Artwork.uploaded_time),
+        pager.SortKey(model.Artwork.id),
     )
-    temporal_column_name = 'uploaded_time'
 
-    def __init__(self, session=None, user=None, formdata=None, countable=False):
+    def __init__(self, session=None, user=None, formdata=None, countable=False,
+            load_plans=LOAD_PLANS):
         """Parameters:
 
         `session`
@@ -132,11 +217,17 @@ class GallerySieve(object):
         `countable`
             If set to True, the gallery display will include a count of the
             total number of items (even when filtered!), and the page list will
-            run from first to last.  If set to False (the default), the page
-            list will instead trail off after the current page, only showing a
-            next page link if there are more items to see.  The intention is
+            run from first to last.  If set to False (the default), there
+            will be no page list at all, only links to the previous and next
+            pages if there are more items to see.  The intention is
             that this be set to True only for "real" gallery, such as the
             artwork a single user owns.
+        `load_plans`
+            A dict mapping each display mode to a sequence of SQLAlchemy
+            loader options, which will be applied to the query when it's
+            evaluated.  Defaults to `LOAD_PLANS`, which covers everything the
+            standard gallery templates need; pass something else if you're
+            rendering the artwork some other way.
         """
         if not session:
             session = model.session
@@ -145,9 +236,17 @@ class GallerySieve(object):
         self.user = user
         self.countable = countable
         self.display_mode = 'thumbnails'
+        self.load_plans = load_plans
 
+        # Every filter applied so far, as (name, value) pairs
+        self.applied_filters = []
+        # Suggestion scores, by artwork id, when sorting by them; see
+        # `_suggestion_sort_key`
+        self.suggestion_scores = None
+
+        self.sort_keys = self.default_sort_keys
         self.query = session.query(model.Artwork) \
-            .order_by(*self.default_order_clauses)
+            .order_by(*[key.order_clause() for key in self.sort_keys])
 
         self.form = GalleryForm(formdata)
         self.original_formdata = formdata or {}
@@ -162,10 +261,19 @@ class GallerySieve(object):
         self.display_mode = form.display.data
 
         if form.tags.data:
-            self.filter_by_tag_query(form.tags.data)
+            try:
+                missing = self.filter_by_tag_query(form.tags.data)
+            except tagquery.TagQueryError as e:
+                form.tags.errors.append(unicode(e))
+            else:
+                for name in missing:
+                    form.tags.errors.append(
+                        u"There's no such thing as '{0}'".format(name))
+
+        if form.text.data:
+            self.filter_by_text(form.text.data)
 
         # TODO: allow "popular per day" a la e621?
-        # TODO: or for "popular recently", use popularity * age for falloff?
         if form.time_radius.data != u'all':
             self.filter_by_recency(
                 timedelta(**TIME_RADII[form.time_radius.data]))
@@ -174,6 +282,7 @@ class GallerySieve(object):
             # This is done here instead of via a method until someone comes up
             # with a decent method interface.
             rating_spec = form.my_rating.data
+            self.applied_filters.append(('my_rating', rating_spec))
             my_rating_subq = self.session.query(model.ArtworkRating) \
                 .filter_by(user=self.user) \
                 .subquery()
@@ -204,7 +313,11 @@ class GallerySieve(object):
                 # Only other option is 'any', which is taken care of by the
                 # join alone
 
-        self.order_by(form.sort.data)
+        if form.sort.data == u'suggest' and not self.user:
+            # Nothing to go on
+            self.order_by(u'uploaded_time')
+        else:
+            self.order_by(form.sort.data)
         if form.sort.data == u'rating':
             # Only allow the past 24 hours when sorting by absolute rating
             self.filter_by_recency(timedelta(hours=24))
@@ -214,10 +327,23 @@ class GallerySieve(object):
 
     def filter_by_age(self, dt):
         """Find art uploaded at or before `dt`."""
+        self.applied_filters.append(('age', dt))
         self.query = self.query.filter(model.Artwork.uploaded_time <= dt)
 
+    def filter_by_text(self, text):
+        """Find art whose title, tags, remark or comments contain every word
+        in `text`.  See `floof.lib.search`."""
+        terms = search.query_terms(text)
+        if not terms:
+            return
+
+        self.applied_filters.append(('text', tuple(terms)))
+        self.query = self.query.filter(model.Artwork.resource_id.in_(
+            search.matching_resources(self.session, terms).subquery()))
+
     def filter_by_recency(self, delta):
         """Find art uploaded no earlier than `delta` before now."""
+        self.applied_filters.append(('recency', delta))
         self.query = self.query.filter(
             model.Artwork.uploaded_time >= model.now() - delta)
 
@@ -225,6 +351,7 @@ class GallerySieve(object):
 
     def filter_by_artist(self, artist):
         """Filter the gallery by artist."""
+        self.applied_filters.append(('artist', artist.id))
         self.query = self.query.filter(
             model.Artwork.user_artwork.any(
                 user_id=artist.id,
@@ -238,11 +365,12 @@ class GallerySieve(object):
         if ' ' in tag:
             raise ValueError("Tags cannot contain spaces; is this a list of tags?")
         if tag.startswith(('by:', 'for:', 'of:')):
-            raise ValueError("Cannot filter by special tags; use filter_by_user instead")
+            raise ValueError("Cannot filter by special tags; use filter_by_artist instead")
 
         # This will raise NoResultFound with a bogus tag -- as it should, since
         # this is called from our code, not directly on user input
         tag = self.session.query(model.Tag).filter_by(name=tag).one()
+        self.applied_filters.append(('tag', tag.id))
 
         self.query = self.query.filter(
             model.Artwork.tag_objs.any(id=tag.id)
@@ -250,27 +378,36 @@ class GallerySieve(object):
 
     def filter_by_tag_query(self, tag_query):
         """Filter by an arbitrary Boolean set of tags.  The query itself is a
-        string, which this method is responsible for parsing.
+        string, which this method is responsible for parsing; see
+        `floof.lib.tagquery` for the syntax.
 
-        Current syntax is just a space-delimited list of tags.
+        Raises `TagQueryError` if the query doesn't parse.  Tags and artists
+        that don't exist match nothing; their names are returned, so they
+        can be pointed out.
         """
-        for tag in tag_query.split():
-            try:
-                if u':' in tag:
-                    rel, _, username = tag.partition(':')
-                    user = self.session.query(model.User).filter_by(name=username).one()
-                    self.filter_by_user(rel, user)
-                else:
-                    self.filter_by_tag(tag)
-            except NoResultFound:
-                # XXX ???
-                pass
+        node = tagquery.parse(tag_query)
+        if node is None:
+            return []
+
+        ids = tagquery.resolve(self.session, node)
+
+        # A lone tag or artist can use the precounted totals
+        if isinstance(node, tagquery.Tag) and node in ids:
+            self.applied_filters.append(('tag', ids[node]))
+        elif isinstance(node, tagquery.Artist) and node in ids:
+            self.applied_filters.append(('artist', ids[node]))
+        else:
+            self.applied_filters.append(('tag_query', unicode(node)))
+
+        self.query = self.query.filter(tagquery.compile_query(node, ids))
+        return tagquery.missing_names(node, ids)
 
     ### Special filter methods; only one of these can exist in a form at a time
 
     def filter_by_watches(self, user):
         """Filter the gallery down to only things `user` is watching."""
         # XXX make this work for multiple users
+        self.applied_filters.append(('watches', user.id))
         self.query = self.query.filter(or_(
             # Check for artist watching
             model.Artwork.id.in_(
@@ -292,69 +429,170 @@ class GallerySieve(object):
 
         This method DOES NOT CHECK that the album is viewable; do that yourself.
         """
+        self.applied_filters.append(('album', album.id))
         self.query = self.query.filter(
             model.Artwork.albums.any(id=album.id))
 
 
     def order_by(self, order):
-        """Changes the sort order.  May be one of "uploaded_time", "rating",
-        "rating_count".
+        """Changes the sort order.  May be one of "uploaded_time", "hot",
+        "rating", "rating_count", "suggest".
+
+        "hot" is recent popularity, with older art gradually sinking; see
+        `floof.lib.hotness`.  "suggest" puts first the art most like what the
+        user has rated well, according to the precomputed neighbors in
+        `ArtworkSimilarity`, so it needs a user.
 
         The default is "uploaded_time".
         """
-        self.temporal_column_name = None
-
         if order == 'uploaded_time':
-            order_column = model.Artwork.uploaded_time
-            self.temporal_column_name = 'uploaded_time'
+            sort_keys = ()
+        elif order == 'hot':
+            sort_keys = (pager.SortKey(model.Artwork.hot_score),)
         elif order == 'rating':
-            order_column = model.Artwork.rating_score
+            sort_keys = (pager.SortKey(
+                func.coalesce(model.Artwork.rating_score, UNRATED_SCORE),
+                getter=_rating_score_or_unrated),)
         elif order == 'rating_count':
-            order_column = model.Artwork.rating_count
+            sort_keys = (pager.SortKey(model.Artwork.rating_count),)
+        elif order == 'suggest':
+            sort_keys = (self._suggestion_sort_key(),)
         else:
             raise ValueError("No such ordering {0}".format(order))
 
+        # Always fall back to the default order, which breaks ties uniquely
+        self.sort_keys = sort_keys + self.default_sort_keys
         self.query = self.query.order_by(None) \
-            .order_by(order_column.desc(), *self.default_order_clauses)
+            .order_by(*[key.order_clause() for key in self.sort_keys])
+
+
+    def _suggestion_sort_key(self):
+        """Joins each artwork's suggestion score for the user, and returns a
+        sort key for it.  The score is the sum of the similarities between
+        that art and everything the user's rated, weighted by their ratings.
+        """
+        if not self.user:
+            raise ValueError("Can't suggest art without a user")
+
+        similarity = model.ArtworkSimilarity
+        rating = model.ArtworkRating
+        suggestions = self.session.query(
+                similarity.similar_artwork_id.label('artwork_id'),
+                func.sum(similarity.similarity * rating.rating)
+                    .label('score')) \
+            .join((rating, rating.artwork_id == similarity.artwork_id)) \
+            .filter(rating.user_id == self.user.id) \
+            .group_by(similarity.similar_artwork_id) \
+            .subquery()
+
+        self.query = self.query.outerjoin(
+            (suggestions, suggestions.c.artwork_id == model.Artwork.id))
+
+        # Rounded, so that paging compares exactly the same values.  Some
+        # databases hand back a Decimal, which won't go in a cursor
+        expression = func.round(
+            cast(func.coalesce(suggestions.c.score, 0), Numeric), 6,
+            type_=Float)
+
+        # The score is loaded alongside each artwork, for making cursors out
+        # of; `evaluate` takes it back off
+        self.query = self.query.add_column(
+            expression.label('suggestion_score'))
+        self.suggestion_scores = scores = {}
+
+        def getter(artwork):
+            return scores[artwork.id]
+
+        return pager.SortKey(expression, getter=getter)
 
 
     ### The fruits of our labors
 
+    def cache_key(self, url):
+        """Returns a string identifying everything that goes into rendering
+        this sieve at `url` for an anonymous user: the filters applied, the
+        sort order, the display mode, and which page is being shown.  Two
+        sieves with the same key render the same HTML, as long as nothing
+        has been committed in between.
+
+        Returns None if the sieve shouldn't be cached at all, i.e. when the
+        form has errors to show.
+        """
+        if self.form.errors:
+            return None
+
+        cursor = [(name, self.original_formdata.get(name))
+            for name in ('after', 'before', 'skip')]
+
+        fingerprint = (
+            url,
+            self.countable,
+            self.display_mode,
+            sorted(self.applied_filters),
+            [(str(key.expression), key.descending) for key in self.sort_keys],
+            cursor,
+            # The form echoes back whatever was typed into it
+            sorted(self.form.data.items()),
+        )
+        return sha1(repr(fingerprint)).hexdigest()
+
+    def _precounted_item_count(self):
+        """Returns the number of items this sieve will find, if it's simple
+        enough to have been counted ahead of time.  Otherwise, returns None.
+        """
+        if len(self.applied_filters) != 1:
+            return None
+
+        name, value = self.applied_filters[0]
+        if name not in PRECOUNTED_FILTERS:
+            return None
+
+        return model.ArtworkCount.get(
+            self.session, PRECOUNTED_FILTERS[name], value)
+
     def evaluate(self):
         """Executes the query.  Returns a pager object.
 
         A word on how the paging works:
         - If the sieve is created with countable=True, you'll get a regular
           numeric pager, regardless of anything else.
-        - If the sieve is created with countable=False, you'll get a numeric
-          pager that trails off at the end.
-        - If the sieve is created with countable=False AND is sorted by time
-          AND the user has gone back "too far", the "next" link will switch to
-          time-based paging instead.
+        - If the sieve is created with countable=False, you'll get a keyset
+          pager, which only knows about the previous and next pages but can
+          go back arbitrarily far without getting any slower.
         """
+        query = self.query.options(
+            *self.load_plans.get(self.display_mode, ()))
+
         common_kw = dict(
-            query=self.query,
+            query=query,
             page_size=PAGE_SIZE,
             formdata=self.original_formdata,
         )
 
         if self.countable:
-            return pager.DiscretePager(
+            result = pager.DiscretePager(
                 countable=True,
+                item_count=self._precounted_item_count(),
                 **common_kw
             )
         else:
-            # Only use temporal paging if we actually can, AND if the formdata
-            # has a timeskip key already
-            if self.temporal_column_name and \
-                'timeskip' in self.original_formdata:
-
-                return pager.TemporalPager(
-                    column_name='uploaded_time',
-                    **common_kw
-                )
-
-            return pager.DiscretePager(
-                countable=False,
+            result = pager.KeysetPager(
+                sort_keys=self.sort_keys,
                 **common_kw
             )
+
+        if self.suggestion_scores is not None:
+            self._unpack_suggestion_scores(result)
+        return result
+
+    def _unpack_suggestion_scores(self, result):
+        """Replaces the (artwork, score) rows in a pager with plain artwork,
+        remembering the scores for the sort key."""
+        rows = list(result.items)
+        if getattr(result, 'next_item', None) is not None:
+            rows.append(result.next_item)
+            result.next_item = result.next_item[0]
+
+        for artwork, score in rows:
+            self.suggestion_scores[artwork.id] = score
+        result.items = [artwork for artwork, score in result.items]
@@ -7,9 +7,6 @@ from __future__ import absolute_import
 import re
 import unicodedata
 
-import lxml.html
-import lxml.html.clean
-import markdown
 from webhelpers.html import escape, HTML, literal, tags, url_escape
 # XXX replace the below with tags.?
 from webhelpers.html.tags import form, end_form, hidden, submit, javascript_link
@@ -17,71 +14,28 @@ from webhelpers.util import update_params
 
 from pyramid.security import has_permission
 
+from floof.lib.richtext import render_many, render_rich_text
 
-def render_rich_text(raw_text, chrome=False):
-    """Takes a unicode string of Markdown source.  Returns literal'd HTML."""
-
-    # First translate the markdown
-    md = markdown.Markdown(
-        extensions=[],
-        output_format='html',
-    )
-
-    html = md.convert(raw_text)
-
-    # Then sanitize the HTML -- whitelisting only, thanks!
-    # Make this as conservative as possible to start.  Might loosen it up a bit
-    # later.
-    fragment = lxml.html.fragment_fromstring(html, create_parent='div')
-
-    if chrome:
-        # This is part of the site and is free to use whatever nonsense it wants
-        allow_tags = None
-    else:
-        # This is user content; beware!!
-        allow_tags = [
-            # Structure
-            'p', 'div', 'span', 'ul', 'ol', 'li',
-            # Tables
-            #'table', 'thead', 'tbody', 'tfoot', 'tr', 'th', 'td',
-            # Embedding
-            'a',
-            # Oldschool styling
-            'strong', 'b', 'em', 'i', 's', 'u',
-        ]
-
-    cleaner = lxml.html.clean.Cleaner(
-        scripts = True,
-        javascript = True,
-        comments = True,
-        style = True,
-        links = True,
-        meta = True,
-        page_structure = True,
-        #processing_instuctions = True,
-        embedded = True,
-        frames = True,
-        forms = True,
-        annoying_tags = True,
-        safe_attrs_only = True,
-
-        remove_unknown_tags = False,
-        allow_tags = allow_tags,
-    )
-    cleaner(fragment)
-
-    # Autolink URLs
-    lxml.html.clean.autolink(fragment)
-
-    # And, done.  Flatten the thing and return it
-    friendly_html = lxml.html.tostring(fragment)
-    # We, uh, need to remove the <div> wrapper that lxml imposes.
-    # I am so sorry.
-    match = re.match(r'\A<div>(.*)</div>\Z', friendly_html, flags=re.DOTALL)
-    if match:
-        friendly_html = match.group(1)
-
-    return literal(friendly_html)
+
+def render_comment(comment):
+    """Returns a comment's content as HTML.  Rendering is slow, so the result
+    is kept on the comment, and only redone when the comment is edited."""
+    if comment.content_html is None:
+        comment.content_html = unicode(render_rich_text(comment.content))
+    return literal(comment.content_html)
+
+
+def render_comments(comments):
+    """Makes sure every one of `comments` has its HTML ready for
+    :func:`render_comment`, rendering any that don't all at once."""
+    unrendered = [comment for comment in comments
+        if comment.content_html is None]
+    if not unrendered:
+        return
+
+    for comment, html in zip(unrendered,
+            render_many([comment.content for comment in unrendered])):
+        comment.content_html = unicode(html)
 
 
 def friendly_serial(serial):
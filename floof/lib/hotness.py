@@ -0,0 +1,123 @@
+"""Keeping artwork hot scores up to date.
+
+Each artwork's `hot_score` (see `floof.model.extensions.hot_score`) depends on
+its rating score and on how many ratings it's had within the last
+`HOT_WINDOW`, so it goes stale as art is rated and as those ratings age.
+Nothing else changes it, so only art rated recently ever needs refreshing:
+:func:`run_refresher` rescores just that, every so often.  The column is
+indexed, so sorting galleries by it is cheap no matter how far back they go.
+"""
+from datetime import timedelta
+import logging
+import time
+
+from sqlalchemy.sql import bindparam, func, select
+import transaction
+
+from floof import model
+from floof.model.extensions import HOT_WINDOW, hot_score
+
+log = logging.getLogger(__name__)
+
+
+def refresh_batch(connection, now, since=None, from_id=None,
+        batch_size=1000):
+    """Recalculates the hot scores of up to `batch_size` artworks with ids
+    from `from_id`, in order of id, as of `now`.  If `since` is given, only
+    art that's been rated within `HOT_WINDOW` of `since` is done; that's
+    everything whose score might have changed since then.
+
+    Returns the last id done, or None if there was nothing to do, and the
+    number of scores that changed.
+    """
+    artwork_table = model.Artwork.__table__
+    rating_table = model.ArtworkRating.__table__
+
+    recent = select([
+            rating_table.c.artwork_id,
+            func.sum((rating_table.c.rating + 1) / 2).label('interest'),
+        ]) \
+        .where(rating_table.c.timestamp >= now - HOT_WINDOW) \
+        .group_by(rating_table.c.artwork_id) \
+        .alias('recent')
+
+    query = select([
+            artwork_table.c.id,
+            artwork_table.c.rating_score,
+            artwork_table.c.uploaded_time,
+            artwork_table.c.hot_score,
+            recent.c.interest,
+        ],
+        from_obj=artwork_table.outerjoin(
+            recent, recent.c.artwork_id == artwork_table.c.id),
+        order_by=artwork_table.c.id,
+        limit=batch_size,
+    )
+    if from_id is not None:
+        query = query.where(artwork_table.c.id >= from_id)
+    if since is not None:
+        query = query.where(artwork_table.c.id.in_(
+            select([rating_table.c.artwork_id])
+                .where(rating_table.c.timestamp >= since - HOT_WINDOW)))
+
+    rows = connection.execute(query).fetchall()
+    if not rows:
+        return None, 0
+
+    changes = []
+    for row in rows:
+        score = hot_score(row.rating_score, row.interest, row.uploaded_time)
+        if abs(score - row.hot_score) > 1e-9:
+            changes.append(dict(_id=row.id, _score=score))
+
+    if changes:
+        connection.execute(
+            artwork_table.update()
+                .where(artwork_table.c.id == bindparam('_id'))
+                .values(hot_score=bindparam('_score')),
+            changes)
+
+    return rows[-1].id, len(changes)
+
+def refresh_hot_scores(since=None, batch_size=1000):
+    """Recalculates hot scores with :func:`refresh_batch`, for everything that
+    might have changed since `since`, or for all art if `since` is None.
+    Each batch is committed on its own.
+
+    Returns the number of scores that changed.
+    """
+    now = model.now()
+    changed = 0
+    from_id = None
+    while True:
+        transaction.begin()
+        last_id, batch_changed = refresh_batch(
+            model.session.connection(), now, since, from_id, batch_size)
+        if last_id is None:
+            transaction.abort()
+            break
+
+        transaction.commit()
+        changed += batch_changed
+        from_id = last_id + 1
+
+    return changed
+
+def run_refresher(interval=300, everything=False, once=False):
+    """Refreshes hot scores every `interval` seconds, forever, or just once if
+    `once` is true.  The first refresh covers the last `interval` seconds, or
+    all art if `everything` is true; after that, each one picks up where the
+    last left off.  The model must already be initialized.
+
+    Only one refresher should run at a time.
+    """
+    since = None if everything else model.now() - timedelta(seconds=interval)
+    while True:
+        started = model.now()
+        changed = refresh_hot_scores(since)
+        log.info("Refreshed hot scores; {0} changed".format(changed))
+        since = started
+
+        if once:
+            return
+        time.sleep(max(0, interval - (model.now() - started).seconds))
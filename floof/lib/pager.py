@@ -3,11 +3,14 @@ navigating between such.
 """
 from __future__ import division
 
+import base64
 from calendar import timegm
 from datetime import datetime
+import json
 import math
 
 import pytz
+from sqlalchemy.sql import and_, or_
 
 def _datetime_to_query(dt):
     """Converts a datetime to some arbitrary and unspecified format appropriate
@@ -44,7 +47,7 @@ def _datetime_from_query(ts):
         dt = datetime.fromtimestamp(int(seconds), pytz.utc)
         dt = dt.replace(microsecond=int(microseconds))
         return dt
-    except TypeError:
+    except (TypeError, ValueError):
         # Nothing reasonable to do, since this is supposed to be a value just
         # for us.  If someone has been dicking with it...  ignore it
         return None
@@ -57,7 +60,8 @@ class DiscretePager(object):
     pager_type = 'discrete'
     maximum_skip = 1000
 
-    def __init__(self, query, page_size, formdata={}, radius=3, countable=False):
+    def __init__(self, query, page_size, formdata={}, radius=3, countable=False,
+            item_count=None):
         """Create a pager.  The current page is taken from 'skip' in the given
         `formdata`.
 
@@ -74,9 +78,15 @@ class DiscretePager(object):
           will only show the following page number (if appropriate) and an
           ellipsis.  Additionally, no OFFSET greater than this object's
           `maximum_skip` will ever be allowed.
+
+        `item_count` may be given along with `countable`, if the number of
+        items in `query` is already known some cheaper way; it'll be used
+        instead of counting.
         """
         self.formdata = formdata.copy()
-        self.formdata.pop('timeskip', None)  # get rid of cruft, just in case
+        # get rid of cruft, just in case
+        self.formdata.pop('after', None)
+        self.formdata.pop('before', None)
 
         self.page_size = page_size
         self.radius = radius
@@ -91,7 +101,9 @@ class DiscretePager(object):
 
         self.countable = countable
         if self.countable:
-            self.item_count = query.count()
+            if item_count is None:
+                item_count = query.count()
+            self.item_count = item_count
             self.last_page = int(math.ceil(
                 self.item_count / self.page_size - 1))
 
@@ -172,16 +184,6 @@ class DiscretePager(object):
             formdata['skip'] = int(round(skip))
         return formdata
 
-    def formdata_for_temporal(self, column_name):
-        """Returns the provided `formdata`, with a 'timeskip' key for the first
-        item on the following page.  Used by `GallerySieve` for switching to
-        temporal paging after so many results.
-        """
-        formdata = self.formdata.copy()
-        formdata['timeskip'] = _datetime_to_query(
-            getattr(self.next_item, column_name))
-        return formdata
-
     @property
     def is_last_page(self):
         return self.next_item is None
@@ -204,64 +206,204 @@ class DiscretePager(object):
         return False
 
 
-class TemporalPager(object):
-    """A pager that skips by time, rather than number of items.  The advantage
-    is that a client can browse back arbitrarily far without the O(n) cost that
-    LIMIT clauses impose.  The downside is that it's not feasible to show a
-    list of pages any more, so it's difficult to express where the user is
-    within the items or even to provide a "back one page" link.
+def _cursor_from_values(values):
+    """Packs a row's sort key values into an opaque string, appropriate for
+    putting in a query and round-tripping.
+    """
+    parts = []
+    for value in values:
+        if isinstance(value, datetime):
+            parts.append({u't': _datetime_to_query(value)})
+        else:
+            parts.append(value)
+
+    # Padding is redundant and looks like junk in a URL
+    return base64.urlsafe_b64encode(json.dumps(parts)).rstrip('=')
+
+def _values_from_cursor(cursor, key_count):
+    """Converts the above format back to a list of `key_count` values.
+
+    Returns None if `cursor` is missing or junk.
+    """
+    if not cursor:
+        return None
+
+    try:
+        cursor = str(cursor)
+        parts = json.loads(
+            base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        return None
+
+    if not isinstance(parts, list) or len(parts) != key_count:
+        return None
+
+    values = []
+    for part in parts:
+        if isinstance(part, dict):
+            part = _datetime_from_query(part.get(u't'))
+        elif not isinstance(part, (basestring, int, long, float)):
+            # Sort keys are never NULL, so this is somebody's idea of a joke
+            part = None
+
+        if part is None:
+            return None
+        values.append(part)
+
+    return values
+
+
+class SortKey(object):
+    """One column of the ordering used by a `KeysetPager`.
+
+    `expression` is anything the query can be sorted by; `getter` is a
+    function that fetches the same value from a loaded row, and defaults to
+    looking up the attribute with the same name as `expression`.  Sort keys
+    must never be NULL -- use coalesce() if need be -- and a pager's keys must
+    identify a row uniquely, so the last one should generally be a primary key.
+    """
+
+    def __init__(self, expression, descending=True, getter=None):
+        self.expression = expression
+        self.descending = descending
+
+        if getter is None:
+            name = expression.key
+            getter = lambda row: getattr(row, name)
+        self.getter = getter
+
+    def order_clause(self, reverse=False):
+        """Returns an ORDER BY clause for this key.  If `reverse` is True, the
+        direction is flipped.
+        """
+        if self.descending != reverse:
+            return self.expression.desc()
+        else:
+            return self.expression.asc()
+
+    def seek_clause(self, value, reverse=False):
+        """Returns a clause that matches rows sorting strictly after a row with
+        the given `value`.
+        """
+        if self.descending != reverse:
+            return self.expression < value
+        else:
+            return self.expression > value
+
+
+class KeysetPager(object):
+    """A pager that seeks past the last item on the previous page, rather than
+    skipping some number of items.  The advantage is that the database can
+    jump straight to any page using an index on the sort columns, so browsing
+    arbitrarily far back costs the same as looking at the first page; also,
+    items don't shift between pages when new ones are added.  The downside is
+    that it's not feasible to show a list of pages, or jump to a particular
+    one, so it's difficult to express where the user is within the items.
 
     The API is similar to `DiscretePager` above, but not interchangeable.
 
-    This class uses the 'timeskip' query parameter rather than 'skip', to help
-    tell which type of pager is being used.
+    This class uses opaque 'after' and 'before' query parameters rather than
+    'skip', to help tell which type of pager is being used.
     """
 
-    pager_type = 'temporal'
+    pager_type = 'keyset'
     item_count = None
 
-    def __init__(self, query, page_size, column_name, formdata={}):
+    def __init__(self, query, page_size, sort_keys, formdata={}):
         """Create a pager.
 
-        `column_name` is the name of the datetime column in the query, to be
-        used for adding the offset and figuring out where the next page starts.
+        `sort_keys` is a sequence of `SortKey`s describing the full order of
+        the items.  Any ordering already applied to `query` is replaced.
 
         Other arguments are the same as for `DiscretePager`.
         """
         self.formdata = formdata.copy()
         self.formdata.pop('skip', None)  # get rid of cruft, just in case
 
-        # Find the column for the table in question
-        table = query.column_descriptions[0]['expr']
-        time_column = getattr(table, column_name)
+        self.page_size = page_size
+        self.sort_keys = sort_keys
+
+        after = _values_from_cursor(
+            self.formdata.pop('after', None), len(sort_keys))
+        before = _values_from_cursor(
+            self.formdata.pop('before', None), len(sort_keys))
+
+        if after is not None:
+            items, has_more = self._fetch(query, after, reverse=False)
+            self.is_first_page = False
+            self.is_last_page = not has_more
+        elif before is not None:
+            # Going backwards means walking the index the other way, then
+            # flipping the results around
+            items, has_more = self._fetch(query, before, reverse=True)
+            items.reverse()
+            self.is_first_page = not has_more
+            self.is_last_page = False
+        else:
+            has_more = False
 
-        self.timeskip = _datetime_from_query(
-            self.formdata.pop('timeskip', None))
-        if self.timeskip:
-            query = query.filter(time_column <= self.timeskip)
+        if not has_more and (after is None or not items):
+            # Either no cursor at all, or we've backed up past the first item
+            # (and may have a short page to show for it); start from the top
+            items, has_more = self._fetch(query, None, reverse=False)
+            self.is_first_page = True
+            self.is_last_page = not has_more
 
-        # Get one extra, for figuring out where the next page starts, and
-        # whether one exists
-        self.items = query.limit(page_size + 1).all()
-        self.visible_count = len(self.items)
-        self.next_item = None
-        self.next_item_timeskip = None
-        if len(self.items) > page_size:
-            self.next_item = self.items.pop()
-            self.next_item_timeskip = getattr(self.next_item, column_name)
+        self.items = items
+        self.visible_count = len(items)
 
-        self.page_size = page_size
+    def _fetch(self, query, values, reverse):
+        """Returns one page of items sorting after the given key `values`, and
+        whether there are more beyond it.
+        """
+        query = query.order_by(None).order_by(
+            *[key.order_clause(reverse) for key in self.sort_keys])
+
+        if values is not None:
+            query = query.filter(self._seek_clause(values, reverse))
+
+        # Get one extra, for figuring out whether another page exists
+        items = query.limit(self.page_size + 1).all()
+        has_more = len(items) > self.page_size
+        del items[self.page_size:]
+        return items, has_more
+
+    def _seek_clause(self, values, reverse):
+        # This is the row-value comparison (a, b, c) < (x, y, z), which not
+        # every database supports, expanded into:
+        # a < x OR (a = x AND b < y) OR (a = x AND b = y AND c < z)
+        clauses = []
+        for i, key in enumerate(self.sort_keys):
+            terms = [prior_key.expression == value for prior_key, value
+                in zip(self.sort_keys[:i], values[:i])]
+            terms.append(key.seek_clause(values[i], reverse))
+            clauses.append(and_(*terms))
+
+        return or_(*clauses)
+
+    def _cursor_for(self, item):
+        return _cursor_from_values(
+            [key.getter(item) for key in self.sort_keys])
 
     def __iter__(self):
         return iter(self.items)
 
-    def formdata_for(self, timeskip):
+    def formdata_for_first(self):
+        """Returns the provided `formdata`, pointed at the first page."""
+        return self.formdata.copy()
+
+    def formdata_for_previous(self):
+        """Returns the provided `formdata`, with a 'before' key for the first
+        item on this page.
+        """
         formdata = self.formdata.copy()
-        # timeskip=None doesn't get put in the query
-        if timeskip:
-            formdata['timeskip'] = _datetime_to_query(timeskip)
+        formdata['before'] = self._cursor_for(self.items[0])
         return formdata
 
-    @property
-    def is_last_page(self):
-        return self.next_item is None
+    def formdata_for_next(self):
+        """Returns the provided `formdata`, with an 'after' key for the last
+        item on this page.
+        """
+        formdata = self.formdata.copy()
+        formdata['after'] = self._cursor_for(self.items[-1])
+        return formdata
@@ -0,0 +1,118 @@
+"""Recalculating artwork rating stats in bulk.
+
+Each artwork's `rating_count`, `rating_sum` and `rating_score` are normally
+kept up to date as ratings change; see `floof.model._flush_artwork_ratings`.
+:func:`recalculate_ratings` starts over from the ratings themselves, e.g.
+after importing ratings from elsewhere or changing how scores work.
+"""
+import logging
+
+from sqlalchemy.sql import bindparam, func, select
+import transaction
+
+from floof import model
+from floof.model.extensions import wilson_scores
+
+log = logging.getLogger(__name__)
+
+
+def _close(a, b):
+    """Compares stats, allowing for floating-point error, since they're
+    accumulated one rating at a time."""
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) < 1e-9
+
+def recalculate_batch(connection, from_id=None, to_id=None, batch_size=1000):
+    """Recalculates the rating stats of up to `batch_size` artworks with ids
+    from `from_id` to `to_id`, in order of id.
+
+    The ratings are counted and summed by the database, the scores are
+    calculated all at once (with NumPy, if it's installed), and the changed
+    stats are written back with one statement.  The artwork is locked
+    meanwhile, so ratings made during the recalculation aren't lost.
+
+    Returns the last id done, or None if there was nothing to do, and the
+    number of artworks whose stats were wrong.
+    """
+    artwork_table = model.Artwork.__table__
+    rating_table = model.ArtworkRating.__table__
+
+    query = select([
+            artwork_table.c.id,
+            artwork_table.c.rating_count,
+            artwork_table.c.rating_sum,
+            artwork_table.c.rating_score,
+        ],
+        order_by=artwork_table.c.id,
+        limit=batch_size,
+        for_update=True,
+    )
+    if from_id is not None:
+        query = query.where(artwork_table.c.id >= from_id)
+    if to_id is not None:
+        query = query.where(artwork_table.c.id <= to_id)
+
+    current = connection.execute(query).fetchall()
+    if not current:
+        return None, 0
+
+    first_id, last_id = current[0].id, current[-1].id
+    totals = dict(
+        (artwork_id, (count, total))
+        for artwork_id, count, total in connection.execute(
+            select([
+                rating_table.c.artwork_id,
+                func.count(),
+                func.sum(rating_table.c.rating),
+            ])
+            .where(rating_table.c.artwork_id.between(first_id, last_id))
+            .group_by(rating_table.c.artwork_id)))
+
+    counts = [totals.get(row.id, (0, 0))[0] for row in current]
+    sums = [totals.get(row.id, (0, 0))[1] for row in current]
+    scores = wilson_scores(counts, sums)
+
+    changes = [
+        dict(_id=row.id, _count=count, _sum=sum_, _score=score)
+        for row, count, sum_, score in zip(current, counts, sums, scores)
+        if row.rating_count != count
+            or not _close(row.rating_sum, sum_)
+            or not _close(row.rating_score, score)]
+    if changes:
+        table = artwork_table
+        connection.execute(
+            table.update()
+                .where(table.c.id == bindparam('_id'))
+                .values(
+                    rating_count=bindparam('_count'),
+                    rating_sum=bindparam('_sum'),
+                    rating_score=bindparam('_score'),
+                ),
+            changes)
+
+    return last_id, len(changes)
+
+def recalculate_ratings(from_id=None, to_id=None, batch_size=1000):
+    """Recalculates the rating stats of every artwork, or those with ids from
+    `from_id` to `to_id`, with :func:`recalculate_batch`.  Each batch is
+    committed on its own.
+
+    Returns the number of artworks whose stats were wrong.
+    """
+    fixed = 0
+    while True:
+        transaction.begin()
+        last_id, changed = recalculate_batch(
+            model.session.connection(), from_id, to_id, batch_size)
+        if last_id is None:
+            transaction.abort()
+            break
+
+        transaction.commit()
+        fixed += changed
+        from_id = last_id + 1
+        log.info("Recalculated ratings up to artwork {0}; {1} changed"
+                 .format(last_id, changed))
+
+    return fixed
@@ -0,0 +1,159 @@
+"""Rendering user-supplied Markdown into safe HTML.
+
+Rendering is slow for what it is, so the expensive parts are done once:
+`markdown.Markdown` instances are kept in a pool and reset between uses, since
+they can't be shared between threads; and the lxml cleaners, which can be,
+are built when this module is imported.  On top of that, finished HTML is
+kept in a cache keyed by the text itself, so the same remark shown on every
+view of a piece of art is only ever rendered once per process.
+
+Templates that render a list of things should use :func:`render_many`, which
+looks everything up in the cache and renders whatever's missing in one go.
+"""
+from __future__ import absolute_import
+from contextlib import contextmanager
+import threading
+
+import lxml.html
+import lxml.html.clean
+import markdown
+from webhelpers.html import literal
+
+from floof.lib.cache import MemoryCache
+
+# Rendered text never goes stale, so the cache only needs to be bounded by
+# size; the timeout is just long
+RENDER_CACHE_SIZE = 10000
+RENDER_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class _MarkdownPool(object):
+    """Hands out `markdown.Markdown` instances, one thread at a time."""
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def markdown(self):
+        with self._lock:
+            md = self._idle.pop() if self._idle else None
+        if md is None:
+            md = markdown.Markdown(
+                extensions=[],
+                output_format='html',
+            )
+
+        try:
+            yield md
+        finally:
+            md.reset()
+            with self._lock:
+                self._idle.append(md)
+
+def _make_cleaner(allow_tags):
+    # Make this as conservative as possible to start.  Might loosen it up a
+    # bit later.
+    return lxml.html.clean.Cleaner(
+        scripts = True,
+        javascript = True,
+        comments = True,
+        style = True,
+        links = True,
+        meta = True,
+        page_structure = True,
+        #processing_instuctions = True,
+        embedded = True,
+        frames = True,
+        forms = True,
+        annoying_tags = True,
+        safe_attrs_only = True,
+
+        remove_unknown_tags = False,
+        allow_tags = allow_tags,
+    )
+
+_markdown_pool = _MarkdownPool()
+_cleaners = {
+    # This is part of the site and is free to use whatever nonsense it wants
+    True: _make_cleaner(None),
+    # This is user content; beware!!
+    False: _make_cleaner([
+        # Structure
+        'p', 'div', 'span', 'ul', 'ol', 'li',
+        # Tables
+        #'table', 'thead', 'tbody', 'tfoot', 'tr', 'th', 'td',
+        # Embedding
+        'a',
+        # Oldschool styling
+        'strong', 'b', 'em', 'i', 's', 'u',
+    ]),
+}
+_cache = MemoryCache(
+    max_items=RENDER_CACHE_SIZE, timeout=RENDER_CACHE_TIMEOUT)
+
+
+def _render(md, raw_text, chrome):
+    """Renders one text with the given Markdown instance.  Returns unicode."""
+    # First translate the markdown
+    html = md.convert(raw_text)
+    md.reset()
+
+    # Then sanitize the HTML -- whitelisting only, thanks!
+    fragment = lxml.html.fragment_fromstring(html, create_parent='div')
+    _cleaners[chrome](fragment)
+
+    # Autolink URLs
+    lxml.html.clean.autolink(fragment)
+
+    # And, done.  Flatten the thing, minus the bare <div> wrapper that lxml
+    # imposed above.  (Anything outside ASCII comes out as an entity.)
+    return lxml.html.tostring(fragment).decode('ascii')[5:-6]
+
+def _cache_key(raw_text, chrome):
+    return (u'chrome:' if chrome else u'user:') + raw_text
+
+def render_rich_text(raw_text, chrome=False):
+    """Takes a unicode string of Markdown source.  Returns literal'd HTML.
+
+    `chrome` is for text that's part of the site, rather than from users, and
+    allows any HTML at all.
+    """
+    if not raw_text:
+        return literal(u'')
+
+    key = _cache_key(raw_text, chrome)
+    html = _cache.get(key)
+    if html is None:
+        with _markdown_pool.markdown() as md:
+            html = _render(md, raw_text, chrome)
+        _cache.set(key, html)
+
+    return literal(html)
+
+def render_many(raw_texts, chrome=False):
+    """Renders a list of texts, as with :func:`render_rich_text`.  Returns a
+    list of literal'd HTML, in the same order.
+
+    Repeated texts are only looked up once, and everything that isn't cached
+    is rendered with the same Markdown instance.
+    """
+    rendered = {u'': u''}
+    missing = []
+    for raw_text in raw_texts:
+        raw_text = raw_text or u''
+        if raw_text in rendered:
+            continue
+
+        html = _cache.get(_cache_key(raw_text, chrome))
+        rendered[raw_text] = html
+        if html is None:
+            missing.append(raw_text)
+
+    if missing:
+        with _markdown_pool.markdown() as md:
+            for raw_text in missing:
+                html = _render(md, raw_text, chrome)
+                rendered[raw_text] = html
+                _cache.set(_cache_key(raw_text, chrome), html)
+
+    return [literal(rendered[raw_text or u'']) for raw_text in raw_texts]
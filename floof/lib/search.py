@@ -0,0 +1,109 @@
+"""Full-text search, over the index in `floof.model.SearchTerm`.
+
+Text is split into terms the same way it was when indexed, and only
+resources containing every term match.  Matches are ranked by tf-idf: each
+term's weight in the resource, scaled up the rarer the term is overall.
+"""
+from __future__ import division
+
+import logging
+import math
+
+from sqlalchemy.sql import case, func, select
+import transaction
+
+from floof import model
+
+log = logging.getLogger(__name__)
+
+# More terms than this in one search are ignored
+MAX_TERMS = 10
+
+
+def query_terms(text):
+    """Returns the distinct terms to search for in `text`, in order."""
+    terms = []
+    for term in model.search_terms(text):
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+def matching_resources(session, terms):
+    """Returns a query for the ids of resources containing all of `terms`,
+    for use as a subquery."""
+    return session.query(model.SearchTerm.resource_id) \
+        .filter(model.SearchTerm.term.in_(terms)) \
+        .group_by(model.SearchTerm.resource_id) \
+        .having(func.count(model.SearchTerm.term.distinct()) == len(terms))
+
+def search(session, text, resource_type=None, limit=20, offset=0):
+    """Searches for `text`, optionally only among resources of one type
+    (u'artwork' or u'users').  Returns a list of (resource id, rank), best
+    first.
+    """
+    terms = query_terms(text)
+    if not terms:
+        return []
+
+    # How many resources each term appears in, to weight rare terms higher.
+    # (A term can be entered more than once per resource; see SearchTerm)
+    document_counts = dict(
+        session.query(model.SearchTerm.term,
+                func.count(model.SearchTerm.resource_id.distinct()))
+            .filter(model.SearchTerm.term.in_(terms))
+            .group_by(model.SearchTerm.term))
+    if len(document_counts) < len(terms):
+        # Some term isn't anywhere
+        return []
+
+    total = session.query(func.count(model.Resource.id)).scalar()
+    idf = case(
+        [(model.SearchTerm.term == term, math.log((total + 1) / count))
+            for term, count in document_counts.iteritems()],
+        else_=0)
+    rank = func.sum(model.SearchTerm.weight * idf).label('rank')
+
+    query = session.query(model.SearchTerm.resource_id, rank) \
+        .filter(model.SearchTerm.term.in_(terms)) \
+        .group_by(model.SearchTerm.resource_id) \
+        .having(func.count(model.SearchTerm.term.distinct()) == len(terms)) \
+        .order_by(rank.desc(), model.SearchTerm.resource_id)
+    if resource_type is not None:
+        query = query \
+            .join((model.Resource,
+                model.Resource.id == model.SearchTerm.resource_id)) \
+            .filter(model.Resource.type == resource_type)
+
+    return query.limit(limit).offset(offset).all()
+
+def reindex_all(batch_size=1000):
+    """Rebuilds the index of every resource from scratch, committing each
+    batch of `batch_size` resources on its own.  Only needed when the index
+    is new or the way it's built changes; otherwise it's kept up to date as
+    things are written.
+
+    Returns the number of resources reindexed.
+    """
+    resources = model.Resource.__table__
+    from_id = None
+    done = 0
+    while True:
+        transaction.begin()
+        connection = model.session.connection()
+        query = select([resources.c.id],
+            order_by=resources.c.id, limit=batch_size)
+        if from_id is not None:
+            query = query.where(resources.c.id >= from_id)
+        resource_ids = [row.id for row in connection.execute(query)]
+        if not resource_ids:
+            transaction.abort()
+            break
+
+        model.reindex_search_terms(connection, resource_ids)
+        transaction.commit()
+
+        done += len(resource_ids)
+        from_id = resource_ids[-1] + 1
+        log.info("Reindexed resources up to {0}".format(resource_ids[-1]))
+
+    return done
@@ -0,0 +1,168 @@
+"""Building the "art like this" index.
+
+Two pieces of art are alike if the same people rated them the same way, and
+if they have the same tags.  Each artwork is described by a sparse vector with
+an entry per user who rated it and per tag it has; the similarity of two
+artworks is the cosine of the angle between their rating vectors, plus that
+between their tag vectors, weighted.  Both parts are folded into a single
+matrix, so every artwork's similarity to everything else comes out of one
+sparse matrix product, done for a batch of artwork at a time.
+
+Only the `top_k` most similar neighbors of each artwork are kept, in
+`ArtworkSimilarity`.  Showing them, or suggesting art to someone based on
+what they've liked, only ever reads that table.
+
+This needs NumPy and SciPy, but only here; the web app doesn't.
+"""
+import logging
+
+import numpy
+from scipy import sparse
+from sqlalchemy.sql import select
+import transaction
+
+from floof import model
+
+log = logging.getLogger(__name__)
+
+
+def _normalized_rows(matrix):
+    """Scales every nonzero row of a sparse matrix to unit length."""
+    lengths = numpy.sqrt(numpy.asarray(
+        matrix.multiply(matrix).sum(axis=1)).ravel())
+    scale = numpy.zeros_like(lengths)
+    nonzero = lengths > 0
+    scale[nonzero] = 1 / lengths[nonzero]
+    return sparse.diags(scale, 0) * matrix
+
+def _sparse_rows(artwork_ids, row_ids, column_ids, values=None):
+    """Returns a CSR matrix with a row per artwork in `artwork_ids` (which
+    must be sorted) and a column per distinct value in `column_ids`."""
+    row_ids = numpy.asarray(row_ids, dtype=numpy.int64)
+    columns, column_index = numpy.unique(
+        numpy.asarray(column_ids, dtype=numpy.int64), return_inverse=True)
+    if values is None:
+        values = numpy.ones(len(row_ids))
+
+    return sparse.csr_matrix(
+        (numpy.asarray(values, dtype=numpy.float64),
+         (numpy.searchsorted(artwork_ids, row_ids), column_index)),
+        shape=(len(artwork_ids), len(columns)))
+
+def load_features(connection, rating_weight=1.0, tag_weight=1.0):
+    """Reads every rating and tag, and returns a sorted array of artwork ids
+    and a sparse matrix with a row for each of them.  The dot product of two
+    rows is the similarity of the two artworks.
+    """
+    artwork_table = model.Artwork.__table__
+    rating_table = model.ArtworkRating.__table__
+    tag_table = model.artwork_tags
+
+    artwork_ids = numpy.array(
+        [row.id for row in connection.execute(
+            select([artwork_table.c.id]).order_by(artwork_table.c.id))],
+        dtype=numpy.int64)
+
+    ratings = connection.execute(select([
+        rating_table.c.artwork_id,
+        rating_table.c.user_id,
+        rating_table.c.rating,
+    ])).fetchall()
+    tags = connection.execute(select([
+        tag_table.c.artwork_id,
+        tag_table.c.tag_id,
+    ])).fetchall()
+
+    rating_matrix = _sparse_rows(
+        artwork_ids,
+        [row.artwork_id for row in ratings],
+        [row.user_id for row in ratings],
+        [row.rating for row in ratings])
+    tag_matrix = _sparse_rows(
+        artwork_ids,
+        [row.artwork_id for row in tags],
+        [row.tag_id for row in tags])
+
+    # Scaling each half by the square root of its weight makes the dot
+    # product the weighted sum of the two cosines
+    features = sparse.hstack([
+        numpy.sqrt(rating_weight) * _normalized_rows(rating_matrix),
+        numpy.sqrt(tag_weight) * _normalized_rows(tag_matrix),
+    ]).tocsr()
+
+    return artwork_ids, features
+
+def top_neighbors(features, start, stop, top_k=20, min_similarity=0.01):
+    """Finds the `top_k` most similar rows to each of the rows from `start`
+    to `stop`.  Returns a list with, for each of those rows, a list of (row,
+    similarity), most similar first.
+    """
+    products = (features[start:stop] * features.T).tocsr()
+
+    neighbors = []
+    for offset in xrange(stop - start):
+        row = start + offset
+        begin, end = products.indptr[offset], products.indptr[offset + 1]
+        columns = products.indices[begin:end]
+        values = products.data[begin:end]
+
+        keep = (columns != row) & (values >= min_similarity)
+        columns, values = columns[keep], values[keep]
+        if len(values) > top_k:
+            best = numpy.argpartition(-values, top_k - 1)[:top_k]
+            columns, values = columns[best], values[best]
+
+        order = numpy.argsort(-values, kind='mergesort')
+        neighbors.append(zip(columns[order].tolist(), values[order].tolist()))
+
+    return neighbors
+
+def store_neighbors(connection, artwork_ids, start, neighbors):
+    """Replaces the stored neighbors of the artworks from `start` onwards with
+    the results of :func:`top_neighbors`."""
+    table = model.ArtworkSimilarity.__table__
+    batch_ids = artwork_ids[start:start + len(neighbors)].tolist()
+    connection.execute(table.delete()
+        .where(table.c.artwork_id.in_(batch_ids)))
+
+    rows = [
+        dict(
+            artwork_id=artwork_id,
+            similar_artwork_id=int(artwork_ids[column]),
+            similarity=similarity,
+        )
+        for artwork_id, row_neighbors in zip(batch_ids, neighbors)
+        for column, similarity in row_neighbors]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+    return len(rows)
+
+def build_similarities(top_k=20, batch_size=500, rating_weight=1.0,
+        tag_weight=1.0, min_similarity=0.01):
+    """Rebuilds the whole similarity index.  Each batch of `batch_size`
+    artworks is committed on its own, so the old neighbors are replaced
+    gradually, and anything uploaded meanwhile waits for the next rebuild.
+
+    Returns the number of neighbors stored.
+    """
+    transaction.begin()
+    artwork_ids, features = load_features(
+        model.session.connection(), rating_weight, tag_weight)
+    transaction.abort()
+
+    stored = 0
+    for start in xrange(0, len(artwork_ids), batch_size):
+        stop = min(start + batch_size, len(artwork_ids))
+        neighbors = top_neighbors(
+            features, start, stop, top_k, min_similarity)
+
+        transaction.begin()
+        stored += store_neighbors(
+            model.session.connection(), artwork_ids, start, neighbors)
+        transaction.commit()
+
+        log.info("Stored neighbors of artwork {0} to {1}"
+                 .format(artwork_ids[start], artwork_ids[stop - 1]))
+
+    return stored
@@ -0,0 +1,294 @@
+"""Parsing and compiling tag queries, as typed into the gallery form.
+
+The syntax:
+
+`a b`
+    Art tagged both `a` and `b`.
+`a | b`
+    Art tagged either.  Binds more loosely than the above, so `a b | c` is
+    `(a b) | c`.
+`-a`
+    Art not tagged `a`.
+`(a | b) c`
+    Grouping.
+`by:name`
+    Art by the artist called `name`.
+
+:func:`parse` turns a query into a tree of nodes; :func:`resolve` looks up
+every tag and user it mentions at once; and :func:`compile_query` turns it
+into a single SQL condition on `Artwork.id`.  Tags that are combined the same
+way are checked together, with one pass over `artwork_tags` -- e.g. `a b c`
+becomes one `GROUP BY ... HAVING COUNT(*) = 3` -- rather than with a
+subquery each.
+"""
+from collections import namedtuple
+import re
+
+from sqlalchemy.sql import and_, func, literal, not_, or_, select, union_all
+from sqlalchemy.sql.expression import false
+
+from floof import model
+
+
+class TagQueryError(ValueError):
+    """Raised for a query that can't be parsed, with a message fit for the
+    person who typed it."""
+    pass
+
+
+### The tree
+
+class Tag(namedtuple('Tag', ['name'])):
+    def __unicode__(self):
+        return self.name
+
+class Artist(namedtuple('Artist', ['name'])):
+    def __unicode__(self):
+        return u'by:' + self.name
+
+class Not(namedtuple('Not', ['child'])):
+    def __unicode__(self):
+        return u'-' + _unicode_operand(self.child)
+
+class And(namedtuple('And', ['children'])):
+    def __unicode__(self):
+        return u' '.join(_unicode_operand(child) for child in self.children)
+
+class Or(namedtuple('Or', ['children'])):
+    def __unicode__(self):
+        return u' | '.join(
+            u'({0})'.format(unicode(child)) if isinstance(child, Or)
+                else unicode(child)
+            for child in self.children)
+
+def _unicode_operand(node):
+    if isinstance(node, (And, Or)):
+        return u'({0})'.format(unicode(node))
+    return unicode(node)
+
+# Prefixes of special terms, and the nodes they make
+SPECIAL_TERMS = {
+    u'by': Artist,
+}
+
+
+### Parsing
+
+_token_re = re.compile(r'\s*(?:([()|-])|([^\s()|]+))', re.UNICODE)
+
+def tokenize(query):
+    """Splits a query into a list of tokens: the operators `(`, `)`, `|` and
+    `-`, and terms.  A `-` only counts as an operator at the start of a term.
+    """
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _token_re.match(query, position)
+        operator, term = match.groups()
+        tokens.append(operator or term)
+        position = match.end()
+    return tokens
+
+class _Parser(object):
+    """Recursive descent parser for the grammar:
+
+        query   := or
+        or      := and ('|' and)*
+        and     := unary unary*
+        unary   := '-' unary | '(' or ')' | term
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise TagQueryError(u"Unexpected '{0}'".format(self.peek()))
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == u'|':
+            self.take()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def parse_and(self):
+        children = [self.parse_unary()]
+        while self.peek() not in (None, u'|', u')'):
+            children.append(self.parse_unary())
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def parse_unary(self):
+        token = self.take()
+        if token is None:
+            raise TagQueryError(u"Unexpected end of query")
+        elif token == u'-':
+            return Not(self.parse_unary())
+        elif token == u'(':
+            node = self.parse_or()
+            if self.take() != u')':
+                raise TagQueryError(u"Missing ')'")
+            return node
+        elif token in (u')', u'|'):
+            raise TagQueryError(u"Unexpected '{0}'".format(token))
+
+        prefix, colon, name = token.partition(u':')
+        if not colon:
+            return Tag(token)
+        if prefix not in SPECIAL_TERMS or not name:
+            raise TagQueryError(u"Don't know what '{0}' means".format(token))
+        return SPECIAL_TERMS[prefix](name)
+
+def parse(query):
+    """Parses a query into a tree of `Tag`, `Artist`, `Not`, `And` and `Or`
+    nodes.  Returns None for an empty query."""
+    tokens = tokenize(query)
+    if not tokens:
+        return None
+    return _Parser(tokens).parse()
+
+
+### Looking things up
+
+def _leaves(node):
+    if isinstance(node, (Tag, Artist)):
+        yield node
+    elif isinstance(node, Not):
+        for leaf in _leaves(node.child):
+            yield leaf
+    else:
+        for child in node.children:
+            for leaf in _leaves(child):
+                yield leaf
+
+def resolve(session, node):
+    """Looks up every tag and artist in the query, in a single query.  Returns
+    a dict of leaf node to id; anything that doesn't exist is left out.
+    """
+    tag_names = set(leaf.name for leaf in _leaves(node)
+        if isinstance(leaf, Tag))
+    user_names = set(leaf.name for leaf in _leaves(node)
+        if isinstance(leaf, Artist))
+
+    selects = []
+    if tag_names:
+        selects.append(select([
+                literal(u'tag').label('kind'),
+                model.Tag.id,
+                model.Tag.name,
+            ])
+            .where(model.Tag.name.in_(tag_names)))
+    if user_names:
+        selects.append(select([
+                literal(u'user').label('kind'),
+                model.User.id,
+                model.User.name,
+            ])
+            .where(model.User.name.in_(user_names)))
+    if not selects:
+        return {}
+
+    kinds = dict(tag=Tag, user=Artist)
+    statement = selects[0] if len(selects) == 1 else union_all(*selects)
+    return dict(
+        (kinds[kind](name), id)
+        for kind, id, name in session.execute(statement))
+
+
+### Compiling
+
+def _artwork_with_all(column, artwork_column, ids):
+    """Artwork ids with every one of `ids` in `column`."""
+    ids = set(ids)
+    query = select([artwork_column]).where(column.in_(ids))
+    if len(ids) > 1:
+        query = query.group_by(artwork_column) \
+            .having(func.count() == len(ids))
+    return query
+
+def _artwork_with_any(column, artwork_column, ids):
+    """Artwork ids with at least one of `ids` in `column`."""
+    return select([artwork_column]).where(column.in_(set(ids)))
+
+# Where each kind of leaf lives: (table's id column, table's artwork column)
+def _leaf_columns(leaf_type):
+    if leaf_type is Tag:
+        return model.artwork_tags.c.tag_id, model.artwork_tags.c.artwork_id
+    else:
+        table = model.UserArtwork.__table__
+        return table.c.user_id, table.c.artwork_id
+
+def compile_query(node, ids):
+    """Compiles a query, given the ids from :func:`resolve`, into a condition
+    on `Artwork.id`.
+
+    Leaves that don't exist match nothing, so `a nosuchtag` finds nothing and
+    `a -nosuchtag` is the same as `a`.
+    """
+    if isinstance(node, (Tag, Artist)):
+        return _compile_group(type(node), [node], ids, all_of=True)
+    elif isinstance(node, Not):
+        return not_(compile_query(node.child, ids))
+
+    all_of = isinstance(node, And)
+    combine = and_ if all_of else or_
+
+    # Gather up plain leaves, and negated ones within an And, of each kind
+    groups = {}
+    clauses = []
+    for child in node.children:
+        negated = False
+        leaf = child
+        if all_of and isinstance(child, Not) \
+                and isinstance(child.child, (Tag, Artist)):
+            negated = True
+            leaf = child.child
+
+        if isinstance(leaf, (Tag, Artist)):
+            groups.setdefault((type(leaf), negated), []).append(leaf)
+        else:
+            clauses.append(compile_query(child, ids))
+
+    for (leaf_type, negated), leaves in sorted(groups.items(),
+            key=lambda ((leaf_type, negated), leaves):
+                (leaf_type.__name__, negated)):
+        if negated:
+            # -a -b is the same as -(a | b)
+            clauses.append(
+                not_(_compile_group(leaf_type, leaves, ids, all_of=False)))
+        else:
+            clauses.append(_compile_group(leaf_type, leaves, ids, all_of))
+
+    return combine(*clauses)
+
+def _compile_group(leaf_type, leaves, ids, all_of):
+    """One condition for several leaves of the same kind, all of which (or
+    any of which) must match."""
+    found = [ids[leaf] for leaf in leaves if leaf in ids]
+    if not found or (all_of and len(found) < len(set(leaves))):
+        return false()
+
+    id_column, artwork_column = _leaf_columns(leaf_type)
+    if all_of:
+        subquery = _artwork_with_all(id_column, artwork_column, found)
+    else:
+        subquery = _artwork_with_any(id_column, artwork_column, found)
+    return model.Artwork.id.in_(subquery)
+
+def missing_names(node, ids):
+    """Returns a sorted list of the terms in the query that don't exist."""
+    return sorted(set(unicode(leaf) for leaf in _leaves(node)
+        if leaf not in ids))
@@ -0,0 +1,76 @@
+"""Handling for freshly-uploaded files.
+
+Uploads can be big, so they're only ever read once, a chunk at a time: the
+MIME type is sniffed from the first chunk, and every chunk is hashed and
+copied to a temporary file on disk as it goes by.  The temporary file can then
+be handed straight to :meth:`floof.model.filestore.FileStorage.put_path`.
+"""
+from __future__ import absolute_import
+import hashlib
+import os
+import tempfile
+
+import magic
+
+CHUNK_SIZE = 524288  # .5 MiB
+SNIFF_SIZE = 1024
+
+
+class SpooledFile(object):
+    """A copy of an uploaded file, sitting in a temporary file at `path`.
+
+    Also has the `mimetype`, SHA-256 `hash` (as hex) and `file_size` of the
+    file, all of which were worked out while copying it.
+    """
+    def __init__(self, path, mimetype, hash, file_size):
+        self.path = path
+        self.mimetype = mimetype
+        self.hash = hash
+        self.file_size = file_size
+
+    def discard(self):
+        """Deletes the temporary file.  Only call this if the file won't be
+        stored after all; once it's been given to a storage, it's not yours
+        any more.
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def spool(fileobj, directory=None):
+    """Copies everything in `fileobj` to a new temporary file in `directory`,
+    or the system's temporary directory if that's omitted.  Returns a
+    :class:`SpooledFile`.
+
+    Spool into the temporary directory of the storage that will eventually
+    receive the file, and it won't need to be copied again.
+    """
+    sniffer = magic.Magic(mime=True)
+    hasher = hashlib.sha256()
+    file_size = 0
+    mimetype = None
+
+    fd, path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as spoolfile:
+            while True:
+                buffer = fileobj.read(CHUNK_SIZE)
+                if mimetype is None:
+                    mimetype = sniffer.from_buffer(buffer[:SNIFF_SIZE]) \
+                        .decode('ascii')
+                if not buffer:
+                    break
+
+                file_size += len(buffer)
+                hasher.update(buffer)
+                spoolfile.write(buffer)
+    except:
+        os.remove(path)
+        raise
+
+    return SpooledFile(
+        path=path,
+        mimetype=mimetype,
+        hash=hasher.hexdigest().decode('ascii'),
+        file_size=file_size,
+    )
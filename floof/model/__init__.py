@@ -1,21 +1,27 @@
 """The application's model objects"""
 import datetime
 import hashlib
+import itertools
+import math
 import OpenSSL.crypto as ssl
 import pytz
 import random
 import re
 import string
 
-from sqlalchemy import Column, ForeignKey, Table
+from sqlalchemy import Column, ForeignKey, Table, event
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, class_mapper, relation, validates
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm.properties import ColumnProperty
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE, get_history
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.session import object_session
-from sqlalchemy.schema import CheckConstraint
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.schema import CheckConstraint, Index, UniqueConstraint
+from sqlalchemy.sql import func, select
+from sqlalchemy.sql.expression import false
 from sqlalchemy.types import *
 from floof.model.extensions import *
 from floof.model.types import *
@@ -30,9 +36,17 @@ def initialize(engine, extension=None):
     # XXX: Is init_model actually used by anything?  Could these be combined?
     session.configure(bind=engine, extension=extension)
     TableBase.metadata.bind = engine
+
+    if engine.dialect.name == 'sqlite':
+        # Rating scores are calculated in SQL; see _adjust_artwork_rating
+        event.listen(engine, 'connect', _sqlite_connect)
     #TableBase.metadata.create_all()
 
 
+def _sqlite_connect(dbapi_connection, connection_record):
+    dbapi_connection.create_function('sqrt', 1, math.sqrt)
+
+
 def now():
     return datetime.datetime.now(pytz.utc)
 
@@ -119,7 +133,7 @@ class AnonymousUser(object):
 class User(TableBase):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, nullable=False)
-    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=False)
+    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=False, index=True)
     name = Column(Unicode(24), nullable=False, index=True, unique=True)
     email = Column(Unicode(255))
     display_name = Column(Unicode(24), nullable=True)
@@ -191,11 +205,17 @@ class UserWatch(TableBase):
 
 ### ART
 
+def _initial_hot_score(context):
+    """New art hasn't been rated yet, so its hot score depends only on when it
+    was uploaded.  See `floof.lib.hotness`."""
+    uploaded_time = context.current_parameters.get('uploaded_time') or now()
+    return hot_score(None, 0, uploaded_time)
+
 # TODO exif and png metadata -- do other formats have similar?  audio, video..  text?
 class Artwork(TableBase):
     __tablename__ = 'artwork'
     id = Column(Integer, primary_key=True, nullable=False)
-    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=False)
+    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=False, index=True)
     media_type = Column(Enum(u'image', u'text', u'audio', u'video', name='artwork_media_type'), nullable=False)
     title = Column(Unicode(133), nullable=False)
     hash = Column(Unicode(256), nullable=False, unique=True, index=True)
@@ -208,6 +228,8 @@ class Artwork(TableBase):
     rating_count = Column(Integer, nullable=False, default=0)
     rating_sum = Column(Float, nullable=False, default=0)
     rating_score = Column(Float, nullable=True, default=None)
+    hot_score = Column(Float, nullable=False, index=True,
+        default=_initial_hot_score)
     # TODO should this (and the comment prose) be a special column type?
     remark = Column(UnicodeText, nullable=False, default=u'')
 
@@ -282,10 +304,7 @@ class ArtworkRating(TableBase):
 
     artwork_id = Column(Integer, ForeignKey(Artwork.id), primary_key=True, nullable=False)
     user_id = Column(Integer, ForeignKey(User.id), primary_key=True, nullable=False)
-    rating = ColumnProperty(
-        Column(Float, CheckConstraint('rating >= -1.0 AND rating <= 1.0'), nullable=False),
-        extension=RatingAttributeExtension(),
-    )
+    rating = Column(Float, CheckConstraint('rating >= -1.0 AND rating <= 1.0'), nullable=False)
     timestamp = Column(TZDateTime, nullable=False, index=True, default=now, onupdate=now)
 
     validates('rating')
@@ -293,6 +312,58 @@ class ArtworkRating(TableBase):
         """Ensures the rating is within the proper rating radius."""
         return -1.0 <= rating <= 1.0
 
+    @classmethod
+    def set(cls, session, artwork, user, rating):
+        """Sets `user`'s rating of `artwork`, replacing any earlier one, and
+        flushes so the artwork's rating stats are up to date."""
+        return cls.set_many(session, user, {artwork.id: rating})[0]
+
+    @classmethod
+    def set_many(cls, session, user, ratings):
+        """Sets several of `user`'s ratings at once, given a dict of artwork
+        id to rating, and flushes.  Returns the `ArtworkRating`s, in order of
+        artwork id.
+
+        Existing ratings are fetched in one query and locked while they're
+        changed, so concurrent ratings by the same user can't both count.
+        The artworks' stats are adjusted in one statement each; see
+        `_flush_artwork_ratings`.
+        """
+        existing = {}
+        if ratings:
+            q = session.query(cls) \
+                .filter(cls.user_id == user.id) \
+                .filter(cls.artwork_id.in_(ratings.keys())) \
+                .with_lockmode('update')
+            existing = dict((obj.artwork_id, obj) for obj in q)
+
+        rating_objs = []
+        for artwork_id, rating in sorted(ratings.iteritems()):
+            rating_obj = existing.get(artwork_id)
+            if rating_obj:
+                rating_obj.rating = rating
+            else:
+                rating_obj = cls(artwork_id=artwork_id, user=user,
+                                 rating=rating)
+                session.add(rating_obj)
+            rating_objs.append(rating_obj)
+
+        session.flush()
+        return rating_objs
+
+
+class ArtworkSimilarity(TableBase):
+    """How much one piece of art is like another, judged by who's rated them
+    and how they're tagged.  Only each artwork's closest few neighbors are
+    kept, and they're recalculated from scratch every so often by
+    `floof.lib.similarity`, so this is all that's read when showing them.
+    """
+    __tablename__ = 'artwork_similarities'
+
+    artwork_id = Column(Integer, ForeignKey(Artwork.id), primary_key=True, nullable=False, autoincrement=False)
+    similar_artwork_id = Column(Integer, ForeignKey(Artwork.id), primary_key=True, nullable=False, autoincrement=False)
+    similarity = Column(Float, nullable=False)
+
 
 ### PERMISSIONS
 
@@ -313,44 +384,98 @@ class UserRole(TableBase):
 class Discussion(TableBase):
     __tablename__ = 'discussions'
     id = Column(Integer, primary_key=True, nullable=False)
-    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=False)
+    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=False, index=True)
     comment_count = Column(Integer, nullable=False, default=0)
 
+# Every comment's path is its parent's path plus its own id, padded to this
+# many digits, so sorting by path puts every comment right after its parent
+# and its older siblings' replies.  Fixed-width digits sort the same way under
+# any collation
+COMMENT_PATH_SEGMENT = 10
+COMMENT_PATH_LENGTH = 1000
+MAX_COMMENT_DEPTH = COMMENT_PATH_LENGTH // COMMENT_PATH_SEGMENT
+
+def comment_path_segment(comment_id):
+    return u'{0:0{1}d}'.format(comment_id, COMMENT_PATH_SEGMENT)
+
 class Comment(TableBase):
     __tablename__ = 'comments'
+    __table_args__ = (
+        Index('ix_comments_discussion_id_path', 'discussion_id', 'path'),
+    )
     id = Column(Integer, primary_key=True, nullable=False)
     discussion_id = Column(Integer, ForeignKey('discussions.id'), nullable=False)
     posted_time = Column(TZDateTime, nullable=False, index=True, default=now)
     author_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    # Nested set threading; Google it
-    left = Column(Integer, index=True, nullable=False)
-    right = Column(Integer, index=True, nullable=False)
+    parent_id = Column(Integer, ForeignKey('comments.id'), nullable=True, index=True)
+    # Materialized path threading; see COMMENT_PATH_SEGMENT.  The path can't
+    # be known until the id is, so it's filled in by `_set_comment_path` just
+    # after the comment is inserted
+    path = Column(Unicode(COMMENT_PATH_LENGTH), nullable=False, default=u'')
     content = Column(UnicodeText(4096), nullable=False)
+    # `content` rendered and sanitized, or NULL if that hasn't happened since
+    # it last changed; see `floof.lib.helpers.render_comment`
+    content_html = Column(UnicodeText, nullable=True)
+
+    @validates('content')
+    def _forget_content_html(self, key, content):
+        self.content_html = None
+        return content
+
+    @property
+    def depth(self):
+        """How many comments this one is nested below; 0 for top-level."""
+        return len(self.path) // COMMENT_PATH_SEGMENT - 1
+
+    @property
+    def ancestor_ids(self):
+        """The ids of the comments above this one, outermost first."""
+        return [int(self.path[start:start + COMMENT_PATH_SEGMENT])
+            for start in xrange(0, len(self.path) - COMMENT_PATH_SEGMENT,
+                COMMENT_PATH_SEGMENT)]
+
+    def is_descendant_of(self, other):
+        """True if this comment is somewhere below `other`, or is `other`."""
+        return self.path.startswith(other.path)
 
     @property
     def ancestors_query(self):
         """Returns a query that will fetch all comments somewhere above this
         one, in correct linear order.
         """
-        # Ancestors are any comments whose left and right contain this
-        # comment's left
-        return object_session(self).query(Comment) \
-            .with_parent(self.discussion) \
-            .filter(Comment.left < self.left) \
-            .filter(Comment.right > self.right) \
-            .order_by(Comment.left.asc())
+        # Ancestors' ids are all in this comment's path
+        query = object_session(self).query(Comment) \
+            .order_by(Comment.path.asc())
+        if not self.ancestor_ids:
+            return query.filter(false())
+        return query.filter(Comment.id.in_(self.ancestor_ids))
 
     @property
     def descendants_query(self):
         """Returns a query that will fetch all comments nested below this one,
         including this one itself, in correct linear order.
         """
-        # Descendants are any comments with a left (or right) between
-        # comment.left and comment.right
+        # Descendants' paths all start with this comment's path.  Phrased as a
+        # range, since that can always use the index and LIKE can't
+        last_path = self.path.ljust(COMMENT_PATH_LENGTH, u'9')
         return object_session(self).query(Comment) \
             .with_parent(self.discussion) \
-            .filter(Comment.left.between(self.left, self.right)) \
-            .order_by(Comment.left.asc())
+            .filter(Comment.path.between(self.path, last_path)) \
+            .order_by(Comment.path.asc())
+
+def _set_comment_path(mapper, connection, target):
+    """Fills in a new comment's path, now that it has an id."""
+    if target.parent is not None:
+        path = target.parent.path
+    else:
+        path = u''
+    path += comment_path_segment(target.id)
+
+    table = Comment.__table__
+    connection.execute(table.update()
+        .where(table.c.id == target.id)
+        .values(path=path))
+    set_committed_value(target, 'path', path)
 
 
 ### PROFILES
@@ -559,6 +684,412 @@ artwork_albums = Table('artwork_albums', TableBase.metadata,
 )
 
 
+### COUNTS
+
+class ArtworkCount(TableBase):
+    """The number of pieces of art attached to a user (as an artist), a tag,
+    or an album.  This is denormalized purely so galleries of those things can
+    be paged without COUNTing a big multi-join query on every single view.
+
+    Every user, tag, and album gets a row, at zero, as soon as it's inserted;
+    rows are then kept up to date on every flush by `_flush_artwork_counts`
+    below, which only sees changes made through the ORM.  Anything that
+    fiddles with the underlying tables directly is responsible for fixing
+    these up too.
+    """
+    __tablename__ = 'artwork_counts'
+    subject_type = Column(Enum(u'user', u'tag', u'album', name='artwork_counts_subject_type'), primary_key=True, nullable=False)
+    subject_id = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    artwork_count = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, session, subject_type, subject_id):
+        """Returns the number of pieces of art attached to the given subject,
+        or None if it isn't known.
+
+        This always hits the database, since the counts are updated behind
+        the ORM's back.
+        """
+        return session.query(cls.artwork_count) \
+            .filter_by(subject_type=subject_type, subject_id=subject_id) \
+            .scalar()
+
+# Where the real answer for each kind of count lives
+_artwork_count_sources = dict(
+    user=UserArtwork.__table__.c.user_id,
+    tag=artwork_tags.c.tag_id,
+    album=artwork_albums.c.album_id,
+)
+
+def _bump_artwork_count(connection, subject_type, subject_id, delta):
+    """Atomically adjusts a single count by `delta`."""
+    table = ArtworkCount.__table__
+    result = connection.execute(table.update()
+        .where(table.c.subject_type == subject_type)
+        .where(table.c.subject_id == subject_id)
+        .values(artwork_count=table.c.artwork_count + delta))
+    if result.rowcount:
+        return
+
+    # There's no row, which shouldn't happen: they're created along with
+    # their subjects, so that two first pieces of art can't both find no row
+    # and both insert one.  Somebody went around the ORM, so count it from
+    # scratch; this runs after the flush, so the count already includes
+    # whatever changed
+    source = _artwork_count_sources[subject_type]
+    connection.execute(table.insert().values(
+        subject_type=subject_type,
+        subject_id=subject_id,
+        artwork_count=select([func.count()]).where(source == subject_id)
+            .as_scalar(),
+    ))
+
+def _create_artwork_count(subject_type):
+    """Returns a mapper event listener that adds an empty count for each new
+    subject, in the same flush that inserts it.
+    """
+    def listener(mapper, connection, target):
+        connection.execute(ArtworkCount.__table__.insert().values(
+            subject_type=subject_type,
+            subject_id=target.id,
+            artwork_count=0,
+        ))
+
+    return listener
+
+def _track_artwork_count(subject_type, delta, subject_is_target):
+    """Returns an attribute event listener that remembers, on the changed
+    object, that the appended or removed subject's count needs bumping.  The
+    change is applied on flush, once everything has a primary key.
+    """
+    def listener(target, value, initiator):
+        subject = target if subject_is_target else value
+        target.__dict__.setdefault('_artwork_count_deltas', []) \
+            .append((subject_type, subject, delta))
+        return value
+
+    return listener
+
+def _flush_artwork_counts(session, flush_context):
+    """Applies all the pending changes to `ArtworkCount`s after a flush."""
+    deltas = {}
+    def add_delta(subject_type, subject_id, delta):
+        key = subject_type, subject_id
+        deltas[key] = deltas.get(key, 0) + delta
+
+    # UserArtwork is a real class, so it's easy to tell what happened to it
+    for obj in session.new:
+        if isinstance(obj, UserArtwork):
+            add_delta(u'user', obj.user_id, 1)
+    for obj in session.deleted:
+        if isinstance(obj, UserArtwork):
+            add_delta(u'user', obj.user_id, -1)
+
+    # The plain association tables need the help of the listeners above
+    for obj in itertools.chain(session.new, session.dirty):
+        pending = obj.__dict__.pop('_artwork_count_deltas', ())
+        for subject_type, subject, delta in pending:
+            add_delta(subject_type, subject.id, delta)
+
+    if not any(deltas.itervalues()):
+        return
+
+    connection = session.connection()
+    for (subject_type, subject_id), delta in sorted(deltas.iteritems()):
+        # Sorted, so concurrent flushes lock rows in the same order
+        if delta:
+            _bump_artwork_count(connection, subject_type, subject_id, delta)
+
+
+### RATINGS
+
+def _adjust_artwork_rating(connection, artwork_id, count_delta, sum_delta):
+    """Atomically adjusts an artwork's rating count and sum, and recalculates
+    its score from the new values, all in one statement."""
+    table = Artwork.__table__
+    rating_count = table.c.rating_count + count_delta
+    rating_sum = table.c.rating_sum + sum_delta
+    connection.execute(table.update()
+        .where(table.c.id == artwork_id)
+        .values(
+            rating_count=rating_count,
+            rating_sum=rating_sum,
+            rating_score=wilson_score_sql(rating_count, rating_sum),
+        ))
+
+def _flush_artwork_ratings(session, flush_context):
+    """Applies all the changed `ArtworkRating`s to their artworks' rating
+    stats after a flush."""
+    deltas = {}
+    def add_delta(artwork_id, count_delta, sum_delta):
+        count, sum_ = deltas.get(artwork_id, (0, 0))
+        deltas[artwork_id] = count + count_delta, sum_ + sum_delta
+
+    for obj in session.new:
+        if isinstance(obj, ArtworkRating):
+            add_delta(obj.artwork_id, 1, obj.rating)
+    for obj in session.deleted:
+        if isinstance(obj, ArtworkRating):
+            history = get_history(obj, 'rating')
+            old = (history.deleted or history.unchanged or [obj.rating])[0]
+            add_delta(obj.artwork_id, -1, -old)
+    for obj in session.dirty:
+        if isinstance(obj, ArtworkRating):
+            history = get_history(obj, 'rating')
+            if history.added and history.deleted:
+                add_delta(obj.artwork_id, 0,
+                    history.added[0] - history.deleted[0])
+
+    if not deltas:
+        return
+
+    connection = session.connection()
+    for artwork_id, (count_delta, sum_delta) in sorted(deltas.iteritems()):
+        # Sorted, so concurrent flushes lock rows in the same order
+        if not (count_delta or sum_delta):
+            continue
+        _adjust_artwork_rating(connection, artwork_id, count_delta, sum_delta)
+
+        # The stats in memory are now stale
+        artwork = session.identity_map.get(identity_key(Artwork, artwork_id))
+        if artwork is not None:
+            session.expire(artwork,
+                ['rating_count', 'rating_sum', 'rating_score'])
+
+
+### SEARCH
+
+class SearchTerm(TableBase):
+    """One entry in the full-text search index: a word that appears somewhere
+    in a resource's "document", and how much it counts there.
+
+    An artwork's document is its title, tags, remark and comments; a user's is
+    their name, display name and the comments on their page.  Words count for
+    more in some places than others; see `SEARCH_WEIGHTS`.  The index is kept
+    up to date as things change by `_flush_search_index`, and searched by
+    `floof.lib.search`.
+
+    Each comment's words are entered separately, under its `comment_id`, so
+    that posting or editing one only has to touch its own entries; the rest
+    of the document has a `comment_id` of 0.  A term can thus appear several
+    times for one resource, and its weights there add up.
+    """
+    __tablename__ = 'search_terms'
+
+    term = Column(Unicode(64), primary_key=True, nullable=False)
+    resource_id = Column(Integer, ForeignKey(Resource.id), primary_key=True, nullable=False, autoincrement=False, index=True)
+    comment_id = Column(Integer, primary_key=True, nullable=False, autoincrement=False, default=0, index=True)
+    weight = Column(Float, nullable=False)
+
+SEARCH_WEIGHTS = dict(
+    title=4.0,
+    name=4.0,
+    tag=3.0,
+    remark=1.0,
+    comment=0.5,
+)
+
+_search_word_re = re.compile(r'\w+', re.UNICODE)
+
+def search_terms(text):
+    """Splits text into the terms it's indexed under: lowercased words, of at
+    least two characters, cut off at the length of `SearchTerm.term`."""
+    if not text:
+        return []
+    return [word[:64] for word in _search_word_re.findall(text.lower())
+        if len(word) > 1]
+
+def _insert_search_terms(connection, weights):
+    """Adds index entries from a dict of (term, resource id, comment id) to
+    weight."""
+    if weights:
+        connection.execute(SearchTerm.__table__.insert(), [
+            dict(term=term, resource_id=resource_id, comment_id=comment_id,
+                weight=weight)
+            for (term, resource_id, comment_id), weight
+                in weights.iteritems()])
+
+def _weigh_terms(weights, text, resource_id, comment_id, weight):
+    for term in search_terms(text):
+        key = term, resource_id, comment_id
+        weights[key] = weights.get(key, 0) + weight
+
+def _comment_weights(connection, where):
+    """Returns index entries, as for :func:`_insert_search_terms`, for the
+    comments matching `where`."""
+    discussions = Discussion.__table__
+    comments = Comment.__table__
+    weights = {}
+    for row in connection.execute(
+            select([discussions.c.resource_id, comments.c.id,
+                    comments.c.content],
+                from_obj=comments.join(discussions,
+                    discussions.c.id == comments.c.discussion_id))
+            .where(where)):
+        _weigh_terms(weights, row.content, row.resource_id, row.id,
+            SEARCH_WEIGHTS['comment'])
+    return weights
+
+def reindex_search_terms(connection, resource_ids, comments=True):
+    """Rebuilds the search index entries of the given resources from scratch,
+    with a handful of queries no matter how many there are.  If `comments` is
+    False, the entries for the resources' comments are left alone.
+    """
+    resource_ids = sorted(resource_ids)
+    if not resource_ids:
+        return
+
+    # Two transactions reindexing the same resource at once would otherwise
+    # trip over each other's new entries.  Comments have entries of their own
+    # and don't need this; see `reindex_comment_search_terms`
+    resources = Resource.__table__
+    connection.execute(select([resources.c.id],
+        resources.c.id.in_(resource_ids),
+        order_by=resources.c.id,
+        for_update=True))
+
+    weights = {}
+    def add(resource_id, text, weight):
+        _weigh_terms(weights, text, resource_id, 0, weight)
+
+    artwork = Artwork.__table__
+    for row in connection.execute(
+            select([artwork.c.resource_id, artwork.c.title, artwork.c.remark])
+            .where(artwork.c.resource_id.in_(resource_ids))):
+        add(row.resource_id, row.title, SEARCH_WEIGHTS['title'])
+        add(row.resource_id, row.remark, SEARCH_WEIGHTS['remark'])
+
+    tags = Tag.__table__
+    for row in connection.execute(
+            select([artwork.c.resource_id, tags.c.name],
+                from_obj=artwork
+                    .join(artwork_tags, artwork_tags.c.artwork_id == artwork.c.id)
+                    .join(tags, tags.c.id == artwork_tags.c.tag_id))
+            .where(artwork.c.resource_id.in_(resource_ids))):
+        add(row.resource_id, row.name, SEARCH_WEIGHTS['tag'])
+
+    users = User.__table__
+    for row in connection.execute(
+            select([users.c.resource_id, users.c.name, users.c.display_name])
+            .where(users.c.resource_id.in_(resource_ids))):
+        add(row.resource_id, row.name, SEARCH_WEIGHTS['name'])
+        add(row.resource_id, row.display_name, SEARCH_WEIGHTS['name'])
+
+    table = SearchTerm.__table__
+    delete = table.delete().where(table.c.resource_id.in_(resource_ids))
+    if comments:
+        weights.update(_comment_weights(connection,
+            Discussion.__table__.c.resource_id.in_(resource_ids)))
+    else:
+        delete = delete.where(table.c.comment_id == 0)
+
+    connection.execute(delete)
+    _insert_search_terms(connection, weights)
+
+def reindex_comment_search_terms(connection, comment_ids):
+    """Rebuilds the search index entries of the given comments, and only
+    those.  Deleted comments just lose their entries."""
+    comment_ids = sorted(comment_ids)
+    if not comment_ids:
+        return
+
+    table = SearchTerm.__table__
+    connection.execute(table.delete()
+        .where(table.c.comment_id.in_(comment_ids)))
+    _insert_search_terms(connection, _comment_weights(connection,
+        Comment.__table__.c.id.in_(comment_ids)))
+
+# The attributes of each class that end up in the index
+_searched_attributes = [
+    (Artwork, ('title', 'remark', 'tag_objs')),
+    (User, ('name', 'display_name')),
+    (Comment, ('content',)),
+]
+
+def _flush_search_index(session, flush_context):
+    """Reindexes every resource and comment whose text this flush changed."""
+    resource_ids = set()
+    comment_ids = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        for cls, attributes in _searched_attributes:
+            if isinstance(obj, cls):
+                break
+        else:
+            continue
+
+        # Don't load anything just to find out it hasn't changed
+        if obj in session.dirty and not any(
+                get_history(obj, attribute, PASSIVE_NO_INITIALIZE)
+                    .has_changes()
+                for attribute in attributes):
+            continue
+
+        if isinstance(obj, Comment):
+            comment_ids.add(obj.id)
+        else:
+            resource_ids.add(obj.resource_id)
+
+    # Deleted things are reindexed as having nothing in them
+    resource_ids.discard(None)
+    comment_ids.discard(None)
+    connection = session.connection()
+    if resource_ids:
+        reindex_search_terms(connection, resource_ids, comments=False)
+    if comment_ids:
+        reindex_comment_search_terms(connection, comment_ids)
+
+
+### DERIVATIVES
+
+class DerivativeJob(TableBase):
+    """A thumbnail or other derivative of some artwork's file that still needs
+    generating.  Jobs are worked through by a separate worker process (see
+    bin/derivative-worker.py), and deleted once done.
+
+    A job is `queued` until a worker claims it, at which point it becomes
+    `running`.  If the work fails, it goes back to `queued`, but won't be
+    retried until `available_time`; after too many attempts it's `failed`
+    for good.  A `running` job whose worker seems to have died will be
+    claimed again eventually.
+    """
+    __tablename__ = 'derivative_jobs'
+    __table_args__ = (
+        UniqueConstraint('artwork_id', 'class_'),
+    )
+    id = Column(Integer, primary_key=True, nullable=False)
+    artwork_id = Column(Integer, ForeignKey('artwork.id'), nullable=False, index=True)
+    class_ = Column(Unicode(32), nullable=False)
+    state = Column(Enum(u'queued', u'running', u'failed', name='derivative_job_state'), nullable=False, default=u'queued', index=True)
+    queued_time = Column(TZDateTime, nullable=False, default=now)
+    available_time = Column(TZDateTime, nullable=False, default=now)
+    started_time = Column(TZDateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(UnicodeText, nullable=True)
+
+class ArtworkRendition(TableBase):
+    """A rendition of some artwork's file (e.g. a thumbnail) that's been made
+    and put in the filestore.  See floof.lib.derivatives.
+
+    The fingerprint identifies the settings it was made with; if they've
+    changed since, it's obsolete.  Each artwork has at most one of each
+    rendition, so if two requests race to make the same one, the loser's
+    transaction fails; it can simply be thrown away.
+    """
+    __tablename__ = 'artwork_renditions'
+    __table_args__ = (
+        UniqueConstraint('artwork_id', 'name'),
+    )
+    id = Column(Integer, primary_key=True, nullable=False)
+    artwork_id = Column(Integer, ForeignKey('artwork.id'), nullable=False, index=True)
+    name = Column(Unicode(32), nullable=False)
+    fingerprint = Column(Unicode(16), nullable=False)
+    mime_type = Column(Unicode(255), nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    file_size = Column(Integer, nullable=False)
+    created_time = Column(TZDateTime, nullable=False, default=now)
+
+
 ### Logging
 
 class Log(TableBase):
@@ -618,9 +1149,14 @@ Artwork.uploader = relation(User, innerjoin=True,
     backref='uploaded_artwork')
 Artwork.user_artwork = relation(UserArtwork,
     backref=backref('artwork', innerjoin=True))
-Artwork.ratings = relation(ArtworkRating,
+Artwork.derivative_jobs = relation(DerivativeJob,
     backref=backref('artwork', innerjoin=True),
-    extension=ArtworkRatingsAttributeExtension())
+    cascade='all, delete-orphan')
+Artwork.renditions = relation(ArtworkRendition,
+    backref=backref('artwork', innerjoin=True),
+    cascade='all, delete-orphan')
+Artwork.ratings = relation(ArtworkRating,
+    backref=backref('artwork', innerjoin=True))
 
 #User.discussion = relation(Discussion, backref='user')
 User.user_artwork = relation(UserArtwork, backref=backref('user', innerjoin=True))
@@ -634,8 +1170,10 @@ Resource.discussion = relation(Discussion, uselist=False,
     backref=backref('resource', innerjoin=True))
 
 Comment.author = relation(User, innerjoin=True, backref='comments')
+Comment.parent = relation(Comment, remote_side=[Comment.id])
+event.listen(Comment, 'after_insert', _set_comment_path)
 
-Discussion.comments = relation(Comment, order_by=Comment.left.asc(),
+Discussion.comments = relation(Comment, order_by=Comment.path.asc(),
     backref=backref('discussion', innerjoin=True))
 
 # Certificates
@@ -645,6 +1183,30 @@ Certificate.user = relation(User, innerjoin=True, backref='certificates')
 Album.user = relation(User, innerjoin=True, backref='albums')
 Album.artwork = relation(Artwork, secondary=artwork_albums, backref='albums')
 
+# Counts; these need to propagate to Artwork's polymorphic subclasses
+event.listen(User, 'after_insert', _create_artwork_count(u'user'))
+event.listen(Tag, 'after_insert', _create_artwork_count(u'tag'))
+event.listen(Album, 'after_insert', _create_artwork_count(u'album'))
+event.listen(Artwork.tag_objs, 'append',
+    _track_artwork_count(u'tag', 1, subject_is_target=False),
+    retval=True, propagate=True)
+event.listen(Artwork.tag_objs, 'remove',
+    _track_artwork_count(u'tag', -1, subject_is_target=False),
+    propagate=True)
+event.listen(Album.artwork, 'append',
+    _track_artwork_count(u'album', 1, subject_is_target=True),
+    retval=True, propagate=True)
+event.listen(Album.artwork, 'remove',
+    _track_artwork_count(u'album', -1, subject_is_target=True),
+    propagate=True)
+event.listen(session, 'after_flush', _flush_artwork_counts)
+
+# Ratings
+event.listen(session, 'after_flush', _flush_artwork_ratings)
+
+# Search
+event.listen(session, 'after_flush', _flush_search_index)
+
 # Logs
 Log.user = relation(User, backref='logs',
         primaryjoin=User.id==Log.user_id,
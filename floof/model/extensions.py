@@ -1,23 +1,31 @@
 # encoding: utf8
 from __future__ import division
 
-from math import sqrt
+from datetime import datetime, timedelta
+from math import log, sqrt
 
-from sqlalchemy.orm.interfaces import AttributeExtension
+import pytz
 
-def wilson_score(n, total):
-    """Given a number of normalized [-1, 1] ratings and their total, calculates
-    the expected score, using the Wilson score interval.  Blah, blah, math."""
-    # See: http://www.evanmiller.org/how-not-to-sort-by-average-rating.html
-    # And: http://amix.dk/blog/post/19588
-    # This is slightly modified, as the given formula is normally for binary
-    # data; i.e., ratings are 0 or 1.  Ours are normalized to [0, 1], then
-    # unnormalized back to [-1, 1].
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sqlalchemy.sql import case, cast, func, null
+from sqlalchemy.types import Float
+
+__all__ = [
+    'WILSON_Z', 'wilson_score', 'wilson_scores', 'wilson_score_sql',
+    'HOT_HALF_LIFE', 'HOT_WINDOW', 'hot_score',
+]
+
+# Confidence, as quantile of the SND.  z = 1.0 → 85%; z = 1.6 → 95%.
+WILSON_Z = 1.03643337714489
+
+def _wilson_score(n, total, sqrt):
     phat = (total / n + 1) / 2  # normalize [-n, n] to [0, 1]
-    # Confidence, as quantile of the SND.  z = 1.0 → 85%; z = 1.6 → 95%.
-    z = 1.03643337714489
+    z = WILSON_Z
 
-    print n, total, phat, z
     score = (
         (phat + z**2 / (2 * n) - z * sqrt(
             (phat * (1 - phat) + z**2 / (4 * n)) / n))
@@ -26,61 +34,77 @@ def wilson_score(n, total):
 
     return score * 2 - 1  # denormalize [0, 1] to [-1, 1]
 
-def recalc_wilson_score(artwork):
-    if artwork.rating_count:
-        artwork.rating_score = wilson_score(
-            artwork.rating_count, artwork.rating_sum)
-    else:
-        artwork.rating_score = None
-
-class RatingAttributeExtension(AttributeExtension):
-    """AttributeExtension to act on the change of a rating.  Updates
-       the rating_sum of the artwork"""
-
-    active_history = True
-
-    def append(self, state, value, initiator):
-        return value
-
-    def remove(self, state, value, initiator):
-        return value
-
-    def set(self, state, rating, oldrating, initiator):
-        """Update the rating sum of the artwork"""
-        rating_obj = state.obj()
-        artwork = rating_obj.artwork
-        if artwork:
-            artwork.rating_sum = artwork.rating_sum - oldrating + rating
-            recalc_wilson_score(artwork)
-        return rating
-
-class ArtworkRatingsAttributeExtension(AttributeExtension):
-    """AttributeExtension to act on the addition or removal of a rating to
-       a piece of art.  Updates the rating_* columns"""
-
-    active_history = True
+def wilson_score(n, total):
+    """Given a number of normalized [-1, 1] ratings and their total, calculates
+    the expected score, using the Wilson score interval.  Blah, blah, math."""
+    # See: http://www.evanmiller.org/how-not-to-sort-by-average-rating.html
+    # And: http://amix.dk/blog/post/19588
+    # This is slightly modified, as the given formula is normally for binary
+    # data; i.e., ratings are 0 or 1.  Ours are normalized to [0, 1], then
+    # unnormalized back to [-1, 1].
+    return _wilson_score(n, total, sqrt)
+
+def wilson_scores(counts, totals):
+    """Vectorized :func:`wilson_score`, for lots of artwork at once.  Takes
+    sequences of numbers of ratings and their totals, and returns a list of
+    scores, with None wherever there are no ratings.
+
+    Uses NumPy if it's installed, and is merely slow otherwise.
+    """
+    if numpy is None:
+        return [wilson_score(n, total) if n > 0 else None
+            for n, total in zip(counts, totals)]
+
+    counts = numpy.asarray(counts, dtype=numpy.float64)
+    totals = numpy.asarray(totals, dtype=numpy.float64)
+    rated = counts > 0
+
+    scores = numpy.empty(len(counts), dtype=numpy.float64)
+    scores[rated] = _wilson_score(counts[rated], totals[rated], numpy.sqrt)
+    return [float(score) if is_rated else None
+        for score, is_rated in zip(scores, rated)]
+
+def wilson_score_sql(n, total):
+    """Same as :func:`wilson_score`, but for SQL expressions: returns an
+    expression that calculates the score in the database, or NULL if there are
+    no ratings.
+
+    SQLite has no `sqrt` function of its own; :func:`floof.model.initialize`
+    adds one.
+    """
+    n = cast(n, Float)
+    return case(
+        [(n > 0, _wilson_score(n, total, func.sqrt))],
+        else_=null(),
+    )
 
-    def append(self, state, rating_obj, initiator):
-        artwork = state.obj()
-        artwork.rating_count += 1
-        artwork.rating_sum += rating_obj.rating
-        recalc_wilson_score(artwork)
 
-        return rating_obj
+# Art loses half its hotness every HOT_HALF_LIFE, and ratings made within the
+# last HOT_WINDOW count extra
+HOT_HALF_LIFE = timedelta(hours=12)
+HOT_WINDOW = timedelta(hours=24)
+HOT_EPOCH = datetime(2012, 1, 1, tzinfo=pytz.utc)
 
-    def remove(self, state, rating_obj, initiator):
-        artwork = state.obj()
-        artwork.rating_count -= 1
-        artwork.rating_sum -= rating_obj.rating
-        recalc_wilson_score(artwork)
+def hot_score(rating_score, recent_interest, uploaded_time):
+    """Returns how "hot" a piece of art is, i.e. how high it should be in a
+    list of what's popular right now.
 
-        return rating_obj
+    `rating_score` is the usual Wilson score, or None for unrated art.
+    `recent_interest` measures how fast the ratings are coming in: it's the
+    sum of the ratings made within the last `HOT_WINDOW`, each normalized to
+    [0, 1].
 
-    def set(self, state, rating_obj, oldrating_obj, initiator):
-        artwork = state.obj()
-        artwork.rating_sum = (
-            artwork.rating_sum - oldrating_obj.rating + rating_obj.rating)
-        recalc_wilson_score(artwork)
+    Popularity halves in value every `HOT_HALF_LIFE`, but rather than make
+    every score shrink as time goes by, newer art gets a proportionally
+    bigger score instead.  The order is the same, and a score only changes
+    when the art's ratings do, or when ratings fall out of the window.
+    """
+    popularity = 1 + (rating_score or 0) + (recent_interest or 0)
 
-        return rating_obj
+    if uploaded_time.tzinfo is None:
+        uploaded_time = uploaded_time.replace(tzinfo=pytz.utc)
+    age = uploaded_time - HOT_EPOCH
+    half_life = HOT_HALF_LIFE.days * 86400 + HOT_HALF_LIFE.seconds
+    age_seconds = age.days * 86400 + age.seconds
 
+    return log(1 + popularity, 2) + age_seconds / half_life
@@ -14,12 +14,16 @@ A storage object factory can be retrieved through :func:`get_storage_factory`.
 """
 
 from __future__ import absolute_import
-from cStringIO import StringIO
+import logging
+import os
 import shutil
+import tempfile
 
 from pyramid.util import DottedNameResolver
 import transaction
 
+log = logging.getLogger(__name__)
+
 
 def get_storage_factory(settings, prefix='filestore'):
     """Uses a Pyramid deployment settings dictionary to construct and return
@@ -31,7 +35,8 @@ def get_storage_factory(settings, prefix='filestore'):
 
     The `$prefix` config setting may be either the full dotted python name of a
     data manager class, or the name of one of the modules in the
-    floof.model.filestore namespace, currently `local` or `mogilefs`.
+    floof.model.filestore namespace, currently `local`, `sharded`,
+    `mogilefs`, `s3`, or `tiered`.
     """
     # Pull prefix.key out of the config object
     kwargs = {}
@@ -55,6 +60,8 @@ def get_storage_factory(settings, prefix='filestore'):
         must be manually joined to a Zope-style transaction."""
         return storage(transaction.manager, **kwargs)
 
+    # For asking about the storage without making one
+    storage_factory.storage_class = storage
     return storage_factory
 
 
@@ -62,42 +69,84 @@ def get_storage_factory(settings, prefix='filestore'):
 # 3. add notion of file class for all filestorages; local can either ignore or use subdirectories
 # fix this impl-per-module nonsense
 class FileStorage(object):
-    """Implements a staging dictionary to temporarily hold in StringIO objects
-    copies of all file objects that are passed to :meth`put`.
+    """Implements a staging dictionary to temporarily hold the paths of
+    temporary files on disk, containing copies of all the files passed to
+    :meth:`put` or :meth:`put_path`.  Nothing is ever held in memory in its
+    entirety, so arbitrarily large files are fine.
 
     Child classes must implement :meth:`url` and the Zope transaction `data
-    manager` methods according to their actual backends.
+    manager` methods according to their actual backends.  They may also set
+    `tempdir` to wherever staged files should live; the default is the
+    system's temporary directory.
+
+    Storages whose URLs clients can fetch themselves, like presigned S3 URLs,
+    should set `redirect`; the app will then redirect to them rather than
+    serving the files itself.
 
     See: http://www.zodb.org/zodbbook/transactions.html
 
     """
+    redirect = False
+
     def __init__(self, transaction_manager, **kwargs):
         self.transaction_manager = transaction_manager
         self.stage = {}
+        self.tempdir = tempfile.gettempdir()
 
     def put(self, class_, key, fileobj):
         """Stages the data in the `fileobj` for subsequent commital under the
         given `class_` and `key`."""
 
-        stageobj = StringIO()
-        shutil.copyfileobj(fileobj, stageobj)
+        fd, path = tempfile.mkstemp(dir=self.tempdir)
+        with os.fdopen(fd, 'wb') as stagefile:
+            shutil.copyfileobj(fileobj, stagefile)
         fileobj.seek(0)
-        stageobj.seek(0)
 
+        self._stage(class_, key, path)
+
+    def put_path(self, class_, key, path):
+        """Stages the file at `path` for subsequent commital under the given
+        `class_` and `key`.
+
+        The storage takes ownership of the file: it will be moved or deleted
+        when the transaction ends, so don't touch it afterwards.  Files already
+        in `tempdir` won't be copied at all.
+        """
+        if os.path.dirname(os.path.abspath(path)) != \
+                os.path.abspath(self.tempdir):
+            fd, temppath = tempfile.mkstemp(dir=self.tempdir)
+            os.close(fd)
+            shutil.move(path, temppath)
+            path = temppath
+
+        self._stage(class_, key, path)
+
+    def _stage(self, class_, key, path):
         idx = self._idx(class_, key)
-        self.stage[idx] = (class_, key, stageobj)
+        if idx in self.stage:
+            self._remove_stagefile(self.stage[idx][2])
+        self.stage[idx] = (class_, key, path)
 
     def _idx(self, class_, key):
         """Index for use in the staging dict."""
         return u':'.join((class_, key))
 
+    def _remove_stagefile(self, path):
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+            except OSError:
+                log.error("Failed to delete orphaned file '{0}'".format(path))
+
     def _finish(self):
-        """Cleans up the temporary memory file storage.
+        """Cleans up the staged temporary files, if they're still around.
 
         Should be run at the end of any abort or commit, regardless of the
         outcome.  (i.e. at the end of :meth:`abort`, :meth:`tpc_finish` and
         :meth:`tpc_abort`.)
         """
+        for class_, key, path in self.stage.itervalues():
+            self._remove_stagefile(path)
         self.stage = {}
 
     def sortKey(self):
@@ -105,14 +154,40 @@ class FileStorage(object):
         with multiple data managers."""
         return 'filestore:{0}'.format(id(self.stage))
 
-    def url(self, class_, key):
+    def url(self, class_, key, content_type=None, disposition=None):
         """Returns a URL for accessing this file.
 
         Must be a fully-qualified URL, or None if the file doesn't seem to
         exist.  Local files can be served by using file:// URLs.
+
+        `content_type` and `disposition` are the headers the file should be
+        served with.  Storages with `redirect` set must see that clients get
+        them, since the app never sees the response; others can ignore them.
         """
         raise NotImplementedError
 
+    def urls(self, class_, keys, content_type=None):
+        """Returns a dict mapping each of `keys` to its URL, as :meth:`url`
+        would.  Missing files map to None.
+
+        This implementation just calls :meth:`url` for each key; storages that
+        can look up several files at once should override it.
+        """
+        return dict(
+            (key, self.url(class_, key, content_type=content_type))
+            for key in keys)
+
+    @classmethod
+    def check_url(cls, url):
+        """Called when a URL handed out earlier is about to be used again,
+        e.g. one remembered by :mod:`floof.lib.fileinfo`.  Returns whether
+        it's still good; if not, the file should be looked up afresh with
+        :meth:`url`.
+
+        This implementation trusts it.
+        """
+        return True
+
     def abort(self, transaction):
         """Run if the transaction is aborted before the two-stage commit
         process begins."""
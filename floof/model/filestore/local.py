@@ -4,8 +4,6 @@ from __future__ import absolute_import
 
 import logging
 import os
-import shutil
-import tempfile
 
 from floof.model.filestore import FileStorage as BaseFileStorage
 
@@ -34,6 +32,8 @@ class FileStorage(BaseFileStorage):
         if not os.path.isdir(directory):
             raise IOError("filestore.directory {0} does not exist".format(directory))
 
+        # Keep staged files on the same filesystem as their destination, so
+        # they can be renamed into place
         self.tempdir = os.path.join(self.directory, '__temp__')
         if not os.path.isdir(self.tempdir):
             try:
@@ -43,9 +43,7 @@ class FileStorage(BaseFileStorage):
                     raise IOError("Unable to make temporary directory '{0}'"
                                   .format(self.tempdir))
 
-        self.tempfiles = {}
-
-    def url(self, class_, key):
+    def url(self, class_, key, content_type=None, disposition=None):
         return 'file://' + self._path(self.directory, class_, key).encode('utf8')
 
     def _path(self, prefix, class_, key):
@@ -55,10 +53,6 @@ class FileStorage(BaseFileStorage):
             prefix, class_,
             long_key[0], long_key[1], long_key[2], key)
 
-    def _finish(self):
-        self.tempfiles = {}
-        super(FileStorage, self)._finish()
-
     def abort(self, transaction):
         self._finish()
 
@@ -66,22 +60,17 @@ class FileStorage(BaseFileStorage):
         pass
 
     def commit(self, transaction):
-        """Write the files out to a temporary directory; may catch some
-        permission errors and filesystem capacity errors."""
-
-        for idx, (class_, key, stageobj) in self.stage.iteritems():
-            fd, path = tempfile.mkstemp(dir=self.tempdir)
-            self.tempfiles[idx] = path
-            fileobj = os.fdopen(fd, 'w')
-            stageobj.seek(0)
-            shutil.copyfileobj(stageobj, fileobj)
-            fileobj.flush()
-            fileobj.close()
+        """Flush the staged files to disk.  They're already in the temporary
+        directory, so there's nothing to copy."""
+
+        for class_, key, path in self.stage.itervalues():
+            with open(path, 'rb') as stagefile:
+                os.fsync(stagefile.fileno())
 
     def tpc_vote(self, transaction):
         """Check that the destination directory exists and is writeable."""
 
-        for idx, (class_, key, stageobj) in self.stage.iteritems():
+        for class_, key, path in self.stage.itervalues():
             destpath = self._path(self.directory, class_, key)
             destdir, destfile = os.path.split(destpath)
 
@@ -93,24 +82,14 @@ class FileStorage(BaseFileStorage):
                               "directory '{0}'.".format(destdir))
 
     def tpc_finish(self, transaction):
-        """Move the temporary files to their final location."""
+        """Rename the staged files into their final location."""
 
-        for idx, (class_, key, stageobj) in self.stage.iteritems():
-            temppath = self.tempfiles[idx]
+        for class_, key, path in self.stage.itervalues():
             destpath = self._path(self.directory, class_, key)
-            shutil.move(temppath, destpath)
+            os.rename(path, destpath)
 
         self._finish()
 
     def tpc_abort(self, transaction):
         """Delete any orphaned temporary files, if possible."""
-
-        for path in self.tempfiles.itervalues():
-            if os.path.isfile(path):
-                try:
-                    os.remove(path)
-                except OSError:
-                    log.error("Failed to delete orphaned file '{0}' "
-                              "during transaction abort".format(path))
-
         self._finish()
@@ -1,18 +1,121 @@
-"""Store files in MogileFS."""
+"""Store files in MogileFS.
+
+A storage object only lives as long as a request, but the tracker connections
+and the tracker's answers to `get_paths` are worth keeping around.  They're
+kept in a :class:`TrackerPool`, shared by every storage in the process that
+talks to the same trackers about the same domain.
+"""
 
 from __future__ import absolute_import
 
+from contextlib import contextmanager
 import logging
+import Queue
 import shutil
+import threading
 import uuid
 
 import pymogile
 
+from floof.lib.cache import MemoryCache
 from floof.model.filestore import FileStorage as BaseFileStorage
 
 log = logging.getLogger(__name__)
 
 
+class TrackerPool(object):
+    """Keeps idle tracker connections for reuse, and remembers where files
+    are.
+
+    A `pymogile.Client` holds on to a single socket, so it can only be used by
+    one thread at a time; :meth:`client` lends one out for the duration of a
+    `with` block.  Up to `pool_size` idle clients are kept.
+
+    Paths are cached for `path_timeout` seconds.  Files that turn out not to
+    exist are remembered too, but only for `missing_timeout` seconds, since
+    another process may be about to store them.
+    """
+    def __init__(self, domain, trackers, pool_size=8, path_cache_size=10000,
+            path_timeout=300, missing_timeout=10):
+        self.domain = domain
+        self.trackers = trackers
+        self.pool_size = pool_size
+        self._idle = Queue.LifoQueue()
+
+        self.paths = MemoryCache(
+            max_items=path_cache_size, timeout=path_timeout)
+        self.missing = MemoryCache(
+            max_items=path_cache_size, timeout=missing_timeout)
+
+    @contextmanager
+    def client(self):
+        """Lends out a client.  If anything goes wrong while it's borrowed,
+        its connection can't be trusted, so it's thrown away.
+        """
+        try:
+            client = self._idle.get_nowait()
+        except Queue.Empty:
+            client = pymogile.Client(domain=self.domain, trackers=self.trackers)
+
+        yield client
+
+        if self._idle.qsize() < self.pool_size:
+            self._idle.put(client)
+
+    def get_paths(self, idents):
+        """Returns a dict mapping each of `idents` to a list of its paths,
+        which is empty if the file doesn't exist.  Only asks the tracker about
+        files it doesn't already know about, all over one connection.
+        """
+        result = {}
+        unknown = []
+        for ident in idents:
+            paths = self.paths.get(ident)
+            if paths is not None:
+                result[ident] = paths
+            elif self.missing.get(ident):
+                result[ident] = []
+            else:
+                unknown.append(ident)
+
+        if unknown:
+            with self.client() as client:
+                for ident in unknown:
+                    try:
+                        paths = client.get_paths(ident, pathcount=1)
+                    except pymogile.MogileFSError as e:
+                        if e.err != 'unknown_key':
+                            raise
+                        paths = []
+
+                    if paths:
+                        self.paths.set(ident, paths)
+                    else:
+                        self.missing.set(ident, True)
+                    result[ident] = paths
+
+        return result
+
+    def forget(self, ident):
+        """Forgets what's known about a file, e.g. because it's just been
+        stored."""
+        self.paths.delete(ident)
+        self.missing.delete(ident)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_tracker_pool(domain, trackers, **kwargs):
+    """Returns the process-wide :class:`TrackerPool` for the given domain and
+    trackers, creating it with `kwargs` if necessary."""
+    pool_key = domain, tuple(trackers)
+    with _pools_lock:
+        if pool_key not in _pools:
+            _pools[pool_key] = TrackerPool(domain, trackers, **kwargs)
+        return _pools[pool_key]
+
+
 class FileStorage(BaseFileStorage):
     """FileStorage data manager using MogileFS as a backend.
 
@@ -23,22 +126,34 @@ class FileStorage(BaseFileStorage):
     Note that :meth:`url` cannot know the URL to a newly :meth`put` file until
     the transaction has been commited.
 
+    Connections and paths are shared with the rest of the process; see
+    :class:`TrackerPool` for the meaning of the optional settings.
+
     """
-    def __init__(self, transaction_manager, domain, trackers, **kwargs):
+    def __init__(self, transaction_manager, domain, trackers, pool_size=8,
+            path_cache_size=10000, path_timeout=300, missing_timeout=10,
+            **kwargs):
         super(FileStorage, self).__init__(transaction_manager, **kwargs)
 
-        trackers = trackers.split()
-        self.client = pymogile.Client(domain=domain, trackers=trackers)
+        self.pool = get_tracker_pool(
+            domain, trackers.split(),
+            pool_size=int(pool_size),
+            path_cache_size=int(path_cache_size),
+            path_timeout=int(path_timeout),
+            missing_timeout=int(missing_timeout),
+        )
         self.temp = []
 
-    def url(self, class_, key):
-        ident = self._identifier(class_, key)
-        paths = self.client.get_paths(ident, pathcount=1)
+    def url(self, class_, key, content_type=None, disposition=None):
+        return self.urls(class_, [key])[key]
+
+    def urls(self, class_, keys, content_type=None):
+        idents = dict((self._identifier(class_, key), key) for key in keys)
+        paths = self.pool.get_paths(idents.keys())
 
-        if paths:
-            return paths[0]
-        else:
-            return None
+        return dict(
+            (key, paths[ident][0] if paths[ident] else None)
+            for ident, key in idents.iteritems())
 
     def _identifier(self, class_, key):
         """Use class:key as the identifier within mogile."""
@@ -56,15 +171,17 @@ class FileStorage(BaseFileStorage):
 
     def commit(self, transaction):
         """Stores the staged files in MogileFS under a temporary name."""
-        for class_, key, stageobj in self.stage.itervalues():
+        for class_, key, path in self.stage.itervalues():
             ident = self._identifier(class_, key)
             # XXX: This rand is probably unnecessary
             rand = uuid.uuid4().hex
             tempident = u':'.join(('__temp__', ident, rand))
             self.temp.append((ident, tempident))
             # Can't use store_file here; it very rudely closes the file when it's done
-            with self.client.new_file(tempident, cls=class_) as f:
-                shutil.copyfileobj(stageobj, f)
+            with open(path, 'rb') as stagefile:
+                with self.pool.client() as client:
+                    with client.new_file(tempident, cls=class_) as f:
+                        shutil.copyfileobj(stagefile, f)
 
     def tpc_vote(self, transaction):
         pass
@@ -78,15 +195,18 @@ class FileStorage(BaseFileStorage):
         failing as low as practical.
 
         """
-        for ident, tempident in self.temp:
-            self.client.rename(tempident, ident)
+        with self.pool.client() as client:
+            for ident, tempident in self.temp:
+                client.rename(tempident, ident)
+                self.pool.forget(ident)
         self._finish()
 
     def tpc_abort(self, transaction):
         """Deletes any temporary files stored to MogileFS, if possible."""
         for ident, tempident in self.temp:
             try:
-                self.client.delete(tempident)
+                with self.pool.client() as client:
+                    client.delete(tempident)
             except:
                 log.error("Failed to delete orphaned file '{0}' "
                           "during transaction abort".format(tempident))
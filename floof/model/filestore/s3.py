@@ -0,0 +1,236 @@
+"""Store files in Amazon S3, or any other object store that speaks its API.
+
+Files are uploaded to a temporary key during the commit, then copied to their
+real key in :meth:`FileStorage.tpc_finish`; S3 has no rename.  Big files are
+sent as multipart uploads, several parts at a time.
+
+S3 connections keep a pool of HTTP connections, so one connection is shared
+by every storage in the process with the same settings.
+
+:meth:`FileStorage.url` returns presigned URLs (or plain ones, for public
+buckets), which clients can be sent to directly, so the app doesn't have to
+pass the file through itself.  Files are uploaded from extensionless temporary
+files, so S3 only knows them as `application/octet-stream`; the URLs ask S3 to
+send the right Content-Type and Content-Disposition instead.
+
+The tests run against the fake server in `floof.tests.s3_server`, unless the
+test config sets up a real one.
+"""
+
+from __future__ import absolute_import
+
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import uuid
+
+import boto
+from boto.exception import S3ResponseError
+from boto.s3.connection import OrdinaryCallingFormat
+from pyramid.settings import asbool
+
+from floof.model.filestore import FileStorage as BaseFileStorage
+
+log = logging.getLogger(__name__)
+
+MiB = 2 ** 20
+
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def get_connection(access_key, secret_key, host, port, is_secure):
+    """Returns the process-wide S3 connection with the given settings.  Set
+    `host` to use something other than Amazon."""
+    connection_key = access_key, host, port, is_secure
+    with _connections_lock:
+        if connection_key not in _connections:
+            kwargs = {}
+            if host:
+                # Other servers rarely do bucket subdomains
+                kwargs['host'] = host
+                kwargs['calling_format'] = OrdinaryCallingFormat()
+            _connections[connection_key] = boto.connect_s3(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                port=port,
+                is_secure=is_secure,
+                **kwargs)
+        return _connections[connection_key]
+
+
+def split_parts(size, part_size):
+    """Returns a list of (part number, offset, length) for a multipart upload
+    of a file of `size` bytes.  Part numbers start at 1."""
+    return [
+        (number, offset, min(part_size, size - offset))
+        for number, offset in enumerate(xrange(0, size, part_size), 1)]
+
+
+def completion_xml(etags):
+    """Returns the body of the request to complete a multipart upload, given
+    a list of (part number, ETag)."""
+    parts = [
+        u'<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(
+            number, etag)
+        for number, etag in etags]
+    return u'<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'.format(
+        u''.join(parts))
+
+
+class FileStorage(BaseFileStorage):
+    """FileStorage data manager using an S3 bucket as a backend.
+
+    This class tries hard to follow the Zope transaction manager interface,
+    where :meth:`tpc_finish` should always succeed and only be reached if we
+    are very confident that it will do so.
+
+    Settings, all optional except `bucket`:
+
+    `access_key`, `secret_key`
+        Credentials.  If omitted, boto looks in the environment and its own
+        config files.
+    `host`, `port`, `is_secure`
+        Where the S3-compatible server is, if it isn't Amazon.
+    `prefix`
+        Prepended to every key in the bucket.
+    `public`
+        If true, :meth:`url` returns plain URLs instead of presigned ones.
+        S3 only overrides response headers for signed requests, though, so
+        URLs given a content type or disposition are signed regardless.
+    `url_expiry`
+        How long presigned URLs last, in seconds.  Make it comfortably longer
+        than `filestore_cache.timeout`, which holds on to them.
+    `multipart_threshold`, `part_size`
+        Files of at least `multipart_threshold` MiB are uploaded in parts of
+        `part_size` MiB (at least 5, by S3's rules).
+    `upload_threads`
+        Parts of one file uploaded at once.
+    """
+    redirect = True
+
+    def __init__(self, transaction_manager, bucket, access_key=None,
+            secret_key=None, host=None, port=None, is_secure='true',
+            prefix=u'', public='false', url_expiry=86400,
+            multipart_threshold=16, part_size=8, upload_threads=4, **kwargs):
+        super(FileStorage, self).__init__(transaction_manager, **kwargs)
+
+        connection = get_connection(
+            access_key, secret_key, host,
+            int(port) if port else None, asbool(is_secure))
+        self.bucket = connection.get_bucket(bucket, validate=False)
+
+        self.prefix = prefix
+        self.public = asbool(public)
+        self.url_expiry = int(url_expiry)
+        self.multipart_threshold = int(multipart_threshold) * MiB
+        self.part_size = int(part_size) * MiB
+        self.upload_threads = int(upload_threads)
+        self.temp = []
+
+    def _key_name(self, class_, key):
+        """Use prefix/class/key as the key name within the bucket."""
+        return u'{0}{1}/{2}'.format(self.prefix, class_, key)
+
+    def _signed_url(self, key_name, content_type=None, disposition=None):
+        # Signing happens right here; it doesn't need S3
+        response_headers = {}
+        if content_type:
+            response_headers['response-content-type'] = content_type
+        if disposition:
+            response_headers['response-content-disposition'] = disposition
+
+        return self.bucket.new_key(key_name).generate_url(
+            expires_in=self.url_expiry,
+            query_auth=not self.public or bool(response_headers),
+            response_headers=response_headers or None)
+
+    def url(self, class_, key, content_type=None, disposition=None):
+        key_name = self._key_name(class_, key)
+        if self.bucket.get_key(key_name) is None:
+            return None
+        return self._signed_url(key_name, content_type, disposition)
+
+    def urls(self, class_, keys, content_type=None):
+        """Unlike :meth:`url`, doesn't check with S3 that the files exist,
+        which would take a request apiece.  Only ask about files the database
+        says are stored, like renditions it has rows for -- as
+        :func:`floof.lib.fileinfo.warm` does.
+        """
+        return dict(
+            (key, self._signed_url(self._key_name(class_, key), content_type))
+            for key in keys)
+
+    def _upload(self, key_name, path):
+        size = os.path.getsize(path)
+        if size < self.multipart_threshold:
+            self.bucket.new_key(key_name).set_contents_from_filename(path)
+            return
+
+        upload = self.bucket.initiate_multipart_upload(key_name)
+
+        def upload_part(part):
+            number, offset, length = part
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                s3_key = upload.upload_part_from_file(f, number, size=length)
+            return number, s3_key.etag
+
+        pool = ThreadPool(self.upload_threads)
+        try:
+            etags = pool.map(upload_part, split_parts(size, self.part_size))
+
+            # Send the part list ourselves, rather than have boto ask S3 for
+            # it first
+            self.bucket.complete_multipart_upload(
+                key_name, upload.id, completion_xml(etags))
+        except:
+            upload.cancel_upload()
+            raise
+        finally:
+            pool.close()
+
+    def _finish(self):
+        self.temp = []
+        super(FileStorage, self)._finish()
+
+    def abort(self, transaction):
+        self._finish()
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        """Uploads the staged files under temporary keys."""
+        for class_, key, path in self.stage.itervalues():
+            key_name = self._key_name(class_, key)
+            temp_name = u'{0}__temp__/{1}/{2}/{3}'.format(
+                self.prefix, class_, key, uuid.uuid4().hex)
+            self.temp.append((key_name, temp_name))
+            self._upload(temp_name, path)
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        """Copies the temporary keys written in :meth:`commit` to their final
+        names, and deletes them.  The copy happens entirely within S3."""
+        for key_name, temp_name in self.temp:
+            self.bucket.copy_key(key_name, self.bucket.name, temp_name)
+            try:
+                self.bucket.delete_key(temp_name)
+            except S3ResponseError:
+                log.error("Failed to delete temporary key '{0}'"
+                          .format(temp_name))
+        self._finish()
+
+    def tpc_abort(self, transaction):
+        """Deletes any temporary keys uploaded, if possible."""
+        for key_name, temp_name in self.temp:
+            try:
+                self.bucket.delete_key(temp_name)
+            except:
+                log.error("Failed to delete orphaned key '{0}' "
+                          "during transaction abort".format(temp_name))
+        self._finish()
@@ -0,0 +1,146 @@
+"""Local file storage for lots of files.
+
+Plain local storage puts each file under ``class/k/e/y/key``, one character
+per directory, so with millions of files the leaf directories get enormous.
+This storage shards keys `depth` levels deep, `width` characters per level;
+with hex keys, each level fans out into 16 ** `width` directories.  The
+default, two levels of two characters, gives ``class/ke/y0/key0123...``.
+
+An existing store can be moved to a new layout in place with :func:`reshard`
+(or the `bin/reshard-filestore.py` script).  Plain local storage's layout is
+the same as this one's with a depth of 3 and a width of 1.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+
+from floof.model.filestore.local import FileStorage as LocalFileStorage
+
+log = logging.getLogger(__name__)
+
+# Directories this process has seen or made, so they needn't be checked again.
+# Nothing ever deletes a shard directory out from under a running app
+_known_directories = set()
+
+
+def shard_path(directory, class_, key, depth, width):
+    """Returns where the file with the given `class_` and `key` belongs, in a
+    store at `directory` sharded `depth` levels deep by `width` characters.
+    Short keys are padded with underscores.
+    """
+    long_key = key + u'_' * (depth * width)
+    shards = [long_key[n * width:(n + 1) * width] for n in xrange(depth)]
+    return os.path.join(directory, class_, *(shards + [key]))
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileStorage(LocalFileStorage):
+    """FileStorage data manager using local files as a backend, sharded
+    `depth` levels deep by `width` characters per level.
+
+    Staged files already live on the same filesystem, in ``__temp__``, so
+    :meth:`tpc_finish` only has to rename them into place.  Each directory
+    that gained a file is then fsynced, once per transaction, so the renames
+    survive a crash.
+    """
+    def __init__(self, transaction_manager, directory, depth=2, width=2,
+            **kwargs):
+        super(FileStorage, self).__init__(
+            transaction_manager, directory, **kwargs)
+
+        self.depth = int(depth)
+        self.width = int(width)
+        if self.depth < 0 or self.width < 1:
+            raise ValueError("filestore.depth must be at least 0 and "
+                             "filestore.width at least 1")
+
+    def _path(self, prefix, class_, key):
+        return shard_path(prefix, class_, key, self.depth, self.width)
+
+    def _destination_directories(self):
+        return set(
+            os.path.dirname(self._path(self.directory, class_, key))
+            for class_, key, path in self.stage.itervalues())
+
+    def tpc_vote(self, transaction):
+        """Check that the destination directories exist and are writeable."""
+
+        for destdir in self._destination_directories():
+            writeable = os.access(destdir, os.W_OK | os.X_OK)
+            if not writeable and destdir in _known_directories:
+                # Must have been deleted after all; check again
+                _known_directories.discard(destdir)
+
+            if destdir not in _known_directories:
+                if not os.path.isdir(destdir):
+                    try:
+                        os.makedirs(destdir)
+                    except OSError:
+                        # Another process might have beaten us to it
+                        if not os.path.isdir(destdir):
+                            raise
+                    writeable = os.access(destdir, os.W_OK | os.X_OK)
+                _known_directories.add(destdir)
+
+            if not writeable:
+                raise IOError("Cannot traverse or cannot write to destination "
+                              "directory '{0}'.".format(destdir))
+
+    def tpc_finish(self, transaction):
+        """Rename the staged files into their final location, then make sure
+        the renames hit the disk."""
+
+        for class_, key, path in self.stage.itervalues():
+            os.rename(path, self._path(self.directory, class_, key))
+
+        for destdir in self._destination_directories():
+            try:
+                _fsync_directory(destdir)
+            except OSError:
+                log.error("Failed to fsync directory '{0}'".format(destdir))
+
+        self._finish()
+
+
+def reshard(directory, depth, width):
+    """Moves every file in the store at `directory` to where a store sharded
+    `depth` levels deep by `width` characters expects it, and removes the
+    directories left empty.  Returns the number of files moved.
+
+    Files are identified only by their class (the top-level directory) and
+    key (their filename), so this works from any layout, and is safe to run
+    again if interrupted.  Don't run it while the app is writing files.
+    """
+    moved = 0
+    for class_ in sorted(os.listdir(directory)):
+        class_dir = os.path.join(directory, class_)
+        if class_ == u'__temp__' or not os.path.isdir(class_dir):
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(class_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                destpath = shard_path(directory, class_, filename, depth, width)
+                if path == destpath:
+                    continue
+
+                destdir = os.path.dirname(destpath)
+                if not os.path.isdir(destdir):
+                    os.makedirs(destdir)
+                os.rename(path, destpath)
+                moved += 1
+
+        # Clear out the old shards, deepest first
+        for dirpath, dirnames, filenames in os.walk(class_dir, topdown=False):
+            if dirpath != class_dir and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+    return moved
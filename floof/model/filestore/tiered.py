@@ -0,0 +1,365 @@
+"""Keep copies of files from a slow storage in a fast local directory.
+
+This storage wraps another one, the "primary", which holds every file and
+does all the transactional work.  Files it's asked about are copied into a
+local cache directory (on an SSD, say) and served from there from then on.
+The cache is kept under a size budget by throwing out the files that were
+used least recently.
+
+How each class of file is cached is up to its policy:
+
+`always`
+    Copied into the cache when stored, as part of the commit, and whenever
+    it's missing.  Good for thumbnails, which are read constantly.
+`demand`
+    Only copied into the cache when it's asked for individually.  Good for
+    originals, which are read rarely but are big.
+`never`
+    Left alone.
+
+Configure it with the primary's settings under `filestore.primary`, e.g.::
+
+    filestore = tiered
+    filestore.primary = mogilefs
+    filestore.primary.trackers = localhost:7001
+    filestore.primary.domain = floof
+    filestore.directory = /ssd/floof-cache
+    filestore.max_size = 10240
+    filestore.policy = demand
+    filestore.policy.thumbnail = always
+"""
+
+from __future__ import absolute_import
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import urllib2
+
+from floof.model.filestore import FileStorage as BaseFileStorage
+from floof.model.filestore import get_storage_factory
+from floof.model.filestore.sharded import shard_path
+
+log = logging.getLogger(__name__)
+
+MiB = 2 ** 20
+
+POLICIES = (u'always', u'demand', u'never')
+
+
+class CacheDirectory(object):
+    """A directory of files, kept under `max_size` bytes.
+
+    The size is tallied as files are added.  Walking the whole directory is
+    too slow to do while someone waits, so the true size is only found by a
+    sweep in a background thread: once when the first file is added, and
+    again whenever the tally goes over, since other processes will have been
+    adding files too.  A sweep deletes the least recently used files until
+    the size is down to `low_water` of the budget.  Files are "used" when
+    their access time is touched with :meth:`touch`.
+    """
+    low_water = 0.9
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.tempdir = os.path.join(directory, '__temp__')
+        self.max_size = max_size
+        self._size = None
+        # The running sweep thread, if any
+        self._sweeper = None
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.tempdir):
+            try:
+                os.makedirs(self.tempdir)
+            except OSError:
+                if not os.path.isdir(self.tempdir):
+                    raise
+
+    def path(self, class_, key):
+        return shard_path(self.directory, class_, key, 2, 2)
+
+    @staticmethod
+    def touch(path):
+        """Marks a cached file as just used.  Returns False if it isn't there
+        after all."""
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def _scan(self):
+        """Returns a list of (atime, size, path) for every cached file."""
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            if dirpath == self.directory:
+                dirnames[:] = [name for name in dirnames if name != '__temp__']
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_atime, stat.st_size, path))
+        return files
+
+    def add(self, class_, key, temppath):
+        """Moves the file at `temppath`, which should be in `tempdir`, into
+        the cache, then has room made in the background if necessary."""
+        path = self.path(class_, key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        size = os.path.getsize(temppath)
+        os.rename(temppath, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._sweeper is not None or (
+                    self._size is not None and self._size <= self.max_size):
+                return
+
+            self._sweeper = threading.Thread(target=self._sweep)
+            self._sweeper.daemon = True
+        self._sweeper.start()
+
+    def _sweep(self):
+        try:
+            self.sweep()
+        except Exception:
+            log.exception("Failed to sweep {0}".format(self.directory))
+        finally:
+            with self._lock:
+                self._sweeper = None
+
+    def sweep(self):
+        """Tallies up the cache's true size, and evicts the least recently
+        used files if it's over budget.  Slow!"""
+        files = sorted(self._scan())
+        size = sum(size for atime, size, path in files)
+        target = self.max_size * self.low_water
+
+        if size > self.max_size:
+            for atime, file_size, path in files:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Someone else got it first
+                    continue
+                size -= file_size
+
+        with self._lock:
+            self._size = size
+
+    def fetch(self, class_, key, url):
+        """Copies the file at `url` into the cache.  Returns its path in the
+        cache, or None if it couldn't be fetched."""
+        fd, temppath = tempfile.mkstemp(dir=self.tempdir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                source = urllib2.urlopen(url)
+                try:
+                    shutil.copyfileobj(source, f, 512 * 1024)
+                finally:
+                    source.close()
+            self.add(class_, key, temppath)
+        except (IOError, OSError) as e:
+            log.error("Failed to cache {0}:{1}: {2}".format(class_, key, e))
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            return None
+
+        return self.path(class_, key)
+
+
+_caches = {}
+_factories = {}
+_lock = threading.Lock()
+
+def _shared(directory, max_size, primary_settings):
+    """Returns the process-wide cache directory and primary storage factory
+    for these settings."""
+    primary_key = tuple(sorted(primary_settings.iteritems()))
+    with _lock:
+        if directory not in _caches:
+            _caches[directory] = CacheDirectory(directory, max_size)
+        if primary_key not in _factories:
+            _factories[primary_key] = get_storage_factory(
+                primary_settings, prefix='primary')
+        return _caches[directory], _factories[primary_key]
+
+
+class FileStorage(BaseFileStorage):
+    """FileStorage data manager that passes everything through to a primary
+    storage, keeping copies of files in a local cache `directory` of at most
+    `max_size` MiB.
+
+    Writes go only to the primary, in the two-phase commit; files whose
+    class has the `always` policy are also copied into the cache, once the
+    primary has them for sure.
+    """
+    def __init__(self, transaction_manager, directory, max_size=1024,
+            policy=u'demand', **kwargs):
+        primary_settings = {}
+        policies = {}
+        for key, value in kwargs.iteritems():
+            if key == 'primary' or key.startswith('primary.'):
+                primary_settings[key] = value
+            elif key.startswith('policy.'):
+                policies[key[len('policy.'):]] = value
+
+        # Not calling the base constructor: the stage belongs to the primary
+        self.transaction_manager = transaction_manager
+
+        for value in [policy] + policies.values():
+            if value not in POLICIES:
+                raise ValueError("Unknown filestore cache policy '{0}'"
+                                 .format(value))
+        self.default_policy = policy
+        self.policies = policies
+
+        self.cache, primary_factory = _shared(
+            directory, int(max_size) * MiB, primary_settings)
+        self.primary = primary_factory()
+        self.cache_temp = []
+
+    def policy(self, class_):
+        return self.policies.get(class_, self.default_policy)
+
+    ### Staging is entirely the primary's business
+
+    @property
+    def stage(self):
+        return self.primary.stage
+
+    @property
+    def tempdir(self):
+        return self.primary.tempdir
+
+    def put(self, class_, key, fileobj):
+        self.primary.put(class_, key, fileobj)
+
+    def put_path(self, class_, key, path):
+        self.primary.put_path(class_, key, path)
+
+    def _idx(self, class_, key):
+        return self.primary._idx(class_, key)
+
+    def sortKey(self):
+        return self.primary.sortKey()
+
+    ### Reading
+
+    def _cached_url(self, class_, key):
+        path = self.cache.path(class_, key)
+        if self.cache.touch(path):
+            return 'file://' + path.encode('utf8')
+        return None
+
+    @classmethod
+    def check_url(cls, url):
+        """Cached copies can be evicted while their URLs are remembered
+        elsewhere, so make sure they're still there; and using one counts as
+        using it, as far as eviction is concerned."""
+        if not url.startswith('file://'):
+            return True
+        return CacheDirectory.touch(url[len('file://'):])
+
+    def url(self, class_, key, content_type=None, disposition=None):
+        if self.policy(class_) == u'never':
+            return self.primary.url(class_, key, content_type, disposition)
+
+        url = self._cached_url(class_, key)
+        if url:
+            return url
+
+        url = self.primary.url(class_, key, content_type, disposition)
+        if not url:
+            return None
+
+        path = self.cache.fetch(class_, key, url)
+        if path:
+            return 'file://' + path.encode('utf8')
+        return url
+
+    def urls(self, class_, keys, content_type=None):
+        """Only fetches missing files with the `always` policy; others are
+        too big to fetch several at once."""
+        policy = self.policy(class_)
+        if policy == u'never':
+            return self.primary.urls(class_, keys, content_type)
+
+        urls = dict((key, self._cached_url(class_, key)) for key in keys)
+        missing = [key for key, url in urls.iteritems() if not url]
+        if not missing:
+            return urls
+
+        urls.update(self.primary.urls(class_, missing, content_type))
+        if policy == u'always':
+            for key in missing:
+                if urls[key]:
+                    path = self.cache.fetch(class_, key, urls[key])
+                    if path:
+                        urls[key] = 'file://' + path.encode('utf8')
+
+        return urls
+
+    ### Transaction protocol
+
+    def _clear_cache_temp(self):
+        for class_, key, temppath in self.cache_temp:
+            self._remove_stagefile(temppath)
+        self.cache_temp = []
+
+    def abort(self, transaction):
+        self.primary.abort(transaction)
+        self._clear_cache_temp()
+
+    def tpc_begin(self, transaction):
+        self.primary.tpc_begin(transaction)
+
+    def commit(self, transaction):
+        """Copies staged files that should always be cached, while they're
+        still around, then has the primary commit."""
+        for class_, key, path in self.primary.stage.itervalues():
+            if self.policy(class_) != u'always':
+                continue
+
+            fd, temppath = tempfile.mkstemp(dir=self.cache.tempdir)
+            self.cache_temp.append((class_, key, temppath))
+            with os.fdopen(fd, 'wb') as cachefile:
+                with open(path, 'rb') as stagefile:
+                    shutil.copyfileobj(stagefile, cachefile)
+
+        self.primary.commit(transaction)
+
+    def tpc_vote(self, transaction):
+        self.primary.tpc_vote(transaction)
+
+    def tpc_finish(self, transaction):
+        """Lets the primary finish, then moves the copies into the cache.
+        Failing to cache is no reason to fail."""
+        self.primary.tpc_finish(transaction)
+
+        for class_, key, temppath in self.cache_temp:
+            try:
+                self.cache.add(class_, key, temppath)
+            except (IOError, OSError) as e:
+                log.error("Failed to cache {0}:{1}: {2}"
+                          .format(class_, key, e))
+        self._clear_cache_temp()
+
+    def tpc_abort(self, transaction):
+        self.primary.tpc_abort(transaction)
+        self._clear_cache_temp()
@@ -88,6 +88,7 @@ def configure_routing(config):
     r('art.add_tags', r'/art/{id:\d+}/add_tags', **kw)
     r('art.remove_tags', r'/art/{id:\d+}/remove_tags', **kw)
     r('art.rate', r'/art/{id:\d+}/rate', **kw)
+    r('api:art.rate', '/art/rate.json')
 
     # Tags
     # XXX what should the tag name regex be, if anything?
@@ -97,12 +98,17 @@ def configure_routing(config):
     r('tags.view', '/tags/{name}', **kw)
     r('tags.artwork', '/tags/{name}/artwork', **kw)
 
+    r('api:tags.list', '/tags.json')
+
     # Albums
     # XXX well this is getting complicated!  needs to check user, needs to check id, needs to generate correctly, needs a title like art has
     user_router = SugarRouter(config, '/users/{user}', model.User.name)
     album_router = user_router.chain('/albums/{album}', model.Album.id, rel=model.Album.user)
     album_router.add_route('albums.artwork', '')
 
+    # Search
+    r('api:search', '/search.json')
+
     # Administration
     r('admin.dashboard', '/admin')
     r('admin.log', '/admin/log')
@@ -181,6 +187,7 @@ def configure_routing(config):
     r('comments.view', '/{type}/{identifier}/comments/{comment_id}', factory=comments_factory, pregenerator=comments_pregenerator)
     r('comments.edit', '/{type}/{identifier}/comments/{comment_id}/edit', factory=comments_factory, pregenerator=comments_pregenerator)
     r('comments.reply', '/{type}/{identifier}/comments/{comment_id}/write', factory=comments_factory, pregenerator=comments_pregenerator)
+    r('comments.replies', '/{type}/{identifier}/comments/{comment_id}/replies', factory=comments_factory, pregenerator=comments_pregenerator)
 
 class SugarRouter(object):
     """Glues routing to the ORM.
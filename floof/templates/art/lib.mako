@@ -1,6 +1,8 @@
 <%namespace name="lib" file="/lib.mako" />
 
 <%!
+from floof.lib import fileinfo
+
 def media_icon(type):
     """Determine the icon that should be used for an artwork.
 
@@ -86,7 +88,19 @@ def media_icon(type):
             <img src="${request.route_url('filestore', class_=u'thumbnail', key=artwork.hash)}" alt="">
         </a>
     </td>
-    <td><a href="${request.route_url('art.view', artwork=artwork)}">${artwork.title}</a></td>
+    <td>
+        <a href="${request.route_url('art.view', artwork=artwork)}">${artwork.title}</a> <br>
+        ${lib.icon('disk', alt='Uploader:')} ${lib.user_link(artwork.uploader)}
+        % for user_artwork in artwork.user_artwork:
+        ${lib.icon('paint-brush', alt='Artist:')} ${lib.user_link(user_artwork.user)}
+        % endfor
+        % if artwork.tag_objs:
+        <br>
+        % for tag in artwork.tag_objs:
+        <a href="${request.route_url('tags.artwork', tag=tag)}">${tag.name}</a>
+        % endfor
+        % endif
+    </td>
     <td>
         Comments: ${artwork.discussion.comment_count} <br>
         Ratings: ${artwork.rating_count}
@@ -108,8 +122,30 @@ def media_icon(type):
     )
 %>\
 <%def name="render_gallery_sieve(gallery_sieve, filters_open=False)">
+## Anonymous users all see the same thing, so their galleries are cached
+<%
+    gallery_cache = request.registry.settings.get('gallery_fragment_cache')
+    cache_key = None
+    fragment = None
+    if gallery_cache is not None and not request.user:
+        cache_key = gallery_sieve.cache_key(request.path_url)
+    if cache_key is not None:
+        fragment = gallery_cache.get(cache_key)
+    if fragment is None:
+        fragment = capture(_render_gallery_sieve, gallery_sieve)
+        if cache_key is not None:
+            gallery_cache.set(cache_key, fragment)
+%>\
+${fragment | n}
+</%def>
+
+<%def name="_render_gallery_sieve(gallery_sieve)">
 ${gallery_sieve_form(gallery_sieve.form)}
-<% pager = gallery_sieve.evaluate() %>\
+<%
+    pager = gallery_sieve.evaluate()
+    # Look up every thumbnail at once, rather than one request at a time
+    fileinfo.warm(request, u'thumbnail', pager.items)
+%>\
 
 % if not pager.items:
 <p>Nothing found.</p>
@@ -122,9 +158,9 @@ ${detailed_table(pager)}
 % endif
 
 % if pager.pager_type == 'discrete':
-${lib.discrete_pager(pager, temporal_column_name=gallery_sieve.temporal_column_name)}
-% elif pager.pager_type == 'temporal':
-${lib.temporal_pager(pager)}
+${lib.discrete_pager(pager)}
+% elif pager.pager_type == 'keyset':
+${lib.keyset_pager(pager)}
 % endif
 </%def>
 
@@ -135,6 +171,7 @@ ${lib.temporal_pager(pager)}
     <div class="column">
         <dl class="horizontal">
             ${lib.field(form.tags)}
+            ${lib.field(form.text)}
             ${lib.field(form.time_radius)}
             % if request.user:
             ## Don't show a user-specific field for a non-user
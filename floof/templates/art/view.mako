@@ -7,6 +7,7 @@
 <%def name="script_dependencies()">
     ${h.javascript_link(request.static_url('floof:assets/js/vendor/jquery.ui-1.8.7.js'))}
     ${h.javascript_link(request.static_url('floof:assets/js/widget/rater.js'))}
+    ${h.javascript_link(request.static_url('floof:assets/js/widget/comment_replies.js'))}
 </%def>
 
 <section class="neutral-background">
@@ -15,9 +16,22 @@
     ${artwork.title or 'Untitled'}
 </h1>
 
-## Ye art itself
+## Ye art itself.  Big images get a smaller preview, linking to the original
+<%
+    original_url = request.route_url('filestore', class_=u'artwork', key=artwork.hash)
+    preview = request.registry.settings['renditions'].get(u'medium')
+    if preview and (artwork.media_type != u'image'
+            or max(artwork.width, artwork.height) <= preview.size):
+        preview = None
+%>\
 <div class="artwork">
-    <img src="${request.route_url('filestore', class_=u'artwork', key=artwork.hash)}" alt="">
+    % if preview:
+    <a href="${original_url}">
+        <img src="${request.route_url('filestore', class_=preview.name, key=artwork.hash)}" alt="">
+    </a>
+    % else:
+    <img src="${original_url}" alt="">
+    % endif
 </div>
 
 ## Metadata and whatever
@@ -121,6 +135,11 @@
     </ul>
 
 
+    % if similar_artwork:
+    <h1>Art like this</h1>
+    ${artlib.thumbnail_grid(similar_artwork)}
+    % endif
+
     % if artwork.remark:
     <h1>Remarks</h1>
     <div class="content rich-text">${h.render_rich_text(artwork.remark)}</div>
@@ -146,12 +165,12 @@
 
 <section>
     ## Comments
-    <% comments = artwork.discussion.comments %>\
+    <% comment_count = artwork.discussion.comment_count %>\
     <h1>
         ${lib.icon('balloons-white')}
-        ${len(comments)} comment${'' if len(comments) == 1 else 's'}
+        ${comment_count} comment${'' if comment_count == 1 else 's'}
     </h1>
-    ${comments_lib.comment_tree(comments)}
+    ${comments_lib.comment_page(comment_page)}
 
     % if request.user.can('comments.add', request.context):
     <section>
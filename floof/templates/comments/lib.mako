@@ -1,12 +1,17 @@
 <%namespace name="lib" file="/lib.mako" />
 
-## Render a single comment object
-<%def name="single_comment(comment)">
+## Render a single comment object.  `can_edit` may be given if it's already
+## known whether the current user can edit it
+<%def name="single_comment(comment, can_edit=None)">
+<%
+    if can_edit is None:
+        can_edit = request.user.can('comment.edit', comment)
+%>\
 <div class="comment" id="comment-${comment.id}">
     <div class="avatar">${lib.avatar(comment.author)}</div>
     <div class="header">
         <ul class="links">
-            % if request.user.can('comment.edit', comment):
+            % if can_edit:
                 <li><a href="${request.route_url('comments.edit', comment=comment, _anchor='comment')}">Edit</a></li>
             % endif
             <li><a href="${request.route_url('comments.reply', comment=comment, _anchor='comment')}">Reply</a></li>
@@ -15,48 +20,83 @@
         ${lib.user_link(comment.author)}
         at ${lib.time(comment.posted_time)}
     </div>
-    <div class="content rich-text">${h.render_rich_text(comment.content)}</div>
+    <div class="content rich-text">${h.render_comment(comment)}</div>
+</div>
+</%def>
+
+
+## Placeholder for replies left out of a thread, which the JS in
+## comment_replies.js swaps for the real thing
+<%def name="hidden_replies(comment, count)">
+<div class="comment-child js-comment-replies" data-replies-url="${request.route_url('comments.replies', comment=comment)}">
+    <a href="${request.route_url('comments.view', comment=comment, _anchor='comment')}">
+        ${count} more repl${'y' if count == 1 else 'ies'}
+    </a>
 </div>
 </%def>
 
 
-## Render an iterable of comments, nesting appropriately as it goes
-<%def name="comment_tree(comments)">
+## Render an iterable of comments, nesting appropriately as it goes.  Replies
+## below any comment in `hidden_counts` are shown as a link to load them
+<%def name="comment_tree(comments, hidden_counts={})">
 <div class="discussion">
 <%
     last_comment = None
-    right_ancestry = []
+    ancestry = []
+
+    # Render whatever hasn't been yet all at once, rather than one at a time
+    # as the comments come up
+    h.render_comments(comments)
+
+    # Who can edit a comment depends only on who wrote it, so only check each
+    # author once
+    author_can_edit = {}
 %>\
 
     % for comment in comments:
     <%
-        # Indent by checking the current comment's left endpoint against
-        # potential parents' right endpoints.  If our left is less than their
-        # right, then this comment is still a descendent.
+        # Comments come in path order, so each one is either below the last
+        # one, or below one of its ancestors, or starts a new thread
 
         # If this comment is a child of the last, indent by a level
-        if last_comment and comment.left < last_comment.right:
+        if last_comment and comment.is_descendant_of(last_comment):
             context.write('<div class="comment-child">\n')
             # Remember current ancestory relevant to the root
-            right_ancestry.append(last_comment)
+            ancestry.append(last_comment)
 
         # Conversely, for every ancestor we just escaped, unindent by a level
-        while right_ancestry and comment.left > right_ancestry[-1].right:
+        while ancestry and not comment.is_descendant_of(ancestry[-1]):
             context.write('</div>\n')
-            right_ancestry.pop()
+            ancestry.pop()
 
         last_comment = comment
+
+        if comment.author_user_id not in author_can_edit:
+            author_can_edit[comment.author_user_id] = \
+                request.user.can('comment.edit', comment)
     %>\
 
-    ${single_comment(comment)}
+    ${single_comment(comment, author_can_edit[comment.author_user_id])}
+    % if hidden_counts.get(comment.id):
+    ${hidden_replies(comment, hidden_counts[comment.id])}
+    % endif
     % endfor
 
-    % for still_open_container in right_ancestry:
+    % for still_open_container in ancestry:
     </div>
     % endfor
 </div>
 </%def>
 
+
+## Render a page of a discussion's threads, from a CommentPage
+<%def name="comment_page(page)">
+${comment_tree(page.comments, page.hidden_counts)}
+% if page.pager.last_page:
+${lib.discrete_pager(page.pager)}
+% endif
+</%def>
+
 <%def name="write_form(form, resource, parent_comment=None)">
 <%lib:secure_form url="${request.route_url('comments.reply' if parent_comment else 'comments.write', resource=resource, comment=parent_comment)}">
 <p>${form.message(rows=25, cols=80)}</p>
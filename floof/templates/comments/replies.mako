@@ -0,0 +1,5 @@
+<%namespace name="comments_lib" file="/comments/lib.mako" />
+## The replies below a comment, in place of its hidden_replies placeholder
+<div class="comment-child">
+${comments_lib.comment_tree(comment_descendants, comment_hidden_counts)}
+</div>
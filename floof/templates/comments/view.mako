@@ -2,6 +2,10 @@
 <%namespace name="lib" file="/lib.mako" />
 <%namespace name="comments_lib" file="/comments/lib.mako" />
 
+<%def name="script_dependencies()">
+    ${h.javascript_link(request.static_url('floof:assets/js/widget/comment_replies.js'))}
+</%def>
+
 <%def name="title()">\
 Comments for: ${discussion.resource.member.resource_title}\
 </%def>
@@ -33,10 +37,14 @@ Comments for: ${discussion.resource.member.resource_title}\
         % if comment:
         Comment thread
         % else:
-        ${len(comment_descendants)} comment${'' if len(comment_descendants) == 1 else 's'}
+        ${discussion.comment_count} comment${'' if discussion.comment_count == 1 else 's'}
         % endif
     </h1>
-    ${comments_lib.comment_tree(comment_descendants)}
+    % if comment:
+    ${comments_lib.comment_tree(comment_descendants, comment_hidden_counts)}
+    % else:
+    ${comments_lib.comment_page(comment_page)}
+    % endif
 
     ## Only show this form if we're displaying ALL comments; otherwise it's not
     ## obviously attached to the current comment
@@ -141,10 +141,7 @@ ${h.end_form()}
 
 
 ## Rendering for lib.pager.Pager objects
-<%def name="discrete_pager(pager, temporal_column_name=None)">
-## When `temporal_column_name` is given, discrete pagers that have reached
-## their maximum allowed limit will switch to temporal pagers.  Used for
-## GallerySieve
+<%def name="discrete_pager(pager)">
 <ol class="pager">
 % if pager.current_page > 0:
     <li class="pager-first">
@@ -189,12 +186,6 @@ ${h.end_form()}
     </li>
     % endif
 % endfor
-% if temporal_column_name and pager.is_last_allowable_page:
-<li>
-    <a href="${h.update_params(request.path_url, \
-        **pager.formdata_for_temporal(temporal_column_name))}">More →</a>
-</li>
-% endif
 % if pager.next_item:
     <li class="pager-last">
         <a href="${h.update_params(request.path_url, **pager.formdata_for(int(pager.current_page + 1) * pager.page_size))}">
@@ -216,27 +207,31 @@ ${h.end_form()}
 </ol>
 </%def>
 
-<%def name="temporal_pager(pager)">
+<%def name="keyset_pager(pager)">
 <ol class="pager">
-    % if pager.timeskip:
-    <li>
-        <a href="${h.update_params(request.path_url, \
-            **pager.formdata_for(None))}">⇤ Newest</a>
+% if not pager.is_first_page:
+    <li class="pager-first">
+        <a href="${h.update_params(request.path_url, **pager.formdata_for_previous())}">
+            ←
+        </a>
     </li>
-    <li class="elided">…</li>
-    <li class="current">
-        ${time(pager.timeskip)}<br>
-        and earlier
+    <li class="pager-first">
+        <a href="${h.update_params(request.path_url, **pager.formdata_for_first())}">
+            ⇤
+        </a>
     </li>
-    % else:
-    <li>Newest</li>
-    % endif
-
-    % if not pager.is_last_page:
-    <li>
-        <a href="${h.update_params(request.path_url, \
-            **pager.formdata_for(pager.next_item_timeskip))}">More →</a>
+% else:
+    <li class="pager-first elided">←</li>
+    <li class="pager-first elided">⇤</li>
+% endif
+% if not pager.is_last_page:
+    <li class="pager-last">
+        <a href="${h.update_params(request.path_url, **pager.formdata_for_next())}">
+            →
+        </a>
     </li>
-    % endif
+% else:
+    <li class="pager-last elided">→</li>
+% endif
 </ol>
 </%def>
@@ -22,14 +22,15 @@ from paste.deploy import appconfig
 from pyramid import testing
 from pyramid.paster import get_app
 from pyramid.url import URLMethodsMixin
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from zope.sqlalchemy import ZopeTransactionExtension
 
 from floof.lib.setup import populate_db
 import floof.model
 from floof.routing import configure_routing
 
-__all__ = ['FunctionalTests', 'UnitTests']
+__all__ = ['FunctionalTests', 'QueryCounter', 'UnitTests']
 
 def _prepare_env():
     """Configure the floof model and set up a database the default entries."""
@@ -58,6 +59,28 @@ def test_get_settings():
     return settings
 
 
+_active_query_counters = []
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for counter in _active_query_counters:
+        counter.count += 1
+
+class QueryCounter(object):
+    """Counts the SQL statements executed, by any engine, within a `with`
+    block.  The total ends up in `count`.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        _active_query_counters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_query_counters.remove(self)
+
+
 class UnitTests(unittest.TestCase):
     """Brings up a lightweight db and threadlocal environment."""
 
@@ -1,7 +1,12 @@
+import json
 import os
+import shutil
+import tempfile
 
 from floof import model
-from floof.tests import FunctionalTests
+from floof.lib.comments import VISIBLE_DEPTH
+from floof.model.filestore import get_storage_factory
+from floof.tests import FunctionalTests, QueryCounter
 
 import floof.tests.sim as sim
 
@@ -58,6 +63,10 @@ class TestArt(FunctionalTests):
         assert art.length is None
         assert art.quality is None
 
+        # Thumbnailing is left to the derivative worker
+        assert [job.class_ for job in art.derivative_jobs] == [u'thumbnail']
+        assert art.derivative_jobs[0].state == u'queued'
+
         # Check on relationships
         relationships = art.user_artwork
         assert len(relationships) == 1
@@ -77,6 +86,41 @@ class TestArt(FunctionalTests):
         """Test that junk files are rejected."""
         pass
 
+    def test_sadday_upload_corrupt(self):
+        """Test that files that look like images but can't be read are
+        rejected, without leaving the upload behind."""
+        directory = tempfile.mkdtemp()
+        settings = self.app.app.app.registry.settings
+        original_factory = settings['filestore_factory']
+        settings['filestore_factory'] = get_storage_factory({
+            'filestore': 'local',
+            'filestore.directory': directory,
+        })
+
+        try:
+            png = self.file_contents('pk.engiveer.png')
+            response = self.app.post(
+                self.url('art.upload'),
+                params=[
+                    ('title', u"test title"),
+                ],
+                upload_files=(
+                    # A PNG header, but junk where the image header should be
+                    ('file', 'broken.png', png[:16] + 'garbage' * 10),
+                ),
+                extra_environ={'tests.user_id': self.user.id},
+            )
+
+            assert response.status_int == 200
+            assert "seems to be damaged" in response
+            assert not model.session.query(model.Artwork) \
+                .filter_by(title=u'test title').count()
+            assert not os.listdir(os.path.join(directory, '__temp__'))
+
+        finally:
+            settings['filestore_factory'] = original_factory
+            shutil.rmtree(directory)
+
     def test_happyday_upload_ajax(self):
         """Test that uploading works correctly via ajax."""
         png = self.file_contents('pk.engiveer.png')
@@ -100,3 +144,365 @@ class TestArt(FunctionalTests):
         assert response.json['status'] == 'redirect'
         assert response.json['redirect-to'].endswith('-test-title')
 
+
+    def test_gallery_query_count(self):
+        """Test that rendering a gallery doesn't need a query per artwork."""
+        tag = sim.sim_tag()
+        model.session.flush()
+        tag_id = tag.id
+
+        def add_artwork(n):
+            tag = model.session.query(model.Tag).get(tag_id)
+            for i in xrange(n):
+                artist = sim.sim_user(credentials=[])
+                artwork = sim.sim_artwork(user=artist)
+                artwork.user_artwork.append(model.UserArtwork(user=artist))
+                artwork.tag_objs.append(tag)
+                artwork.discussion = model.Discussion()
+            model.session.flush()
+
+        for display in (u'thumbnails', u'succinct', u'detailed'):
+            url = self.url('art.browse', _query=dict(display=display))
+
+            # The app shares our session, so empty it out before each request
+            # to avoid lazy loads being satisfied by the identity map
+            add_artwork(2)
+            model.session.expunge_all()
+            with QueryCounter() as few:
+                self.app.get(url)
+
+            add_artwork(8)
+            model.session.expunge_all()
+            with QueryCounter() as many:
+                response = self.app.get(url)
+
+            total = model.session.query(model.Artwork).count()
+            assert response.body.count('/filestore/thumbnail/') == total
+            assert few.count == many.count, display
+
+    def test_pending_thumbnail(self):
+        """Test that a thumbnail still waiting to be made gets a placeholder."""
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.derivative_jobs.append(
+            model.DerivativeJob(class_=u'thumbnail'))
+        model.session.flush()
+
+        # The filestore route's pregenerator needs a real request
+        url = u'/filestore/{0}/' + artwork.hash
+        response = self.app.get(url.format(u'thumbnail'), status=202)
+        assert response.content_type == 'image/svg+xml'
+        assert 'no-cache' in response.headers['Cache-Control']
+
+        # Nonsense classes don't exist at all
+        self.app.get(url.format(u'bogus'), status=404)
+
+    def test_lazy_rendition(self):
+        """Test that a rendition is made the first time it's asked for."""
+        directory = tempfile.mkdtemp()
+        settings = self.app.app.app.registry.settings
+        original_factory = settings['filestore_factory']
+        settings['filestore_factory'] = get_storage_factory({
+            'filestore': 'local',
+            'filestore.directory': directory,
+        })
+
+        try:
+            artwork = sim.sim_artwork(user=self.user)
+            artwork.mime_type = u'image/png'
+            model.session.flush()
+            storage = settings['filestore_factory']()
+            path = storage._path(directory, u'artwork', artwork.hash)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(self.file_contents('pk.engiveer.png'))
+
+            url = u'/filestore/medium/' + artwork.hash
+            response = self.app.get(url)
+            assert response.content_type == 'image/jpeg'
+
+            rendition, = artwork.renditions
+            assert rendition.name == u'medium'
+            assert (rendition.width, rendition.height) == (400, 500)
+            assert rendition.file_size == len(response.body)
+
+        finally:
+            settings['filestore_factory'] = original_factory
+            shutil.rmtree(directory)
+
+    def test_cached_thumbnail(self):
+        """Test that thumbnails in a gallery are served without any queries."""
+        directory = tempfile.mkdtemp()
+        settings = self.app.app.app.registry.settings
+        original_factory = settings['filestore_factory']
+        settings['filestore_factory'] = get_storage_factory({
+            'filestore': 'local',
+            'filestore.directory': directory,
+        })
+
+        try:
+            thumbnail = settings['renditions'][u'thumbnail']
+            artwork = sim.sim_artwork(user=self.user)
+            artwork.renditions.append(model.ArtworkRendition(
+                name=thumbnail.name,
+                fingerprint=thumbnail.fingerprint,
+                mime_type=u'image/png',
+                width=1, height=1, file_size=1,
+            ))
+            model.session.flush()
+            storage = settings['filestore_factory']()
+            path = storage._path(
+                directory, u'thumbnail', thumbnail.storage_key(artwork))
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write('x')
+
+            self.app.get(self.url('art.browse'))
+
+            url = u'/filestore/thumbnail/' + artwork.hash
+            with QueryCounter() as counter:
+                response = self.app.get(
+                    url, headers={'X-Forwarded-For': '127.0.0.1'})
+            assert counter.count == 0
+            assert response.content_type == 'image/png'
+            assert response.headers['X-Reproxy-URL'] == 'file://' + path
+
+        finally:
+            settings['filestore_factory'] = original_factory
+            shutil.rmtree(directory)
+
+    def test_evicted_thumbnail(self):
+        """Test that thumbnails evicted from a tiered storage's cache, while
+        the app still remembers them there, are fetched again."""
+        directory = tempfile.mkdtemp()
+        primary_directory = os.path.join(directory, 'primary')
+        os.mkdir(primary_directory)
+        settings = self.app.app.app.registry.settings
+        original_factory = settings['filestore_factory']
+        settings['filestore_factory'] = get_storage_factory({
+            'filestore': 'tiered',
+            'filestore.directory': os.path.join(directory, 'cache'),
+            'filestore.primary': 'local',
+            'filestore.primary.directory': primary_directory,
+            'filestore.policy.thumbnail': 'always',
+        })
+
+        try:
+            thumbnail = settings['renditions'][u'thumbnail']
+            artwork = sim.sim_artwork(user=self.user)
+            artwork.renditions.append(model.ArtworkRendition(
+                name=thumbnail.name,
+                fingerprint=thumbnail.fingerprint,
+                mime_type=u'image/png',
+                width=1, height=1, file_size=1,
+            ))
+            model.session.flush()
+            storage = settings['filestore_factory']()
+            path = storage.primary._path(primary_directory, u'thumbnail',
+                thumbnail.storage_key(artwork))
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write('x')
+
+            url = u'/filestore/thumbnail/' + artwork.hash
+            assert self.app.get(url).body == 'x'
+            cache_path = storage.cache.path(
+                u'thumbnail', thumbnail.storage_key(artwork))
+            assert os.path.exists(cache_path)
+
+            os.remove(cache_path)
+            assert self.app.get(url).body == 'x'
+            assert os.path.exists(cache_path)
+
+        finally:
+            settings['filestore_factory'] = original_factory
+            shutil.rmtree(directory)
+
+    def test_local_file_serving(self):
+        """Test serving files off the disk, with ranges and conditional
+        requests."""
+        directory = tempfile.mkdtemp()
+        settings = self.app.app.app.registry.settings
+        original_factory = settings['filestore_factory']
+        settings['filestore_factory'] = get_storage_factory({
+            'filestore': 'local',
+            'filestore.directory': directory,
+        })
+
+        try:
+            artwork = sim.sim_artwork(user=self.user)
+            artwork.mime_type = u'image/png'
+            model.session.flush()
+            storage = settings['filestore_factory']()
+            path = storage._path(directory, u'artwork', artwork.hash)
+            os.makedirs(os.path.dirname(path))
+            data = self.file_contents('pk.engiveer.png')
+            with open(path, 'wb') as f:
+                f.write(data)
+
+            url = u'/filestore/artwork/' + artwork.hash
+            response = self.app.get(url)
+            assert response.body == data
+            assert response.content_type == 'image/png'
+            assert response.etag == artwork.hash
+            assert response.headers['Accept-Ranges'] == 'bytes'
+
+            response = self.app.get(url, headers={'Range': 'bytes=10-19'})
+            assert response.status_int == 206
+            assert response.body == data[10:20]
+
+            # A stale If-Range means the whole thing
+            response = self.app.get(url, headers={
+                'Range': 'bytes=10-19', 'If-Range': '"bogus"'})
+            assert response.status_int == 200
+            assert response.body == data
+
+            self.app.get(url, status=304,
+                headers={'If-None-Match': '"{0}"'.format(artwork.hash)})
+            self.app.get(url, status=304,
+                headers={'If-Modified-Since': response.headers['Last-Modified']})
+
+        finally:
+            settings['filestore_factory'] = original_factory
+            shutil.rmtree(directory)
+
+    def test_bulk_rating(self):
+        """Test posting several ratings at once."""
+        radius = self.app.app.app.registry.settings['rating_radius']
+        artist = sim.sim_user(credentials=[])
+        artwork = [sim.sim_artwork(user=artist) for i in xrange(2)]
+        model.session.flush()
+        env = {'tests.user_id': self.user.id}
+        url = self.url('api:art.rate')
+
+        ratings = [
+            dict(artwork_id=artwork[0].id, rating=radius),
+            dict(artwork_id=artwork[1].id, rating=-radius),
+        ]
+        response = self.app.post(url,
+            params={'ratings': json.dumps(ratings)}, extra_environ=env)
+        results = response.json['results']
+        assert [r['artwork_id'] for r in results] == [a.id for a in artwork]
+        assert [r['ratings'] for r in results] == [1, 1]
+        assert results[0]['rating_sum'] > results[1]['rating_sum']
+
+        # Rating again replaces the earlier ratings
+        ratings[0]['rating'] = 0
+        response = self.app.post(url,
+            params={'ratings': json.dumps(ratings)}, extra_environ=env)
+        assert response.json['results'][0]['ratings'] == 1
+        assert artwork[0].rating_sum == 0
+
+        # Nothing is saved if anything is wrong
+        for bad in (
+                [dict(artwork_id=artwork[0].id, rating=radius + 1)],
+                [dict(artwork_id=artwork[0].id, rating=radius),
+                 dict(artwork_id=0, rating=radius)],
+                [dict(artwork_id=artwork[0].id)],
+                {'artwork_id': artwork[0].id}):
+            self.app.post(url, params={'ratings': json.dumps(bad)},
+                extra_environ=env, status=400)
+        assert artwork[0].rating_sum == 0
+
+    def test_similar_artwork(self):
+        """Test showing art like the art being viewed."""
+        artwork = [sim.sim_artwork(user=self.user) for i in xrange(3)]
+        for a in artwork:
+            a.discussion = model.Discussion()
+        model.session.flush()
+        for other, similarity in zip(artwork[1:], [0.5, 0.9]):
+            model.session.add(model.ArtworkSimilarity(
+                artwork_id=artwork[0].id,
+                similar_artwork_id=other.id,
+                similarity=similarity,
+            ))
+        model.session.flush()
+
+        response = self.app.get(self.url('art.view', artwork=artwork[0]))
+        assert 'Art like this' in response
+        links = [self.url('art.view', artwork=other) for other in artwork[2:0:-1]]
+        positions = [response.body.index('{0}"'.format(link))
+            for link in links]
+        assert positions == sorted(positions)
+
+        response = self.app.get(self.url('art.view', artwork=artwork[1]))
+        assert 'Art like this' not in response
+
+    def test_comment_replies(self):
+        """Test posting comments and replies, and viewing the thread."""
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.discussion = model.Discussion()
+        model.session.flush()
+        env = {'tests.user_id': self.user.id}
+
+        for message in (u'first', u'second'):
+            self.app.post(
+                self.url('comments.write', resource=artwork.resource),
+                params={'message': message}, extra_environ=env, status=303)
+        first, second = model.session.query(model.Comment) \
+            .order_by(model.Comment.id).all()
+        self.app.post(self.url('comments.reply', comment=first),
+            params={'message': u'reply'}, extra_environ=env, status=303)
+
+        model.session.expire_all()
+        assert [c.content for c in artwork.discussion.comments] == \
+            [u'first', u'reply', u'second']
+        assert artwork.discussion.comment_count == 3
+
+        # The reply is nested inside its parent, and nothing else is
+        response = self.app.get(self.url('comments.list',
+            type='art', identifier=artwork.id))
+        body = response.unicode_body
+        assert body.index(u'first') < body.index(u'comment-child') \
+            < body.index(u'reply') < body.index(u'second')
+        assert body.count(u'comment-child') == 1
+
+        response = self.app.get(self.url('comments.view', comment=first))
+        assert u'reply' in response.unicode_body
+        assert u'second' not in response.unicode_body
+
+    def test_too_deep_reply(self):
+        """Test that replying below the deepest level is turned away."""
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.discussion = model.Discussion()
+        model.session.flush()
+        env = {'tests.user_id': self.user.id}
+
+        parent = None
+        for depth in xrange(model.MAX_COMMENT_DEPTH):
+            parent = model.Comment(discussion=artwork.discussion,
+                parent=parent, author=self.user, content=u'deeper')
+            model.session.add(parent)
+            model.session.flush()
+
+        response = self.app.post(self.url('comments.reply', comment=parent),
+            params={'message': u'too deep'}, extra_environ=env, status=303)
+        assert response.location.endswith('#comment-{0}'.format(parent.id))
+        response = response.follow(extra_environ=env)
+        assert u'too deep to reply to' in response.unicode_body
+        assert not model.session.query(model.Comment) \
+            .filter_by(content=u'too deep').count()
+
+    def test_collapsed_replies(self):
+        """Test that deep threads are collapsed, and can be expanded."""
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.discussion = model.Discussion()
+        parent = None
+        comments = []
+        for i in xrange(VISIBLE_DEPTH + 3):
+            parent = model.Comment(discussion=artwork.discussion,
+                parent=parent, author=self.user,
+                content=u'level{0}'.format(i))
+            comments.append(parent)
+        model.session.flush()
+
+        response = self.app.get(self.url('art.view', artwork=artwork))
+        body = response.unicode_body
+        assert u'level{0}'.format(VISIBLE_DEPTH) in body
+        assert u'level{0}'.format(VISIBLE_DEPTH + 1) not in body
+        assert u'2 more replies' in body
+
+        collapsed = comments[VISIBLE_DEPTH]
+        response = self.app.get(self.url('comments.replies', comment=collapsed))
+        body = response.unicode_body
+        assert u'level{0}'.format(VISIBLE_DEPTH) not in body
+        assert u'level{0}'.format(VISIBLE_DEPTH + 2) in body
@@ -1,4 +1,6 @@
+from floof import model
 from floof.tests import FunctionalTests
+import floof.tests.sim as sim
 
 class TestMain(FunctionalTests):
 
@@ -11,3 +13,28 @@ class TestMain(FunctionalTests):
         """Test display of the public admin log page."""
         response = self.app.get(self.url('log'))
         assert 'Public Admin Log' in response
+
+    def test_search(self):
+        """Test full-text search of art and users."""
+        user = sim.sim_user(credentials=[])
+        user.display_name = u'Zebra fan'
+        artwork = sim.sim_artwork(user=user)
+        artwork.title = u'Zebra crossing'
+        model.session.flush()
+        url = self.url('api:search')
+
+        results = self.app.get(url, params={'q': u'zebra'}).json['results']
+        assert set((r['type'], r['id']) for r in results) == \
+            set([(u'artwork', artwork.id), (u'users', user.id)])
+        assert results[0]['rank'] >= results[1]['rank']
+
+        results = self.app.get(url,
+            params={'q': u'zebra', 'type': u'users'}).json['results']
+        assert [r['name'] for r in results] == [user.name]
+
+        results = self.app.get(url,
+            params={'q': u'zebra', 'page': 2}).json['results']
+        assert results == []
+
+        for bad in ({'q': u'zebra', 'type': u'tags'}, {'page': u'x'}):
+            self.app.get(url, params=bad, status=400)
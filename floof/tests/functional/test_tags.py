@@ -23,3 +23,23 @@ class TestTags(FunctionalTests):
         # Ensure it shows in the tag's gallery
         res = self.app.get(self.url('tags.artwork', tag=tag))
         assert artwork.title in res
+
+    def test_autocomplete(self):
+        """Test autocompleting tag names."""
+        user = sim.sim_user(credentials=[])
+        tags = [model.Tag(u'zz_popular'), model.Tag(u'zz_rare')]
+        for i in xrange(2):
+            artwork = sim.sim_artwork(user=user)
+            artwork.tag_objs.append(tags[0])
+        artwork.tag_objs.append(tags[1])
+        model.session.flush()
+        url = self.url('api:tags.list')
+
+        results = self.app.get(url, params={'name': u'zz'}).json['results']
+        assert [r['name'] for r in results] == [u'zz_popular', u'zz_rare']
+
+        results = self.app.get(url,
+            params={'name': u'ZZ_R', 'limit': 1}).json['results']
+        assert [r['id'] for r in results] == [tags[1].id]
+
+        self.app.get(url, params={'limit': u'x'}, status=400)
@@ -0,0 +1,204 @@
+"""A fake S3-compatible server, for testing the S3 filestore without Amazon.
+
+It speaks just enough of the REST API for boto and `floof.model.filestore.s3`:
+path-style object PUT, GET, HEAD, DELETE and server-side copy, multipart
+uploads, and bucket listings.  Everything is kept in memory, any bucket
+exists, and no one is ever asked to authenticate.  Presigned URLs work, since
+the signatures are just ignored, as do their `response-content-type` and
+`response-content-disposition` overrides.
+
+Run it in a background thread with :func:`start_server`.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from hashlib import md5
+import SocketServer
+import threading
+import urllib
+import urlparse
+import uuid
+from xml.sax.saxutils import escape
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, HTTPServer):
+    """Holds objects, by (bucket, key), and their Content-Types in
+    `content_types`; and the Content-Types and parts of unfinished multipart
+    uploads, by upload id.  Counts the requests it gets in `requests`."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        HTTPServer.__init__(self, address, FakeS3Handler)
+        self.objects = {}
+        self.content_types = {}
+        self.uploads = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+def _etag(data):
+    return '"{0}"'.format(md5(data).hexdigest())
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and bodies go out in separate writes, which Nagle's algorithm
+    # would hold up for every request
+    disable_nagle_algorithm = True
+
+    def _parse(self):
+        """Returns the bucket, key and query parameters of the request."""
+        with self.server.lock:
+            self.server.requests += 1
+
+        url = urlparse.urlsplit(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        return urllib.unquote(bucket), urllib.unquote(key), query
+
+    def _content_type(self):
+        return self.headers.get('Content-Type', 'binary/octet-stream')
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else ''
+
+    def _respond(self, status, body='', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, body):
+        self._respond(200,
+            '<?xml version="1.0" encoding="UTF-8"?>\n' + body,
+            [('Content-Type', 'application/xml')])
+
+    def _not_found(self):
+        self._xml_error(404, 'NoSuchKey')
+
+    def _xml_error(self, status, code):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Error><Code>{0}</Code><Message>{0}</Message></Error>'
+            .format(code))
+        self._respond(status, body, [('Content-Type', 'application/xml')])
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if not key:
+            return self._list(bucket, query.get('prefix', ''))
+
+        data = self.server.objects.get((bucket, key))
+        if data is None:
+            return self._not_found()
+
+        headers = [
+            ('Content-Type', query.get('response-content-type',
+                self.server.content_types[bucket, key])),
+            ('ETag', _etag(data)),
+            ('Last-Modified', self.date_time_string()),
+        ]
+        if 'response-content-disposition' in query:
+            headers.append(('Content-Disposition',
+                query['response-content-disposition']))
+        self._respond(200, data, headers)
+
+    def _list(self, bucket, prefix):
+        contents = []
+        for (key_bucket, key), data in sorted(self.server.objects.items()):
+            if key_bucket != bucket or not key.startswith(prefix):
+                continue
+            contents.append(
+                '<Contents><Key>{0}</Key><Size>{1}</Size><ETag>{2}</ETag>'
+                '<LastModified>2012-01-01T00:00:00.000Z</LastModified>'
+                '</Contents>'.format(escape(key), len(data),
+                    escape(_etag(data))))
+
+        self._xml('<ListBucketResult><Name>{0}</Name><Prefix>{1}</Prefix>'
+            '<IsTruncated>false</IsTruncated>{2}</ListBucketResult>'
+            .format(escape(bucket), escape(prefix), ''.join(contents)))
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        data = self._body()
+
+        if 'uploadId' in query:
+            upload = self.server.uploads.get(query['uploadId'])
+            if upload is None:
+                return self._xml_error(404, 'NoSuchUpload')
+            content_type, parts = upload
+            parts[int(query['partNumber'])] = data
+            return self._respond(200, headers=[('ETag', _etag(data))])
+
+        source = self.headers.get('x-amz-copy-source')
+        if source:
+            source_bucket, _, source_key = \
+                urllib.unquote(source).lstrip('/').partition('/')
+            data = self.server.objects.get((source_bucket, source_key))
+            if data is None:
+                return self._not_found()
+            self.server.objects[bucket, key] = data
+            self.server.content_types[bucket, key] = \
+                self.server.content_types[source_bucket, source_key]
+            return self._xml('<CopyObjectResult>'
+                '<LastModified>2012-01-01T00:00:00.000Z</LastModified>'
+                '<ETag>{0}</ETag></CopyObjectResult>'.format(
+                    escape(_etag(data))))
+
+        self.server.objects[bucket, key] = data
+        self.server.content_types[bucket, key] = self._content_type()
+        self._respond(200, headers=[('ETag', _etag(data))])
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = self._content_type(), {}
+            return self._xml('<InitiateMultipartUploadResult>'
+                '<Bucket>{0}</Bucket><Key>{1}</Key><UploadId>{2}</UploadId>'
+                '</InitiateMultipartUploadResult>'.format(
+                    escape(bucket), escape(key), upload_id))
+
+        if 'uploadId' in query:
+            upload = self.server.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self._xml_error(404, 'NoSuchUpload')
+            content_type, parts = upload
+            data = ''.join(parts[number] for number in sorted(parts))
+            self.server.objects[bucket, key] = data
+            self.server.content_types[bucket, key] = content_type
+            return self._xml('<CompleteMultipartUploadResult>'
+                '<Location>/{0}/{1}</Location><Bucket>{0}</Bucket>'
+                '<Key>{1}</Key><ETag>{2}</ETag>'
+                '</CompleteMultipartUploadResult>'.format(
+                    escape(bucket), escape(key), escape(_etag(data))))
+
+        self._xml_error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if 'uploadId' in query:
+            self.server.uploads.pop(query['uploadId'], None)
+        else:
+            self.server.objects.pop((bucket, key), None)
+            self.server.content_types.pop((bucket, key), None)
+        self._respond(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    """Starts a :class:`FakeS3Server` on a free local port, in a daemon
+    thread.  Returns the server; call its `shutdown` when done."""
+    server = FakeS3Server(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -117,7 +117,7 @@ def sim_user_env(user, *trust_flags):
 def sim_artwork(user):
     artwork = model.MediaImage(
         title = ''.join(random.choice(string.letters) for i in xrange(10)),
-        hash = '123',
+        hash = ''.join(random.choice(string.hexdigits) for i in xrange(64)),
         uploader = user,
         original_filename = 'dummy.jpg',
         mime_type = 'image/jpeg',
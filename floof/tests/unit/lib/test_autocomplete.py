@@ -0,0 +1,163 @@
+import random
+
+import transaction
+
+from floof import model
+from floof.lib.autocomplete import MAX_COMPLETIONS
+from floof.lib.autocomplete import Autocompleter, PrefixIndex
+from floof.tests import QueryCounter, UnitTests
+from floof.tests import sim
+
+
+def test_prefix_index():
+    index = PrefixIndex()
+    index.set(1, [u'Alice', u'Wonderland'], 5, u'alice')
+    index.set(2, [u'alfred'], 10, u'alfred')
+    index.set(3, [u'bob'], 1, u'bob')
+
+    assert index.complete(u'al') == [u'alfred', u'alice']
+    assert index.complete(u'ALI') == [u'alice']
+    assert index.complete(u'won') == [u'alice']
+    assert index.complete(u'') == [u'alfred', u'alice', u'bob']
+    assert index.complete(u'al', limit=1) == [u'alfred']
+    assert index.complete(u'x') == []
+    assert index.complete(u'alicex') == []
+
+    # Changes show up straight away
+    index.set_score(1, 20)
+    assert index.complete(u'al') == [u'alice', u'alfred']
+    index.set(1, [u'carol'], 20, u'carol')
+    assert index.complete(u'al') == [u'alfred']
+    assert index.complete(u'c') == [u'carol']
+    index.remove(2)
+    assert index.complete(u'al') == []
+    assert len(index) == 2
+
+def test_prefix_index_limit():
+    index = PrefixIndex()
+    for i in xrange(MAX_COMPLETIONS * 2):
+        index.set(i, [u'name{0}'.format(i)], i, i)
+
+    best = range(MAX_COMPLETIONS * 2 - 1, MAX_COMPLETIONS - 1, -1)
+    assert index.complete(u'name', limit=1000) == best
+    assert index.complete(u'name', limit=-1) == []
+
+def test_prefix_index_updates():
+    """Lists of best entries are kept right by redoing only the paths of
+    changed names."""
+    rng = random.Random(0)
+    index = PrefixIndex()
+    index.set_many((i, [u'n{0:03d}'.format(i)], 0, i) for i in xrange(200))
+    entries = dict((i, ([u'n{0:03d}'.format(i)], 0)) for i in xrange(200))
+
+    def expected(prefix):
+        matches = [(-score, min(names), key)
+            for key, (names, score) in entries.iteritems()
+            if any(name.startswith(prefix) for name in names)]
+        return [key for score, name, key in sorted(matches)][:MAX_COMPLETIONS]
+
+    for n in xrange(300):
+        key = rng.randrange(250)
+        roll = rng.random()
+        if roll < 0.5:
+            index.set_score(key, rng.randrange(50))
+            if key in entries:
+                entries[key] = entries[key][0], index._entries[key][1]
+        elif roll < 0.8:
+            names = [u'n{0:03d}'.format(rng.randrange(250))]
+            score = rng.randrange(50)
+            index.set(key, names, score, key)
+            entries[key] = names, score
+        else:
+            index.remove(key)
+            entries.pop(key, None)
+
+        for prefix in (u'', u'n', u'n0', u'n1', u'n12', u'n2'):
+            assert index.complete(prefix) == expected(prefix)
+
+    # Nodes off the changed path are left alone
+    untouched = index._root.children[u'n'].children[u'0']
+    best = untouched.best
+    index.set(1000, [u'n123'], 1000, 1000)
+    assert untouched.best is best
+    assert index.complete(u'n')[0] == 1000
+
+
+class TestAutocomplete(UnitTests):
+
+    def setUp(self):
+        super(TestAutocomplete, self).setUp()
+        self.prolific = sim.sim_user(credentials=[])
+        self.prolific.name = u'zz_prolific'
+        self.prolific.display_name = u'Busy Bee'
+        self.idle = sim.sim_user(credentials=[])
+        self.idle.name = u'zz_idle'
+        self.tags = [model.Tag(u'zz_popular'), model.Tag(u'zz_rare')]
+        model.session.add_all(self.tags)
+
+        for i in xrange(2):
+            artwork = sim.sim_artwork(user=self.prolific)
+            artwork.user_artwork.append(model.UserArtwork(user=self.prolific))
+            artwork.tag_objs.append(self.tags[0])
+        model.session.flush()
+
+        self.autocompleter = Autocompleter()
+        self.autocompleter.load(model.session)
+        self.config.registry.settings['autocompleter'] = self.autocompleter
+
+    def _commit(self):
+        """Flushes, and pretends to commit; unit tests never really do."""
+        model.session.flush()
+        for hook, args, kwargs in transaction.get().getAfterCommitHooks():
+            hook(True, *args, **kwargs)
+
+    def _users(self, prefix):
+        return [user['name'] for user in
+            self.autocompleter.complete_users(model.session, prefix)]
+
+    def _tags(self, prefix):
+        return [tag['name'] for tag in
+            self.autocompleter.complete_tags(model.session, prefix)]
+
+    def test_complete(self):
+        assert self._users(u'zz_') == [u'zz_prolific', u'zz_idle']
+        assert self._users(u'bee') == [u'zz_prolific']
+        assert self._tags(u'zz') == [u'zz_popular', u'zz_rare']
+
+        # Once loaded, completing doesn't touch the database
+        with QueryCounter() as counter:
+            self._users(u'zz')
+            self._tags(u'zz')
+        assert counter.count == 0
+
+    def test_changes(self):
+        # New art for the idle user and the rare tag pushes both up
+        for i in xrange(3):
+            artwork = sim.sim_artwork(user=self.idle)
+            artwork.user_artwork.append(model.UserArtwork(user=self.idle))
+            artwork.tag_objs.append(self.tags[1])
+        self.idle.display_name = u'Formerly Idle'
+        new_tag = model.Tag(u'zz_new')
+        model.session.add(new_tag)
+
+        # Changes only apply on commit
+        model.session.flush()
+        assert self._users(u'zz_') == [u'zz_prolific', u'zz_idle']
+        self._commit()
+
+        assert self._users(u'zz_') == [u'zz_idle', u'zz_prolific']
+        assert self._users(u'formerly') == [u'zz_idle']
+        assert self._tags(u'zz') == [u'zz_rare', u'zz_popular', u'zz_new']
+
+        model.session.delete(new_tag)
+        self._commit()
+        assert self._tags(u'zz_n') == []
+
+    def test_reload(self):
+        self.autocompleter.reload_interval = -1
+        new_tag = model.Tag(u'zz_new')
+        model.session.add(new_tag)
+        model.session.flush()
+
+        # Stale indexes are reloaded
+        assert u'zz_new' in self._tags(u'zz')
@@ -0,0 +1,123 @@
+import shutil
+import tempfile
+
+import transaction
+from webob.multidict import MultiDict
+
+from floof import model
+from floof.lib.cache import FilesystemCache, MemoryCache, get_cache
+from floof.lib.gallery import GallerySieve, _invalidate_gallery_cache
+from floof.tests import UnitTests
+from floof.tests import sim
+
+
+class TestCaches(UnitTests):
+
+    def setUp(self):
+        super(TestCaches, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestCaches, self).tearDown()
+
+    def _check_cache(self, cache):
+        assert cache.get(u'foo') is None
+        cache.set(u'foo', u'<p>\u2603</p>')
+        assert cache.get(u'foo') == u'<p>\u2603</p>'
+
+        cache.invalidate()
+        assert cache.get(u'foo') is None
+
+        cache.set(u'foo', u'bar')
+        assert cache.get(u'foo') == u'bar'
+
+        cache.delete(u'foo')
+        assert cache.get(u'foo') is None
+        cache.delete(u'foo')
+
+    def test_get_cache(self):
+        assert get_cache({}) is None
+        assert get_cache({'gallery_cache': u''}) is None
+
+        cache = get_cache({
+            'gallery_cache': u'memory',
+            'gallery_cache.max_items': u'3',
+        })
+        assert isinstance(cache, MemoryCache)
+        assert cache.max_items == 3
+
+    def test_memory(self):
+        self._check_cache(MemoryCache())
+
+    def test_memory_eviction(self):
+        cache = MemoryCache(max_items=2)
+        cache.set(u'a', u'a')
+        cache.set(u'b', u'b')
+        cache.get(u'a')
+        cache.set(u'c', u'c')
+
+        # b was the least recently used
+        assert cache.get(u'a') == u'a'
+        assert cache.get(u'b') is None
+        assert cache.get(u'c') == u'c'
+
+    def test_memory_timeout(self):
+        cache = MemoryCache(timeout=-1)
+        cache.set(u'a', u'a')
+        assert cache.get(u'a') is None
+
+    def test_filesystem(self):
+        self._check_cache(FilesystemCache(self.directory))
+
+        # Another process should see the same entries and invalidations
+        cache = FilesystemCache(self.directory)
+        other_cache = FilesystemCache(self.directory)
+        cache.set(u'a', u'a')
+        assert other_cache.get(u'a') == u'a'
+        other_cache.invalidate()
+        assert cache.get(u'a') is None
+
+    def test_filesystem_timeout(self):
+        cache = FilesystemCache(self.directory, timeout=-1)
+        cache.set(u'a', u'a')
+        assert cache.get(u'a') is None
+
+
+class TestGalleryCaching(UnitTests):
+
+    def _cache_key(self, url=u'http://localhost/art', **formdata):
+        return GallerySieve(formdata=MultiDict(formdata)).cache_key(url)
+
+    def test_cache_key(self):
+        key = self._cache_key()
+        assert key == self._cache_key()
+        assert key != self._cache_key(url=u'http://localhost/tags/foo/artwork')
+        assert key != self._cache_key(sort=u'rating_count')
+        assert key != self._cache_key(display=u'detailed')
+        assert key != self._cache_key(after=u'WzFd')
+
+        # Nothing to cache if there are errors to show
+        assert self._cache_key(sort=u'bogus') is None
+
+    def test_invalidation(self):
+        cache = MemoryCache()
+        cache.set(u'foo', u'bar')
+        self.config.registry.settings['gallery_fragment_cache'] = cache
+
+        # Nothing happens until commit
+        user = sim.sim_user(credentials=[])
+        sim.sim_artwork(user=user)
+        model.session.flush()
+        sim.sim_artwork(user=user)
+        model.session.flush()
+        assert cache.get(u'foo') == u'bar'
+
+        hooks = [(hook, args) for hook, args, kwargs
+            in transaction.get().getAfterCommitHooks()]
+        assert hooks == [(_invalidate_gallery_cache, (cache,))]
+
+        _invalidate_gallery_cache(False, cache)
+        assert cache.get(u'foo') == u'bar'
+        _invalidate_gallery_cache(True, cache)
+        assert cache.get(u'foo') is None
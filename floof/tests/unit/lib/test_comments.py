@@ -0,0 +1,103 @@
+from webob.multidict import MultiDict
+
+from floof import model
+from floof.lib.comments import CommentPage, load_subtrees
+from floof.lib.helpers import render_comment, render_comments
+from floof.tests import QueryCounter, UnitTests
+from floof.tests import sim
+
+
+class TestCommentPages(UnitTests):
+
+    def setUp(self):
+        super(TestCommentPages, self).setUp()
+        self.user = sim.sim_user(credentials=[])
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.discussion = self.discussion = model.Discussion()
+        model.session.flush()
+
+    def _post(self, content, parent=None):
+        comment = model.Comment(discussion=self.discussion, parent=parent,
+            author=self.user, content=content)
+        model.session.add(comment)
+        model.session.flush()
+        return comment
+
+    def _chain(self, content, length, parent=None):
+        """Posts a chain of replies, each to the last."""
+        comments = []
+        for i in xrange(length):
+            parent = self._post(u'{0}{1}'.format(content, i), parent)
+            comments.append(parent)
+        return comments
+
+    def _contents(self, comments):
+        return [comment.content for comment in comments]
+
+    def test_paging(self):
+        for i in xrange(5):
+            self._post(u'thread{0}'.format(i))
+        self._post(u'reply', self.discussion.comments[1])
+
+        page = CommentPage(model.session, self.discussion, page_size=2)
+        assert self._contents(page) == [u'thread0', u'thread1', u'reply']
+        assert page.pager.last_page == 2
+
+        page = CommentPage(model.session, self.discussion,
+            MultiDict(skip=u'4'), page_size=2)
+        assert self._contents(page) == [u'thread4']
+
+    def test_collapsing(self):
+        a = self._chain(u'a', 5)
+        b = self._chain(u'b', 2)
+        self._post(u'a4x', a[4])
+        self._post(u'a3x', a[3])
+
+        # Only three levels are shown below the top; the rest is counted
+        comments, hidden_counts = load_subtrees(
+            model.session, self.discussion, [a[0], b[0]], depth=2)
+        assert self._contents(comments) == [u'a0', u'a1', u'a2', u'b0', u'b1']
+        assert hidden_counts == {a[2].id: 4}
+
+        # Fetching below a collapsed comment goes deeper again
+        comments, hidden_counts = load_subtrees(
+            model.session, self.discussion, [a[2]], depth=2)
+        assert self._contents(comments) == [u'a2', u'a3', u'a4', u'a3x']
+        assert hidden_counts == {a[4].id: 1}
+
+    def test_query_count(self):
+        for i in xrange(3):
+            self._chain(u'thread{0}-'.format(i), 6)
+        model.session.expire_all()
+        self.discussion.id
+
+        # Counting, the top level, the rest, and what's hidden
+        with QueryCounter() as counter:
+            page = CommentPage(model.session, self.discussion, depth=2)
+            for comment in page:
+                comment.author.name
+        assert counter.count == 4
+        assert len(page.comments) == 9
+
+    def test_rendered_content(self):
+        comment = self._post(u'*hello*')
+        assert comment.content_html is None
+        assert render_comment(comment) == u'<p><em>hello</em></p>'
+
+        # Rendering once is enough
+        model.session.flush()
+        model.session.expire_all()
+        assert comment.content_html == u'<p><em>hello</em></p>'
+        comment.content_html = u'cached'
+        assert render_comment(comment) == u'cached'
+
+        # Editing throws out the old rendering
+        comment.content = u'**bye**'
+        assert comment.content_html is None
+        assert render_comment(comment) == u'<p><strong>bye</strong></p>'
+
+        # Pages of comments are rendered all at once, leaving what's done
+        other = self._post(u'*other*')
+        render_comments([comment, other])
+        assert comment.content_html == u'<p><strong>bye</strong></p>'
+        assert other.content_html == u'<p><em>other</em></p>'
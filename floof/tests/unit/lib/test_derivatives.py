@@ -0,0 +1,163 @@
+from cStringIO import StringIO
+import os
+import shutil
+import tempfile
+
+import transaction
+
+from floof import model
+from floof.lib import derivatives
+from floof.model.filestore import get_storage_factory
+from floof.tests import UnitTests
+from floof.tests import sim
+
+# PIL is an unholy fucking abomination that can't even be imported right
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+
+
+class TestDerivatives(UnitTests):
+
+    def setUp(self):
+        super(TestDerivatives, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestDerivatives, self).tearDown()
+
+    def test_get_renditions(self):
+        renditions = derivatives.get_renditions({
+            'thumbnail_size': u'160',
+            'rendition.medium.size': u'800',
+            'rendition.medium.format': u'jpeg',
+            'rendition.medium.quality': u'70',
+        })
+        assert sorted(renditions) == [u'medium', u'thumbnail']
+
+        thumbnail = renditions[u'thumbnail']
+        assert thumbnail.size == 160
+        assert thumbnail.crop and thumbnail.eager
+
+        medium = renditions[u'medium']
+        assert medium.size == 800
+        assert medium.format == u'jpeg'
+        assert medium.quality == 70
+        assert not medium.crop and not medium.eager
+
+        # Changing the settings changes the fingerprint
+        assert medium.fingerprint != derivatives.Rendition(
+            u'medium', 800, format=u'jpeg').fingerprint
+
+    def test_render(self):
+        rendition = derivatives.Rendition(u'medium', 100, format=u'jpeg')
+        image = rendition.render(Image.new('RGBA', (400, 200)))
+        assert image.size == (100, 50)
+
+        # Transparency is flattened away for JPEG
+        data = rendition.encode(image, u'image/png')
+        assert Image.open(StringIO(data)).format == 'JPEG'
+        assert rendition.mime_type(u'image/png') == u'image/jpeg'
+
+    def test_make_thumbnail(self):
+        # Too tall, so it's cropped to 2:1 first
+        image = Image.new('RGB', (100, 500))
+        assert derivatives.make_thumbnail(image, 160).size == (80, 160)
+
+        # Small enough to leave alone
+        image = Image.new('RGB', (100, 50))
+        assert derivatives.make_thumbnail(image, 160).size == (100, 50)
+
+    def test_claim_job(self):
+        artwork = sim.sim_artwork(user=sim.sim_user(credentials=[]))
+        derivatives.enqueue(artwork, {
+            u'thumbnail': derivatives.Rendition(u'thumbnail', 160, eager=True),
+            u'medium': derivatives.Rendition(u'medium', 800),
+        })
+        model.session.flush()
+
+        job = derivatives.claim_job(model.session)
+        assert job.artwork == artwork
+        assert job.state == u'running'
+        assert job.attempts == 1
+
+        # It's taken now
+        assert derivatives.claim_job(model.session) is None
+
+        # ...unless its worker seems to have died
+        job.started_time = model.now() - derivatives.JOB_LEASE * 2
+        model.session.flush()
+        job = derivatives.claim_job(model.session)
+        assert job.attempts == 2
+
+    def test_generate_rendition(self):
+        storage = get_storage_factory({
+            'filestore': 'local',
+            'filestore.directory': self.directory,
+        })()
+        transaction.get().join(storage)
+
+        artwork = sim.sim_artwork(user=sim.sim_user(credentials=[]))
+        artwork.mime_type = u'image/png'
+        path = storage._path(self.directory, u'artwork', artwork.hash)
+        os.makedirs(os.path.dirname(path))
+        Image.new('RGB', (400, 500)).save(path, 'PNG')
+        model.session.flush()
+
+        old_rendition = derivatives.Rendition(u'thumbnail', 100, crop=True)
+        derivatives.generate_rendition(
+            model.session, storage, artwork, old_rendition)
+
+        rendition = derivatives.Rendition(u'thumbnail', 160, crop=True)
+        assert not derivatives.current_rendition(
+            model.session, artwork, rendition)
+        artwork_rendition, data = derivatives.generate_rendition(
+            model.session, storage, artwork, rendition)
+        model.session.flush()
+
+        assert derivatives.current_rendition(
+            model.session, artwork, rendition) == artwork_rendition
+        assert (artwork_rendition.width, artwork_rendition.height) \
+            == (128, 160)
+        assert artwork_rendition.file_size == len(data)
+
+        # The old one is forgotten
+        model.session.expire_all()
+        assert artwork.renditions == [artwork_rendition]
+
+        idx = storage._idx(u'thumbnail', rendition.storage_key(artwork))
+        class_, key, path = storage.stage[idx]
+        assert Image.open(path).size == (128, 160)
+
+        # Making it again, as a forced backfill does, replaces it too
+        artwork_rendition, data = derivatives.generate_rendition(
+            model.session, storage, artwork, rendition)
+        model.session.flush()
+        model.session.expire_all()
+        assert artwork.renditions == [artwork_rendition]
+
+    def test_make_rendition_file(self):
+        original = os.path.join(self.directory, 'original.png')
+        Image.new('RGB', (400, 500)).save(original, 'PNG')
+
+        rendition = derivatives.Rendition(u'medium', 100, format=u'jpeg')
+        path, width, height = derivatives.make_rendition_file(
+            'file://' + original, u'image/png', rendition, self.directory)
+
+        assert os.path.dirname(path) == self.directory
+        assert (width, height) == (80, 100)
+        assert Image.open(path).format == 'JPEG'
+
+    def test_checkpoint(self):
+        path = os.path.join(self.directory, 'checkpoint')
+        renditions = [derivatives.Rendition(u'thumbnail', 160)]
+        assert derivatives.read_checkpoint(path, renditions) is None
+
+        derivatives.write_checkpoint(path, renditions, 123)
+        assert derivatives.read_checkpoint(path, renditions) == 123
+
+        # Checkpoints for other settings don't count
+        renditions = [derivatives.Rendition(u'thumbnail', 200)]
+        assert derivatives.read_checkpoint(path, renditions) is None
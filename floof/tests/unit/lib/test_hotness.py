@@ -0,0 +1,82 @@
+from datetime import timedelta
+
+from webob.multidict import MultiDict
+
+from floof import model
+from floof.lib.gallery import GallerySieve
+from floof.lib.hotness import refresh_batch
+from floof.model.extensions import HOT_HALF_LIFE, HOT_WINDOW, hot_score
+from floof.tests import UnitTests
+from floof.tests import sim
+
+
+def test_hot_score():
+    now = model.now()
+
+    # Better and more recently rated art is hotter
+    assert hot_score(0.5, 0, now) > hot_score(None, 0, now) \
+        > hot_score(-0.5, 0, now)
+    assert hot_score(0.5, 3, now) > hot_score(0.5, 0, now)
+
+    # Art a half-life older needs twice the popularity to keep up
+    older = now - HOT_HALF_LIFE
+    assert abs(hot_score(1.0, 1, older) - hot_score(None, 0, now)) < 1e-9
+
+
+class TestHotScores(UnitTests):
+
+    def setUp(self):
+        super(TestHotScores, self).setUp()
+        artist = sim.sim_user(credentials=[])
+        self.raters = [sim.sim_user(credentials=[]) for i in xrange(3)]
+        self.artwork = [sim.sim_artwork(user=artist) for i in xrange(3)]
+        model.session.flush()
+
+    def _refresh(self, now, since=None):
+        connection = model.session.connection()
+        from_id = None
+        changed = 0
+        while True:
+            last_id, batch_changed = refresh_batch(
+                connection, now, since, from_id, batch_size=2)
+            if last_id is None:
+                break
+            changed += batch_changed
+            from_id = last_id + 1
+
+        model.session.expire_all()
+        return changed
+
+    def test_refresh(self):
+        a, b, c = self.artwork
+        now = model.now()
+        for rater in self.raters:
+            model.ArtworkRating.set(model.session, a, rater, 1.0)
+        model.ArtworkRating.set(model.session, b, self.raters[0], -1.0)
+
+        # New art starts out with the score of unrated art
+        initial = c.hot_score
+        assert abs(initial - hot_score(None, 0, c.uploaded_time)) < 1e-9
+
+        # Only rated art needs refreshing
+        assert self._refresh(now, since=now) == 2
+        assert a.hot_score > c.hot_score > b.hot_score
+        assert c.hot_score == initial
+        assert abs(a.hot_score
+            - hot_score(a.rating_score, 3, a.uploaded_time)) < 1e-9
+
+        # Once the ratings are old, they no longer count extra.  (A rating of
+        # -1 never did)
+        later = now + HOT_WINDOW + timedelta(minutes=1)
+        assert self._refresh(later, since=now) == 1
+        assert abs(a.hot_score
+            - hot_score(a.rating_score, 0, a.uploaded_time)) < 1e-9
+        assert self._refresh(later, since=later) == 0
+
+    def test_gallery_sort(self):
+        a, b, c = self.artwork
+        model.ArtworkRating.set(model.session, b, self.raters[0], 1.0)
+        self._refresh(model.now())
+
+        sieve = GallerySieve(formdata=MultiDict(sort=u'hot'))
+        assert sieve.evaluate().items[0] is b
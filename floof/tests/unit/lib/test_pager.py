@@ -0,0 +1,76 @@
+from datetime import timedelta
+
+from floof import model
+from floof.lib.pager import KeysetPager, SortKey
+from floof.lib.pager import _cursor_from_values, _values_from_cursor
+from floof.tests import UnitTests
+from floof.tests import sim
+
+
+class TestKeysetPager(UnitTests):
+
+    def setUp(self):
+        """Creates a pile of art, with plenty of ties in upload time."""
+        super(TestKeysetPager, self).setUp()
+
+        user = sim.sim_user()
+        base_time = model.now()
+        self.artwork = []
+        for i in xrange(11):
+            artwork = sim.sim_artwork(user=user)
+            artwork.uploaded_time = base_time - timedelta(minutes=i // 3)
+            artwork.rating_count = i % 4
+            self.artwork.append(artwork)
+        model.session.flush()
+
+        self.sort_keys = (
+            SortKey(model.Artwork.rating_count),
+            SortKey(model.Artwork.uploaded_time),
+            SortKey(model.Artwork.id),
+        )
+        self.query = model.session.query(model.Artwork).filter(
+            model.Artwork.id.in_([artwork.id for artwork in self.artwork]))
+
+    def _pager(self, formdata={}):
+        return KeysetPager(self.query, 3, self.sort_keys, formdata=formdata)
+
+    def test_cursor_roundtrip(self):
+        now = model.now()
+        values = [now, 3, 0.1, u'foo']
+        cursor = _cursor_from_values(values)
+        assert _values_from_cursor(cursor, 4) == values
+
+        # Junk is ignored
+        assert _values_from_cursor(cursor, 3) is None
+        assert _values_from_cursor(u'!!!', 4) is None
+        assert _values_from_cursor(u'\u2603', 4) is None
+        assert _values_from_cursor(_cursor_from_values([None]), 1) is None
+
+    def test_forwards_and_backwards(self):
+        expected = sorted(self.artwork, key=lambda artwork: (
+            artwork.rating_count, artwork.uploaded_time, artwork.id),
+            reverse=True)
+
+        # Walk forwards through every page
+        pages = [self._pager()]
+        while not pages[-1].is_last_page:
+            pages.append(self._pager(pages[-1].formdata_for_next()))
+
+        assert pages[0].is_first_page
+        assert not any(pager.is_first_page for pager in pages[1:])
+        assert [len(pager.items) for pager in pages] == [3, 3, 3, 2]
+        assert [artwork for pager in pages for artwork in pager] == expected
+
+        # And walk back again, which should produce the same pages
+        pager = pages[-1]
+        for page in reversed(pages[:-1]):
+            pager = self._pager(pager.formdata_for_previous())
+            assert pager.items == page.items
+            assert not pager.is_last_page
+        assert pager.is_first_page
+
+    def test_cruft(self):
+        pager = self._pager(dict(after=u'junk', skip=u'30', foo=u'bar'))
+        assert pager.is_first_page
+        assert pager.formdata_for_first() == dict(foo=u'bar')
+        assert u'after' in pager.formdata_for_next()
@@ -0,0 +1,72 @@
+from floof import model
+from floof.lib.ratings import recalculate_batch
+from floof.model import extensions
+from floof.model.extensions import wilson_score, wilson_scores
+from floof.tests import UnitTests
+from floof.tests import sim
+
+
+def test_wilson_scores():
+    counts = [0, 1, 3, 10, 2]
+    totals = [0, 1.0, -0.5, 7.25, -2.0]
+    expected = [None] + [wilson_score(n, total)
+        for n, total in zip(counts[1:], totals[1:])]
+
+    def check(scores):
+        assert scores[0] is None
+        for score, want in zip(scores[1:], expected[1:]):
+            assert abs(score - want) < 1e-12
+
+    check(wilson_scores(counts, totals))
+
+    # And without NumPy
+    numpy = extensions.numpy
+    extensions.numpy = None
+    try:
+        check(wilson_scores(counts, totals))
+    finally:
+        extensions.numpy = numpy
+
+
+class TestRecalculateRatings(UnitTests):
+
+    def setUp(self):
+        super(TestRecalculateRatings, self).setUp()
+        artist = sim.sim_user(credentials=[])
+        self.raters = [sim.sim_user(credentials=[]) for i in xrange(2)]
+        self.artwork = [sim.sim_artwork(user=artist) for i in xrange(3)]
+        model.session.flush()
+
+    def test_recalculate(self):
+        a, b, c = self.artwork
+        for rater in self.raters:
+            model.ArtworkRating.set(model.session, a, rater, 1.0)
+        model.ArtworkRating.set(model.session, b, self.raters[0], -0.5)
+        expected = [(a.rating_count, a.rating_sum, a.rating_score),
+                    (b.rating_count, b.rating_sum, b.rating_score),
+                    (0, 0, None)]
+
+        # Mess up the stats behind the model's back
+        table = model.Artwork.__table__
+        model.session.execute(table.update()
+            .where(table.c.id.in_([a.id, c.id]))
+            .values(rating_count=5, rating_sum=3, rating_score=0.5))
+
+        # In two batches
+        connection = model.session.connection()
+        last_id, changed = recalculate_batch(
+            connection, from_id=a.id, batch_size=2)
+        assert (last_id, changed) == (b.id, 1)
+        last_id, changed = recalculate_batch(
+            connection, from_id=last_id + 1, to_id=c.id, batch_size=2)
+        assert (last_id, changed) == (c.id, 1)
+        assert recalculate_batch(connection, from_id=c.id + 1) == (None, 0)
+
+        model.session.expire_all()
+        for artwork, (count, sum_, score) in zip(self.artwork, expected):
+            assert artwork.rating_count == count
+            assert abs(artwork.rating_sum - sum_) < 1e-9
+            if score is None:
+                assert artwork.rating_score is None
+            else:
+                assert abs(artwork.rating_score - score) < 1e-9
@@ -0,0 +1,80 @@
+import threading
+
+from floof.lib import richtext
+from floof.lib.richtext import render_many, render_rich_text
+
+
+def setup():
+    richtext._cache.invalidate()
+
+
+def test_render():
+    assert render_rich_text(u'') == u''
+    assert render_rich_text(u'*hi* there') == u'<p><em>hi</em> there</p>'
+    assert render_rich_text(u'caf\xe9') == u'<p>caf&#233;</p>'
+
+    # User content is cleaned up
+    assert render_rich_text(u'*x*<script>alert(1)</script>') == \
+        u'<p><em>x</em></p>'
+    assert render_rich_text(u'<b onclick="x">b</b>') == u'<p><b>b</b></p>'
+    assert render_rich_text(u'<h1>big</h1>') == u'big'
+    assert render_rich_text(u'see http://floofy.net/') == \
+        u'<p>see <a href="http://floofy.net/">http://floofy.net/</a></p>'
+
+    # Chrome isn't, much
+    assert render_rich_text(u'<h1>big</h1>', chrome=True) == u'<h1>big</h1>'
+    assert render_rich_text(u'*y*<script>x</script>', chrome=True) == \
+        u'<p><em>y</em></p>'
+
+
+def test_cache():
+    render_rich_text(u'**cached**')
+    key = richtext._cache_key(u'**cached**', False)
+    assert richtext._cache.get(key) == u'<p><strong>cached</strong></p>'
+
+    richtext._cache.set(key, u'from the cache')
+    assert render_rich_text(u'**cached**') == u'from the cache'
+    # Chrome is cached separately
+    assert render_rich_text(u'**cached**', chrome=True) == \
+        u'<p><strong>cached</strong></p>'
+
+
+def test_render_many():
+    richtext._cache.set(richtext._cache_key(u'old', False), u'from the cache')
+    texts = [u'*a*', None, u'old', u'b', u'*a*', u'']
+    assert render_many(texts) == [
+        u'<p><em>a</em></p>', u'', u'from the cache', u'<p>b</p>',
+        u'<p><em>a</em></p>', u'',
+    ]
+    assert render_many([]) == []
+
+    # Same as rendering one at a time, once the cache is out of the way
+    richtext._cache.invalidate()
+    texts = [u'- one\n- two', u'<i>x</i> <iframe></iframe>']
+    rendered = render_many(texts, chrome=True)
+    richtext._cache.invalidate()
+    assert rendered == [render_rich_text(text, chrome=True) for text in texts]
+
+
+def test_threads():
+    texts = [u'*{0}* http://floofy.net/{0}/'.format(i) for i in xrange(50)]
+    expected = [render_rich_text(text) for text in texts]
+    assert expected[7] == u'<p><em>7</em> <a href="http://floofy.net/7/">' \
+        u'http://floofy.net/7/</a></p>'
+    richtext._cache.invalidate()
+    results = []
+
+    def worker():
+        mine = [render_rich_text(text) for text in texts]
+        mine.extend(render_many(texts))
+        results.append(mine)
+
+    threads = [threading.Thread(target=worker) for i in xrange(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 8
+    for result in results:
+        assert result == expected * 2
@@ -0,0 +1,150 @@
+from webob.multidict import MultiDict
+
+from floof import model
+from floof.lib import search
+from floof.lib.gallery import GallerySieve
+from floof.tests import QueryCounter, UnitTests
+from floof.tests import sim
+
+
+def test_query_terms():
+    assert search.query_terms(u'') == []
+    assert search.query_terms(u'The cat, the HAT & a dog') == \
+        [u'the', u'cat', u'hat', u'dog']
+    assert search.query_terms(u'caf\xe9 x') == [u'caf\xe9']
+
+
+class TestSearch(UnitTests):
+
+    def setUp(self):
+        super(TestSearch, self).setUp()
+        self.artist = sim.sim_user(credentials=[])
+        self.artist.display_name = u'Painter'
+        self.artwork = [sim.sim_artwork(user=self.artist) for i in xrange(3)]
+        self.artwork[0].title = u'A red fox'
+        self.artwork[1].title = u'Blue sky'
+        self.artwork[1].remark = u'The fox is hiding'
+        self.artwork[2].title = u'Still life'
+        for artwork in self.artwork:
+            artwork.discussion = model.Discussion()
+        model.session.flush()
+
+    def _found(self, text, **kwargs):
+        return [resource_id for resource_id, rank
+            in search.search(model.session, text, **kwargs)]
+
+    def test_ranking(self):
+        red, blue, still = self.artwork
+        # A word in the title counts for more than in the remark
+        assert self._found(u'fox') == [red.resource_id, blue.resource_id]
+        assert self._found(u'FOX hiding') == [blue.resource_id]
+        assert self._found(u'fox nothing') == []
+        assert self._found(u'') == []
+
+        assert self._found(u'painter') == [self.artist.resource_id]
+        assert self._found(u'fox', resource_type=u'users') == []
+        assert self._found(u'fox', limit=1, offset=1) == [blue.resource_id]
+
+    def test_updates(self):
+        red, blue, still = self.artwork
+
+        # Changes are indexed as they're flushed
+        still.title = u'Fox at rest'
+        still.tag_objs.append(model.Tag(u'vulpine'))
+        model.session.flush()
+        assert set(self._found(u'fox')) == \
+            set(artwork.resource_id for artwork in self.artwork)
+        assert self._found(u'vulpine') == [still.resource_id]
+
+        comment = model.Comment(discussion=blue.discussion,
+            author=self.artist, content=u'Lovely clouds')
+        model.session.add(comment)
+        model.session.flush()
+        assert self._found(u'clouds') == [blue.resource_id]
+
+        comment.content = u'Lovely rain'
+        model.session.flush()
+        assert self._found(u'clouds') == []
+        assert self._found(u'rain') == [blue.resource_id]
+
+        model.session.delete(comment)
+        model.session.flush()
+        assert self._found(u'rain') == []
+
+    def test_comments(self):
+        red, blue, still = self.artwork
+
+        def post(content):
+            comment = model.Comment(discussion=blue.discussion,
+                author=self.artist, content=content)
+            model.session.add(comment)
+            model.session.flush()
+            return comment
+
+        # Each comment has its own entries, which add up
+        first = post(u'Rain rain')
+        second = post(u'More rain')
+        assert self._found(u'rain') == [blue.resource_id]
+        weights = model.session.query(model.SearchTerm.comment_id,
+                model.SearchTerm.weight) \
+            .filter_by(term=u'rain', resource_id=blue.resource_id) \
+            .order_by(model.SearchTerm.comment_id) \
+            .all()
+        assert weights == [
+            (first.id, 2 * model.SEARCH_WEIGHTS['comment']),
+            (second.id, model.SEARCH_WEIGHTS['comment']),
+        ]
+
+        model.session.delete(first)
+        model.session.flush()
+        assert self._found(u'rain') == [blue.resource_id]
+        model.session.delete(second)
+        model.session.flush()
+        assert self._found(u'rain') == []
+
+        # Posting costs the same however long the discussion is, and leaves
+        # the rest of the document alone
+        def flush_cost():
+            comment = model.Comment(discussion=blue.discussion,
+                author=self.artist, content=u'Another one')
+            model.session.add(comment)
+            with QueryCounter() as counter:
+                model.session.flush()
+            return counter.count
+        short = flush_cost()
+        for i in xrange(5):
+            post(u'Filler')
+        assert flush_cost() == short
+        assert self._found(u'fox hiding') == [blue.resource_id]
+
+        # Reindexing from scratch comes up with the same entries
+        def entries():
+            return sorted(model.session.query(model.SearchTerm.term,
+                model.SearchTerm.comment_id, model.SearchTerm.weight)
+                .filter_by(resource_id=blue.resource_id))
+        before = entries()
+        model.reindex_search_terms(model.session.connection(),
+            [blue.resource_id])
+        assert entries() == before
+
+    def test_unrelated_changes(self):
+        # Changing something that isn't searched doesn't touch the index
+        self.artwork[0].hot_score = 123.0
+        with QueryCounter() as counter:
+            model.session.flush()
+        assert counter.count == 1
+
+    def test_reindex(self):
+        red = self.artwork[0]
+        model.session.execute(model.SearchTerm.__table__.delete())
+        assert self._found(u'fox') == []
+
+        model.reindex_search_terms(model.session.connection(),
+            [red.resource_id])
+        assert self._found(u'fox') == [red.resource_id]
+
+    def test_gallery(self):
+        red, blue, still = self.artwork
+        sieve = GallerySieve(formdata=MultiDict(text=u'Fox'))
+        assert sieve.applied_filters == [('text', (u'fox',))]
+        assert set(sieve.evaluate().items) == set([red, blue])
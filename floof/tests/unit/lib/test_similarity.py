@@ -0,0 +1,115 @@
+import pytest
+from webob.multidict import MultiDict
+
+from floof import model
+from floof.lib import gallery
+from floof.lib.gallery import GallerySieve
+from floof.tests import QueryCounter, UnitTests
+from floof.tests import sim
+
+pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+from floof.lib.similarity import load_features, store_neighbors, top_neighbors
+
+
+class TestSimilarity(UnitTests):
+
+    def setUp(self):
+        super(TestSimilarity, self).setUp()
+        artist = sim.sim_user(credentials=[])
+        self.raters = [sim.sim_user(credentials=[]) for i in xrange(3)]
+        self.artwork = [sim.sim_artwork(user=artist) for i in xrange(4)]
+        model.session.flush()
+
+    def _build(self, top_k=20, batch_size=2):
+        connection = model.session.connection()
+        artwork_ids, features = load_features(connection)
+        for start in xrange(0, len(artwork_ids), batch_size):
+            stop = min(start + batch_size, len(artwork_ids))
+            store_neighbors(connection, artwork_ids, start,
+                top_neighbors(features, start, stop, top_k))
+        model.session.expire_all()
+
+    def _neighbors(self, artwork):
+        return [similarity.similar_artwork_id for similarity in
+            model.session.query(model.ArtworkSimilarity)
+                .filter_by(artwork_id=artwork.id)
+                .order_by(model.ArtworkSimilarity.similarity.desc())]
+
+    def test_neighbors(self):
+        a, b, c, d = self.artwork
+        tag = sim.sim_tag()
+        # a and b are liked by the same people; c shares a tag with a
+        for rater in self.raters[:2]:
+            model.ArtworkRating.set(model.session, a, rater, 1.0)
+            model.ArtworkRating.set(model.session, b, rater, 1.0)
+        model.ArtworkRating.set(model.session, c, self.raters[2], 1.0)
+        a.tag_objs.append(tag)
+        c.tag_objs.append(tag)
+        model.session.flush()
+
+        self._build()
+        assert self._neighbors(a) == [b.id, c.id] \
+            or self._neighbors(a) == [c.id, b.id]
+        assert self._neighbors(b) == [a.id]
+        assert self._neighbors(c) == [a.id]
+        assert self._neighbors(d) == []
+
+        # Only the closest are kept, and rebuilding replaces them
+        a.tag_objs.remove(tag)
+        model.session.flush()
+        self._build(top_k=1)
+        assert self._neighbors(a) == [b.id]
+        assert self._neighbors(c) == []
+
+    def test_suggest(self):
+        a, b, c, d = self.artwork
+        user = self.raters[0]
+        for rater in self.raters:
+            model.ArtworkRating.set(model.session, a, rater, 1.0)
+        for rater in self.raters[1:]:
+            model.ArtworkRating.set(model.session, c, rater, 1.0)
+        model.ArtworkRating.set(model.session, b, self.raters[1], 1.0)
+        self._build()
+
+        # The user liked a, which c is most like, then b
+        sieve = GallerySieve(user=user, formdata=MultiDict(sort=u'suggest'))
+        items = list(sieve.evaluate())
+        assert items[:2] == [c, b]
+        assert set(items) == set(self.artwork)
+
+        # Paging needs to be able to find the scores of single items, without
+        # asking the database again
+        key = sieve.sort_keys[0]
+        with QueryCounter() as counter:
+            assert key.getter(c) > key.getter(b) > key.getter(d) == 0
+        assert counter.count == 0
+        assert isinstance(key.getter(c), float)
+
+    def test_suggest_paging(self):
+        a, b, c, d = self.artwork
+        user = self.raters[0]
+        for rater in self.raters:
+            model.ArtworkRating.set(model.session, a, rater, 1.0)
+        model.ArtworkRating.set(model.session, b, self.raters[1], 1.0)
+        self._build()
+
+        original_page_size = gallery.PAGE_SIZE
+        gallery.PAGE_SIZE = 2
+        try:
+            sieve = GallerySieve(user=user,
+                formdata=MultiDict(sort=u'suggest'))
+            first = sieve.evaluate()
+            formdata = first.formdata_for_next()
+
+            # The cursor makes it through a URL and back
+            sieve = GallerySieve(user=user, formdata=MultiDict(formdata))
+            second = sieve.evaluate()
+            assert not second.is_first_page
+            assert set(first.items + second.items) == set(self.artwork)
+
+            sieve = GallerySieve(user=user,
+                formdata=MultiDict(second.formdata_for_previous()))
+            assert sieve.evaluate().items == first.items
+        finally:
+            gallery.PAGE_SIZE = original_page_size
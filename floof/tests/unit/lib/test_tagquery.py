@@ -0,0 +1,97 @@
+import pytest
+from webob.multidict import MultiDict
+
+from floof import model
+from floof.lib.gallery import GallerySieve
+from floof.lib.tagquery import And, Artist, Not, Or, Tag, TagQueryError
+from floof.lib.tagquery import parse
+from floof.tests import QueryCounter, UnitTests
+from floof.tests import sim
+
+
+def test_parse():
+    assert parse(u'') is None
+    assert parse(u'a') == Tag(u'a')
+    assert parse(u'a b') == And((Tag(u'a'), Tag(u'b')))
+    assert parse(u'a | b c') == Or((Tag(u'a'), And((Tag(u'b'), Tag(u'c')))))
+    assert parse(u'-a b') == And((Not(Tag(u'a')), Tag(u'b')))
+    assert parse(u'-(a|b)') == Not(Or((Tag(u'a'), Tag(u'b'))))
+    assert parse(u'by:eve a-b') == And((Artist(u'eve'), Tag(u'a-b')))
+
+    # Parsing what's printed gets the same tree back
+    for query in (u'a (b | -c) | by:eve', u'-(a b) | (c | d) e'):
+        node = parse(query)
+        assert parse(unicode(node)) == node
+
+    for bad in (u'(a', u'a)', u'a |', u'| a', u'-', u'of:eve', u'by:', u'()'):
+        with pytest.raises(TagQueryError):
+            parse(bad)
+
+
+class TestTagQueries(UnitTests):
+
+    def setUp(self):
+        super(TestTagQueries, self).setUp()
+        self.artists = [sim.sim_user(credentials=[]) for i in xrange(2)]
+        self.tags = dict((name, model.Tag(name)) for name in u'abc')
+
+        # One artwork per combination of tags, alternating artists
+        self.artwork = {}
+        for i, names in enumerate([u'', u'a', u'b', u'c', u'ab', u'abc']):
+            artist = self.artists[i % 2]
+            artwork = sim.sim_artwork(user=artist)
+            artwork.user_artwork.append(model.UserArtwork(user=artist))
+            artwork.tag_objs.extend(self.tags[name] for name in names)
+            self.artwork[names] = artwork
+        model.session.flush()
+
+    def _find(self, query):
+        sieve = GallerySieve()
+        missing = sieve.filter_by_tag_query(query)
+        names = set(name for name, artwork in self.artwork.iteritems()
+            if artwork in sieve.query.all())
+        return names, missing
+
+    def test_queries(self):
+        assert self._find(u'a') == (set([u'a', u'ab', u'abc']), [])
+        assert self._find(u'a b') == (set([u'ab', u'abc']), [])
+        assert self._find(u'a | c') == (set([u'a', u'c', u'ab', u'abc']), [])
+        assert self._find(u'a -c') == (set([u'a', u'ab']), [])
+        assert self._find(u'-a -b')[0] == set([u'', u'c'])
+        assert self._find(u'(a | b) -(a b)')[0] == set([u'a', u'b'])
+
+        artist = self.artists[1]
+        assert self._find(u'by:' + artist.name)[0] == set([u'a', u'c', u'abc'])
+        assert self._find(u'by:{0} b'.format(artist.name))[0] == set([u'abc'])
+
+    def test_missing(self):
+        assert self._find(u'a zzz') == (set(), [u'zzz'])
+        assert self._find(u'a -zzz')[0] == set([u'a', u'ab', u'abc'])
+        assert self._find(u'c | by:nobody') == \
+            (set([u'c', u'abc']), [u'by:nobody'])
+
+    def test_query_count(self):
+        # One query to look everything up, and one to find the art
+        query = u'a (b | -c) | by:{0}'.format(self.artists[0].name)
+        with QueryCounter() as counter:
+            sieve = GallerySieve()
+            sieve.filter_by_tag_query(query)
+            sieve.query.all()
+        assert counter.count == 2
+
+    def test_form(self):
+        sieve = GallerySieve(formdata=MultiDict(tags=u'a b'))
+        assert sieve.applied_filters == [('tag_query', u'a b')]
+        assert not sieve.form.errors
+
+        # A lone tag is precounted
+        sieve = GallerySieve(formdata=MultiDict(tags=u'a'))
+        assert sieve.applied_filters == [('tag', self.tags[u'a'].id)]
+
+        sieve = GallerySieve(formdata=MultiDict(tags=u'a (b'))
+        assert sieve.form.errors['tags'] == [u"Missing ')'"]
+        assert sieve.applied_filters == []
+
+        sieve = GallerySieve(formdata=MultiDict(tags=u'a zzz'))
+        assert sieve.form.errors['tags'] == [u"There's no such thing as 'zzz'"]
+        assert sieve.evaluate().items == []
@@ -0,0 +1,45 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+from floof.lib import upload
+from floof.tests import UnitTests
+
+# A 1x1 transparent PNG
+PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA'
+    '60e6kgAAAABJRU5ErkJggg==')
+
+
+class TestSpool(UnitTests):
+
+    def setUp(self):
+        super(TestSpool, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestSpool, self).tearDown()
+
+    def test_spool(self):
+        # Make sure it's read in more than one chunk
+        data = PNG + 'x' * (upload.CHUNK_SIZE * 2)
+        spooled = upload.spool(StringIO(data), self.directory)
+
+        assert os.path.dirname(spooled.path) == self.directory
+        assert spooled.mimetype == u'image/png'
+        assert spooled.hash == hashlib.sha256(data).hexdigest()
+        assert spooled.file_size == len(data)
+        with open(spooled.path, 'rb') as f:
+            assert f.read() == data
+
+        spooled.discard()
+        assert not os.listdir(self.directory)
+
+    def test_spool_empty(self):
+        spooled = upload.spool(StringIO(''), self.directory)
+        assert spooled.file_size == 0
+        assert spooled.hash == hashlib.sha256('').hexdigest()
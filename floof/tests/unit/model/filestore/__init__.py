@@ -52,9 +52,9 @@ def storage_put_tester(storage):
     # Check the values of the tuple inserted into storage.stage
     entry = storage.stage[idx]
     assert len(entry) == 3
-    c, k, d = entry
+    c, k, path = entry
     assert c == cls
     assert k == key
-    d.seek(0)
     data.seek(0)
-    assert d.read() == data.read()
+    with open(path, 'rb') as f:
+        assert f.read() == data.read()
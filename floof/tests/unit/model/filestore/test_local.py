@@ -76,8 +76,8 @@ class TestLocalFileStore(UnitTests):
         storage.commit(trxn)
         storage.tpc_vote(trxn)
 
-        stagecopy = [(c, k) for c, k, d in storage.stage.itervalues()]
-        temppaths = storage.tempfiles.values()
+        stagecopy = [(c, k) for c, k, path in storage.stage.itervalues()]
+        temppaths = [path for c, k, path in storage.stage.itervalues()]
 
         # At this stage, the new files should be written out to the temp dir
         for temppath in temppaths:
@@ -96,7 +96,7 @@ class TestLocalFileStore(UnitTests):
     def test_other_dm_fail(self):
         storage = self._get_storage()
         cls, key, data = storage_put(storage)
-        assert not os.listdir(self.tempdir)
+        assert len(os.listdir(self.tempdir)) == 1
 
         # Simulate voting failure of another datamanager during commit
         transaction.get().join(AlwaysFailDataManager())
@@ -106,3 +106,27 @@ class TestLocalFileStore(UnitTests):
         # The tempfiles should have been cleaned up on failure
         assert os.path.exists(self.tempdir)
         assert not os.listdir(self.tempdir)
+
+    def test_put_path(self):
+        storage = self._get_storage()
+
+        # Files elsewhere are moved into the temp dir...
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write('foo')
+        storage.put_path(u'artwork', u'foo', path)
+        assert not os.path.exists(path)
+
+        # ...and files already there are left where they are
+        fd, path = tempfile.mkstemp(dir=storage.tempdir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write('bar')
+        storage.put_path(u'artwork', u'bar', path)
+        assert storage.stage[storage._idx(u'artwork', u'bar')][2] == path
+
+        transaction.commit()
+
+        assert not os.listdir(self.tempdir)
+        for key in (u'foo', u'bar'):
+            with open(storage._path(self.directory, u'artwork', key)) as f:
+                assert f.read() == key
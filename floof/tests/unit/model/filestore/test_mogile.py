@@ -62,3 +62,67 @@ class TestMogileFileStore(UnitTests):
 
         # The tempfiles should have been cleaned up on failure
         assert not storage.url(cls, key)
+
+
+class FakeClient(object):
+    """Stands in for a pymogile client, counting tracker requests."""
+    files = {u'thumbnail:abc': [u'http://storage/abc']}
+    requests = 0
+
+    def __init__(self, domain, trackers):
+        pass
+
+    def get_paths(self, ident, pathcount=2):
+        FakeClient.requests += 1
+        if ident not in self.files:
+            raise self.error('unknown_key unknown_key', 'unknown_key')
+        return self.files[ident]
+
+
+class TestTrackerPool(UnitTests):
+
+    def setUp(self):
+        super(TestTrackerPool, self).setUp()
+        pymogile = pytest.importorskip('pymogile')
+        from floof.model.filestore import mogilefs
+
+        FakeClient.error = pymogile.MogileFSError
+        FakeClient.requests = 0
+        self.original_client = pymogile.Client
+        pymogile.Client = FakeClient
+        self.pool = mogilefs.TrackerPool(u'floof', [u'localhost:7001'])
+
+    def tearDown(self):
+        import pymogile
+        pymogile.Client = self.original_client
+        super(TestTrackerPool, self).tearDown()
+
+    def test_client_reuse(self):
+        with self.pool.client() as client:
+            pass
+        with self.pool.client() as other_client:
+            assert other_client is client
+
+        # Clients that saw trouble aren't trusted again
+        with pytest.raises(IntentionalError):
+            with self.pool.client() as client:
+                raise IntentionalError
+        with self.pool.client() as other_client:
+            assert other_client is not client
+
+    def test_get_paths(self):
+        idents = [u'thumbnail:abc', u'thumbnail:def']
+        expected = {
+            u'thumbnail:abc': [u'http://storage/abc'],
+            u'thumbnail:def': [],
+        }
+        assert self.pool.get_paths(idents) == expected
+        assert FakeClient.requests == 2
+
+        # Both found and missing files are remembered
+        assert self.pool.get_paths(idents) == expected
+        assert FakeClient.requests == 2
+
+        self.pool.forget(u'thumbnail:def')
+        self.pool.get_paths(idents)
+        assert FakeClient.requests == 3
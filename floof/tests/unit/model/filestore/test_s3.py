@@ -0,0 +1,153 @@
+import urllib2
+
+import pytest
+import transaction
+
+from floof.model.filestore import get_storage_factory
+from floof.tests import UnitTests
+from floof.tests.unit.model.filestore import AlwaysFailDataManager
+from floof.tests.unit.model.filestore import IntentionalError
+from floof.tests.unit.model.filestore import storage_put, storage_put_tester
+
+boto = pytest.importorskip('boto')
+from floof.tests import s3_server
+
+server = None
+
+def setup_module(module):
+    global server
+    server = s3_server.start_server()
+
+def teardown_module(module):
+    server.shutdown()
+    server.server_close()
+
+
+class TestS3FileStore(UnitTests):
+    """Runs against a real bucket or S3-compatible server, if the test config
+    sets one up as the filestore, and against `floof.tests.s3_server`
+    otherwise."""
+
+    def setUp(self):
+        super(TestS3FileStore, self).setUp()
+
+        settings = self.config.registry.settings
+        if settings.get('filestore') == 's3':
+            self.settings = settings
+            self.fake = False
+        else:
+            self.settings = {
+                'filestore': 's3',
+                'filestore.bucket': 'floof-test',
+                'filestore.access_key': 'floof',
+                'filestore.secret_key': 'floof',
+                'filestore.host': server.server_address[0],
+                'filestore.port': str(server.server_address[1]),
+                'filestore.is_secure': 'false',
+            }
+            self.fake = True
+
+    def _get_storage(self, **settings):
+        settings = dict(self.settings, **settings)
+        storage = get_storage_factory(settings)()
+        trxn = transaction.begin()
+        trxn.join(storage)
+
+        return storage
+
+    def _temp_keys(self, storage):
+        return list(storage.bucket.list(prefix=storage.prefix + '__temp__'))
+
+    def test_put(self):
+        storage = self._get_storage()
+        assert len(storage.stage) == 0
+        storage_put_tester(storage)
+
+    def test_url(self):
+        storage = self._get_storage()
+        cls, key, data = storage_put(storage)
+
+        # URL should not be available immediately
+        assert not storage.url(cls, key)
+
+        transaction.commit()
+
+        # ... but must be available after commit
+        url = storage.url(cls, key)
+        fetched = urllib2.urlopen(url, timeout=5)
+        assert fetched.read() == data.read()
+
+        # The copy under a temporary key is gone
+        assert not self._temp_keys(storage)
+
+    def test_urls(self):
+        storage = self._get_storage()
+        puts = [storage_put(storage, class_=u'thumbnail') for i in xrange(3)]
+        transaction.commit()
+
+        keys = [key for cls, key, data in puts]
+        if self.fake:
+            requests = server.requests
+        urls = storage.urls(u'thumbnail', keys)
+        if self.fake:
+            # Signing URLs in bulk doesn't ask S3 about each file
+            assert server.requests == requests
+
+        for cls, key, data in puts:
+            fetched = urllib2.urlopen(urls[key], timeout=5)
+            assert fetched.read() == data.read()
+
+    def test_content_type(self):
+        """The staged files have no extension, so S3 can't know what they
+        are; the URLs have to tell it."""
+        storage = self._get_storage()
+        cls, key, data = storage_put(storage)
+        transaction.commit()
+
+        disposition = 'inline; filename=floof.png'
+        fetched = urllib2.urlopen(storage.url(cls, key,
+            content_type='image/png', disposition=disposition), timeout=5)
+        assert fetched.info()['Content-Type'] == 'image/png'
+        assert fetched.info()['Content-Disposition'] == disposition
+
+        urls = storage.urls(cls, [key], content_type='image/jpeg')
+        fetched = urllib2.urlopen(urls[key], timeout=5)
+        assert fetched.info()['Content-Type'] == 'image/jpeg'
+        assert 'Content-Disposition' not in fetched.info()
+
+    def test_multipart(self):
+        # 5 MiB parts are the smallest S3 allows
+        storage = self._get_storage(**{
+            'filestore.multipart_threshold': '1',
+            'filestore.part_size': '5',
+        })
+        data = 'floof' * (3 * 2 ** 20)
+        cls, key, data = storage_put(storage, data=data)
+        transaction.commit()
+
+        fetched = urllib2.urlopen(storage.url(cls, key), timeout=30)
+        assert fetched.read() == data.read()
+        if self.fake:
+            assert not server.uploads
+
+    def test_other_dm_fail(self):
+        storage = self._get_storage()
+        cls, key, data = storage_put(storage)
+
+        # Simulate voting failure of another datamanager during commit
+        transaction.get().join(AlwaysFailDataManager())
+        with pytest.raises(IntentionalError):
+            transaction.commit()
+
+        # Nothing should be left behind
+        assert not storage.url(cls, key)
+        assert not self._temp_keys(storage)
+
+
+class TestMultipart(UnitTests):
+
+    def test_split_parts(self):
+        from floof.model.filestore.s3 import split_parts
+
+        assert split_parts(10, 4) == [(1, 0, 4), (2, 4, 4), (3, 8, 2)]
+        assert split_parts(8, 4) == [(1, 0, 4), (2, 4, 4)]
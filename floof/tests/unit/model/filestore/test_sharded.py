@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+
+import transaction
+
+from floof.model.filestore import get_storage_factory
+from floof.model.filestore.sharded import reshard, shard_path
+from floof.tests import UnitTests
+from floof.tests.unit.model.filestore import storage_put
+
+
+class TestShardedFileStore(UnitTests):
+
+    def setUp(self):
+        super(TestShardedFileStore, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestShardedFileStore, self).tearDown()
+
+    def _get_storage(self, **settings):
+        settings['filestore'] = 'sharded'
+        settings['filestore.directory'] = self.directory
+        storage = get_storage_factory(settings)()
+        transaction.begin().join(storage)
+        return storage
+
+    def test_shard_path(self):
+        assert shard_path(u'/files', u'artwork', u'abcdef', 2, 2) \
+            == u'/files/artwork/ab/cd/abcdef'
+        assert shard_path(u'/files', u'artwork', u'abc', 3, 1) \
+            == u'/files/artwork/a/b/c/abc'
+        assert shard_path(u'/files', u'artwork', u'a', 2, 2) \
+            == u'/files/artwork/a_/__/a'
+        assert shard_path(u'/files', u'artwork', u'abc', 0, 2) \
+            == u'/files/artwork/abc'
+
+    def test_commit(self):
+        storage = self._get_storage(**{'filestore.depth': '3'})
+        files = [storage_put(storage) for n in xrange(3)]
+        transaction.commit()
+
+        assert os.listdir(storage.tempdir) == []
+        for cls, key, data in files:
+            path = shard_path(self.directory, cls, key, 3, 2)
+            assert storage.url(cls, key) == 'file://' + path
+            with open(path, 'rb') as f:
+                assert f.read() == data.read()
+
+    def test_deleted_directory(self):
+        """Test that directories deleted behind the storage's back are made
+        again."""
+        storage = self._get_storage()
+        cls, key, data = storage_put(storage)
+        transaction.commit()
+
+        shutil.rmtree(os.path.join(self.directory, cls))
+        storage = self._get_storage()
+        storage.put(cls, key, data)
+        transaction.commit()
+        assert os.path.isfile(storage._path(self.directory, cls, key))
+
+    def test_reshard(self):
+        # Start out with plain local storage
+        storage = get_storage_factory({
+            'filestore': 'local',
+            'filestore.directory': self.directory,
+        })()
+        transaction.begin().join(storage)
+        files = [storage_put(storage) for n in xrange(5)]
+        transaction.commit()
+
+        assert reshard(self.directory, 2, 2) == 5
+        assert reshard(self.directory, 2, 2) == 0
+
+        storage = self._get_storage()
+        for cls, key, data in files:
+            with open(storage._path(self.directory, cls, key), 'rb') as f:
+                assert f.read() == data.read()
+
+        # Nothing is left of the old layout
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.directory, u'artwork')):
+            assert dirnames or filenames
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import time
+
+import transaction
+
+from floof.model.filestore import get_storage_factory
+from floof.model.filestore.tiered import CacheDirectory
+from floof.tests import UnitTests
+from floof.tests.unit.model.filestore import storage_put, storage_put_tester
+
+
+class TestTieredFileStore(UnitTests):
+
+    def setUp(self):
+        super(TestTieredFileStore, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.primary_directory = os.path.join(self.directory, 'primary')
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        os.mkdir(self.primary_directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestTieredFileStore, self).tearDown()
+
+    def _get_storage(self):
+        settings = {
+            'filestore': 'tiered',
+            'filestore.directory': self.cache_directory,
+            'filestore.primary': 'local',
+            'filestore.primary.directory': self.primary_directory,
+            'filestore.policy': 'demand',
+            'filestore.policy.thumbnail': 'always',
+            'filestore.policy.secret': 'never',
+        }
+        storage = get_storage_factory(settings)()
+        transaction.begin().join(storage)
+        return storage
+
+    def _cache_path(self, storage, cls, key):
+        return storage.cache.path(cls, key)
+
+    def _primary_path(self, storage, cls, key):
+        return storage.primary._path(self.primary_directory, cls, key)
+
+    def test_put(self):
+        storage = self._get_storage()
+        assert storage.tempdir == storage.primary.tempdir
+        storage_put_tester(storage)
+
+    def test_write_through(self):
+        storage = self._get_storage()
+        thumbnail = storage_put(storage, class_=u'thumbnail')
+        artwork = storage_put(storage, class_=u'artwork')
+        transaction.commit()
+
+        # Everything lands in the primary, but only thumbnails are cached
+        for cls, key, data in thumbnail, artwork:
+            assert os.path.isfile(self._primary_path(storage, cls, key))
+        cls, key, data = thumbnail
+        with open(self._cache_path(storage, cls, key), 'rb') as f:
+            assert f.read() == data.read()
+        cls, key, data = artwork
+        assert not os.path.exists(self._cache_path(storage, cls, key))
+
+        assert not os.listdir(storage.cache.tempdir)
+
+    def test_abort(self):
+        storage = self._get_storage()
+        cls, key, data = storage_put(storage, class_=u'thumbnail')
+        transaction.abort()
+
+        assert not os.path.exists(self._cache_path(storage, cls, key))
+        assert not os.listdir(storage.cache.tempdir)
+
+    def test_read_through(self):
+        storage = self._get_storage()
+        artwork = storage_put(storage, class_=u'artwork')
+        secret = storage_put(storage, class_=u'secret')
+        transaction.commit()
+
+        storage = self._get_storage()
+        cls, key, data = artwork
+        path = self._cache_path(storage, cls, key)
+        assert storage.url(cls, key) == 'file://' + path
+        with open(path, 'rb') as f:
+            assert f.read() == data.read()
+
+        # Batches don't fetch on demand
+        cls, key, data = storage_put(storage, class_=u'artwork')
+        transaction.commit()
+        storage = self._get_storage()
+        assert storage.urls(cls, [key]) == {
+            key: 'file://' + self._primary_path(storage, cls, key)}
+
+        cls, key, data = secret
+        assert storage.url(cls, key) == \
+            'file://' + self._primary_path(storage, cls, key)
+        assert not os.path.exists(self._cache_path(storage, cls, key))
+
+
+class TestCacheDirectory(UnitTests):
+
+    def setUp(self):
+        super(TestCacheDirectory, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestCacheDirectory, self).tearDown()
+
+    def _add(self, cache, key, size):
+        fd, path = tempfile.mkstemp(dir=cache.tempdir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write('x' * size)
+        cache.add(u'thumbnail', key, path)
+
+        # Let any sweep finish
+        sweeper = cache._sweeper
+        if sweeper:
+            sweeper.join()
+        return cache.path(u'thumbnail', key)
+
+    def test_eviction(self):
+        cache = CacheDirectory(self.directory, max_size=250)
+        a = self._add(cache, u'aaaa', 100)
+        b = self._add(cache, u'bbbb', 100)
+
+        # a was used more recently than b
+        then = time.time() - 60
+        os.utime(b, (then, then))
+        cache.touch(a)
+
+        c = self._add(cache, u'cccc', 100)
+        assert os.path.exists(a)
+        assert not os.path.exists(b)
+        assert os.path.exists(c)
+
+        # Sweeps only happen when the tally goes over
+        assert cache._size == 200
+        self._add(cache, u'dddd', 10)
+        assert cache._sweeper is None
+        assert cache._size == 210
+
+    def test_check_url(self):
+        cache = CacheDirectory(self.directory, max_size=250)
+        path = self._add(cache, u'aaaa', 100)
+        then = time.time() - 60
+        os.utime(path, (then, then))
+
+        storage_class = get_storage_factory(
+            {'filestore': 'tiered'}).storage_class
+        assert storage_class.check_url('http://example.com/aaaa')
+        assert storage_class.check_url('file://' + path)
+        assert os.stat(path).st_atime > then
+
+        os.remove(path)
+        assert not storage_class.check_url('file://' + path)
@@ -0,0 +1,72 @@
+from floof import model
+from floof.tests import QueryCounter, UnitTests
+from floof.tests import sim
+
+
+class TestCommentThreading(UnitTests):
+
+    def setUp(self):
+        super(TestCommentThreading, self).setUp()
+        self.user = sim.sim_user(credentials=[])
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.discussion = self.discussion = model.Discussion()
+        model.session.flush()
+
+    def _post(self, content, parent=None):
+        comment = model.Comment(discussion=self.discussion, parent=parent,
+            author=self.user, content=content)
+        model.session.add(comment)
+        model.session.flush()
+        return comment
+
+    def _contents(self, comments):
+        return [comment.content for comment in comments]
+
+    def test_threading(self):
+        # Replies posted out of order still come out depth-first
+        a = self._post(u'a')
+        b = self._post(u'b')
+        a1 = self._post(u'a1', a)
+        b1 = self._post(u'b1', b)
+        a2 = self._post(u'a2', a)
+        a1x = self._post(u'a1x', a1)
+
+        assert [c.depth for c in (a, a1, a1x)] == [0, 1, 2]
+        assert a1x.ancestor_ids == [a.id, a1.id]
+        assert a1x.is_descendant_of(a) and not a1x.is_descendant_of(b)
+
+        model.session.expire_all()
+        assert self._contents(self.discussion.comments) == \
+            [u'a', u'a1', u'a1x', u'a2', u'b', u'b1']
+        assert self._contents(a.descendants_query) == \
+            [u'a', u'a1', u'a1x', u'a2']
+        assert self._contents(a1x.descendants_query) == [u'a1x']
+        assert self._contents(a1x.ancestors_query) == [u'a', u'a1']
+        assert self._contents(a.ancestors_query) == []
+
+    def test_same_flush(self):
+        # A reply can go in with its parent
+        parent = model.Comment(discussion=self.discussion,
+            author=self.user, content=u'parent')
+        reply = model.Comment(discussion=self.discussion, parent=parent,
+            author=self.user, content=u'reply')
+        model.session.add_all([parent, reply])
+        model.session.flush()
+
+        assert reply.ancestor_ids == [parent.id]
+        assert self._contents(parent.descendants_query) == \
+            [u'parent', u'reply']
+
+    def test_insertion_cost(self):
+        # Replying never touches other comments, however many there are
+        parent = self._post(u'parent')
+        for i in xrange(5):
+            self._post(u'sibling', parent)
+
+        with QueryCounter() as first:
+            self._post(u'reply', parent)
+        for i in xrange(5):
+            self._post(u'sibling', parent)
+        with QueryCounter() as second:
+            self._post(u'reply', parent)
+        assert first.count == second.count
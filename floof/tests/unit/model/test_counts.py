@@ -0,0 +1,111 @@
+from sqlalchemy.sql.expression import Update
+
+from floof import model
+from floof.lib.gallery import GallerySieve
+from floof.tests import UnitTests
+from floof.tests import sim
+
+
+class TestArtworkCounts(UnitTests):
+
+    def setUp(self):
+        super(TestArtworkCounts, self).setUp()
+        self.user = sim.sim_user()
+
+    def _count(self, subject_type, subject):
+        return model.ArtworkCount.get(self.session, subject_type, subject.id)
+
+    def _sim_artwork(self):
+        artwork = sim.sim_artwork(user=self.user)
+        artwork.user_artwork.append(model.UserArtwork(user=self.user))
+        return artwork
+
+    def test_artists(self):
+        assert self._count(u'user', self.user) == 0
+
+        artwork = [self._sim_artwork() for i in xrange(3)]
+        model.session.flush()
+        assert self._count(u'user', self.user) == 3
+
+        model.session.delete(artwork[0].user_artwork[0])
+        model.session.flush()
+        assert self._count(u'user', self.user) == 2
+
+    def test_tags(self):
+        tag = sim.sim_tag()
+        artwork = [self._sim_artwork() for i in xrange(3)]
+        for a in artwork:
+            a.tag_objs.append(tag)
+        model.session.flush()
+        assert self._count(u'tag', tag) == 3
+
+        # Either end of the relationship should work
+        artwork[0].tag_objs.remove(tag)
+        tag.artwork.remove(artwork[1])
+        model.session.flush()
+        assert self._count(u'tag', tag) == 1
+
+        # As should the association proxy
+        artwork[0].tags.append(tag.name)
+        model.session.flush()
+        assert self._count(u'tag', tag) == 2
+
+    def test_albums(self):
+        album = model.Album(name=u'foo', encapsulation=u'public')
+        self.user.albums.append(album)
+        artwork = [self._sim_artwork() for i in xrange(2)]
+        artwork[0].albums.append(album)
+        album.artwork.append(artwork[1])
+        model.session.flush()
+        assert self._count(u'album', album) == 2
+
+        artwork[1].albums.remove(album)
+        model.session.flush()
+        assert self._count(u'album', album) == 1
+
+    def test_new_subjects(self):
+        """Counts are created with their subjects, so the first piece of art
+        only has to update one, and can't race another to insert it."""
+        tag = sim.sim_tag()
+        album = model.Album(name=u'foo', encapsulation=u'public')
+        self.user.albums.append(album)
+        model.session.flush()
+        assert self._count(u'user', self.user) == 0
+        assert self._count(u'tag', tag) == 0
+        assert self._count(u'album', album) == 0
+
+        statements = []
+        class RecordingConnection(object):
+            def __init__(self, connection):
+                self.connection = connection
+
+            def execute(self, statement, *args, **kwargs):
+                statements.append(statement)
+                return self.connection.execute(statement, *args, **kwargs)
+
+        model._bump_artwork_count(
+            RecordingConnection(model.session.connection()),
+            u'tag', tag.id, 1)
+        assert len(statements) == 1
+        assert isinstance(statements[0], Update)
+        assert self._count(u'tag', tag) == 1
+
+    def test_gallery_uses_counts(self):
+        for i in xrange(3):
+            self._sim_artwork()
+        model.session.flush()
+
+        # Fudge the count, to check it's actually being used
+        model.session.query(model.ArtworkCount) \
+            .filter_by(subject_type=u'user', subject_id=self.user.id) \
+            .update({'artwork_count': 30})
+
+        gallery_sieve = GallerySieve(countable=True)
+        gallery_sieve.filter_by_artist(self.user)
+        assert gallery_sieve.evaluate().item_count == 30
+
+        # But not when there's more than just the one filter
+        gallery_sieve = GallerySieve(countable=True)
+        gallery_sieve.filter_by_artist(self.user)
+        gallery_sieve.filter_by_age(model.now())
+        assert gallery_sieve.evaluate().item_count == 3
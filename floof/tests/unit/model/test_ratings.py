@@ -0,0 +1,68 @@
+from floof import model
+from floof.model.extensions import wilson_score
+from floof.tests import UnitTests
+from floof.tests import sim
+
+
+class TestArtworkRatings(UnitTests):
+
+    def setUp(self):
+        super(TestArtworkRatings, self).setUp()
+        self.artist = sim.sim_user(credentials=[])
+        self.artwork = sim.sim_artwork(user=self.artist)
+        self.raters = [sim.sim_user(credentials=[]) for i in xrange(3)]
+        model.session.flush()
+
+    def _check(self, ratings):
+        """Checks the artwork's stats against the DB and the given ratings."""
+        artwork = self.artwork
+        assert artwork.rating_count == len(ratings)
+        assert abs(artwork.rating_sum - sum(ratings)) < 1e-9
+        if ratings:
+            expected = wilson_score(len(ratings), sum(ratings))
+            assert abs(artwork.rating_score - expected) < 1e-9
+        else:
+            assert artwork.rating_score is None
+
+    def test_stats(self):
+        self._check([])
+
+        for rater, rating in zip(self.raters, [1.0, 0.5, -1.0]):
+            model.ArtworkRating.set(
+                model.session, self.artwork, rater, rating)
+        self._check([1.0, 0.5, -1.0])
+
+        # Changing a rating replaces it
+        model.ArtworkRating.set(
+            model.session, self.artwork, self.raters[2], 1.0)
+        self._check([1.0, 0.5, 1.0])
+        assert len(self.artwork.ratings) == 3
+
+        rating_obj = model.session.query(model.ArtworkRating) \
+            .filter_by(user=self.raters[0]) \
+            .one()
+        model.session.delete(rating_obj)
+        model.session.flush()
+        self._check([0.5, 1.0])
+
+    def test_plain_orm(self):
+        # Ratings added the ordinary way count too
+        for rater, rating in zip(self.raters, [-0.5, -0.5]):
+            model.session.add(model.ArtworkRating(
+                artwork=self.artwork, user=rater, rating=rating))
+        model.session.flush()
+        self._check([-0.5, -0.5])
+
+    def test_concurrent_stats(self):
+        # Stats are adjusted in the database, not from the values in memory
+        model.ArtworkRating.set(
+            model.session, self.artwork, self.raters[0], 1.0)
+        table = model.Artwork.__table__
+        model.session.execute(table.update()
+            .where(table.c.id == self.artwork.id)
+            .values(rating_count=table.c.rating_count + 1,
+                    rating_sum=table.c.rating_sum - 1))
+
+        model.ArtworkRating.set(
+            model.session, self.artwork, self.raters[1], 0.5)
+        self._check([1.0, -1.0, 0.5])
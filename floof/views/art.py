@@ -1,17 +1,19 @@
 # encoding: utf8
 from __future__ import division
-from cStringIO import StringIO
-import hashlib
+import json
 import logging
 
-import magic
 from pyramid.httpexceptions import HTTPBadRequest, HTTPSeeOther
 from pyramid.view import view_config, view_defaults
+from sqlalchemy.orm import joinedload
 import wtforms.form, wtforms.fields, wtforms.validators
 
 from floof import model
 from floof.forms import MultiCheckboxField, MultiTagField, QueryMultiCheckboxField
+from floof.lib import derivatives
+from floof.lib.comments import CommentPage
 from floof.lib.gallery import GallerySieve
+from floof.lib.upload import spool
 from floof.views._workflow import FormWorkflow
 
 # PIL is an unholy fucking abomination that can't even be imported right
@@ -22,8 +24,8 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
-HASH_BUFFER_SIZE = 524288  # .5 MiB
-MAX_ASPECT_RATIO = 2
+# How much "art like this" to show alongside art
+SIMILAR_ARTWORK_COUNT = 8
 
 
 # XXX import from somewhere
@@ -119,26 +121,19 @@ class UploadPage(FormWorkflow):
                 level=u'error')
             return self.respond_general_error()
 
-        # Figure out mimetype (and if we even support it)
-        mimetype = magic.Magic(mime=True).from_buffer(fileobj.read(1024)) \
-            .decode('ascii')
+        # Copy the file to disk, figuring out its mimetype and hash on the way
+        spooled = spool(fileobj, storage.tempdir)
+        mimetype = spooled.mimetype
+        hash = spooled.hash
+
+        # Check that we even support it
         if mimetype not in (u'image/png', u'image/gif', u'image/jpeg'):
+            spooled.discard()
             # XXX this seems suboptimal, but...
-            form.file.errors.append("Only PNG, GIF, and JPEG are supported at the moment.")
-            return self.respond_form_invalid()
-
-        # Hash the thing
-        hasher = hashlib.sha256()
-        file_size = 0
-        fileobj.seek(0)
-        while True:
-            buffer = fileobj.read(HASH_BUFFER_SIZE)
-            if not buffer:
-                break
-
-            file_size += len(buffer)
-            hasher.update(buffer)
-        hash = hasher.hexdigest().decode('ascii')
+            message = u"Only PNG, GIF, and JPEG are supported at the moment."
+            form.file.errors.append(message)
+            self.request.session.flash(message, level=u'error')
+            return self.respond_form_error()
 
         # Assert that the thing is unique
         existing_artwork = model.session.query(model.Artwork) \
@@ -146,6 +141,7 @@ class UploadPage(FormWorkflow):
             .limit(1) \
             .all()
         if existing_artwork:
+            spooled.discard()
             self.request.session.flash(
                 u'This artwork has already been uploaded.',
                 level=u'warning',
@@ -153,50 +149,25 @@ class UploadPage(FormWorkflow):
             return self.respond_redirect(
                 request.route_url('art.view', artwork=existing_artwork[0]))
 
+        # Open the image and determine its size.  PIL only reads the header
+        # for this; decoding the whole thing for thumbnails is left to the
+        # derivative worker.  This keeps the file open, so it's fine that the
+        # storage may move it
+        try:
+            image = Image.open(spooled.path)
+            width, height = image.size
+        except IOError:
+            spooled.discard()
+            message = u"This file seems to be damaged; it can't be read as " \
+                u"an image."
+            form.file.errors.append(message)
+            self.request.session.flash(message, level=u'error')
+            return self.respond_form_error()
+
         ### By now, all error-checking should be done.
 
-        # OK, store the file.  Reset the file object first!
-        fileobj.seek(0)
-        storage.put(u'artwork', hash, fileobj)
-
-        # Open the image, determine its size, and generate a thumbnail
-        fileobj.seek(0)
-        image = Image.open(fileobj)
-        width, height = image.size
-
-        # Thumbnailin'
-        # NOTE: this logic is replicated in the upload JS; please keep in sync
-        thumbnail_size = int(request.registry.settings['thumbnail_size'])
-        # To avoid super-skinny thumbnails, don't let the aspect ratio go
-        # beyond 2
-        height = min(height, width * MAX_ASPECT_RATIO)
-        width = min(width, height * MAX_ASPECT_RATIO)
-        # crop() takes left, top, right, bottom
-        cropped_image = image.crop((0, 0, width, height))
-        # And resize...  if necessary
-        if width > thumbnail_size or height > thumbnail_size:
-            if width > height:
-                new_size = (thumbnail_size, height * thumbnail_size // width)
-            else:
-                new_size = (width * thumbnail_size // height, thumbnail_size)
-
-            thumbnail_image = cropped_image.resize(
-                new_size, Image.ANTIALIAS)
-
-        else:
-            thumbnail_image = cropped_image
-
-        # Dump the thumbnail in a buffer and save it, too
-        buf = StringIO()
-        if mimetype == u'image/png':
-            thumbnail_format = 'PNG'
-        elif mimetype == u'image/gif':
-            thumbnail_format = 'GIF'
-        elif mimetype == u'image/jpeg':
-            thumbnail_format = 'JPEG'
-        thumbnail_image.save(buf, thumbnail_format)
-        buf.seek(0)
-        storage.put(u'thumbnail', hash, buf)
+        # OK, store the file.  The storage takes over the spooled copy
+        storage.put_path(u'artwork', hash, spooled.path)
 
         # Deal with user-supplied metadata
         # nb: it's perfectly valid to have no title or remark
@@ -212,7 +183,7 @@ class UploadPage(FormWorkflow):
             uploader = request.user,
             original_filename = uploaded_file.filename,
             mime_type = mimetype,
-            file_size = file_size,
+            file_size = spooled.file_size,
             resource = resource,
             remark = remark,
         )
@@ -230,6 +201,9 @@ class UploadPage(FormWorkflow):
             )
         )
 
+        # Thumbnails and such will be generated in the background
+        derivatives.enqueue(artwork, request.registry.settings['renditions'])
+
         # Attach tags and albums
         for tag in form.tags.data:
             artwork.tags.append(tag)
@@ -286,9 +260,22 @@ def view(artwork, request):
         if rating_obj:
             current_rating = rating_obj.rating
 
+    # Art like this, precomputed by floof.lib.similarity
+    similar_artwork = model.session.query(model.Artwork) \
+        .join((model.ArtworkSimilarity,
+            model.ArtworkSimilarity.similar_artwork_id == model.Artwork.id)) \
+        .filter(model.ArtworkSimilarity.artwork_id == artwork.id) \
+        .order_by(model.ArtworkSimilarity.similarity.desc()) \
+        .options(joinedload('uploader')) \
+        .limit(SIMILAR_ARTWORK_COUNT) \
+        .all()
+
     return dict(
         artwork=artwork,
         current_rating=current_rating,
+        similar_artwork=similar_artwork,
+        comment_page=CommentPage(
+            model.session, artwork.discussion, request.GET),
         comment_form=CommentForm(),
         add_tag_form=AddTagForm(),
         remove_tag_form=RemoveTagForm(),
@@ -312,23 +299,10 @@ def rate(artwork, request):
     except (KeyError, ValueError):
         return HTTPBadRequest()
 
-    # Get the previous rating, if there was one
-    rating_obj = model.session.query(model.ArtworkRating) \
-        .filter_by(artwork=artwork, user=request.user) \
-        .first()
-
-    # Update the rating or create it and add it to the db.
+    # Update the rating or create it.
     # n.b.: The model is responsible both for ensuring that the rating is
     # within [-1, 1], and updating rating stats on the artwork
-    if rating_obj:
-        rating_obj.rating = rating
-    else:
-        rating_obj = model.ArtworkRating(
-            artwork=artwork,
-            user=request.user,
-            rating=rating,
-        )
-        model.session.add(rating_obj)
+    model.ArtworkRating.set(model.session, artwork, request.user, rating)
 
     # If the request has the asynchronous parameter, we return the number/sum
     # of ratings to update the widget
@@ -343,6 +317,60 @@ def rate(artwork, request):
     return HTTPSeeOther(location=request.route_url('art.view', artwork=artwork))
 
 
+@view_config(
+    route_name='api:art.rate',
+    permission='art.rate',
+    request_method='POST',
+    renderer='json')
+def api_rate(context, request):
+    """Post lots of ratings at once, e.g. when importing them from elsewhere.
+
+    Expects a `ratings` parameter holding a JSON list of objects with
+    `artwork_id` and `rating` (on the same scale as :func:`rate`).  Either
+    every rating is saved, or none are.
+    """
+    radius = request.registry.settings['rating_radius']
+    try:
+        items = json.loads(request.POST['ratings'])
+        ratings = dict(
+            (int(item['artwork_id']), int(item['rating']) / radius)
+            for item in items)
+    except (KeyError, TypeError, ValueError):
+        return HTTPBadRequest()
+
+    if not all(-1.0 <= rating <= 1.0 for rating in ratings.itervalues()):
+        return HTTPBadRequest()
+    if not ratings:
+        return {'status': 'success', 'results': []}
+
+    known_ids = set(artwork_id for (artwork_id,) in
+        model.session.query(model.Artwork.id)
+            .filter(model.Artwork.id.in_(ratings.keys())))
+    if known_ids != set(ratings):
+        return HTTPBadRequest()
+
+    model.ArtworkRating.set_many(model.session, request.user, ratings)
+
+    # Report back the new stats, same as rate
+    stats = model.session.query(
+            model.Artwork.id,
+            model.Artwork.rating_count,
+            model.Artwork.rating_score) \
+        .filter(model.Artwork.id.in_(ratings.keys())) \
+        .order_by(model.Artwork.id)
+
+    return {
+        'status': 'success',
+        'results': [
+            dict(
+                artwork_id=artwork_id,
+                ratings=rating_count,
+                rating_sum=rating_score * radius,
+            )
+            for artwork_id, rating_count, rating_score in stats],
+    }
+
+
 class AddTagForm(wtforms.form.Form):
     tags = MultiTagField(
         u"Add a tag",
@@ -3,9 +3,10 @@ import logging
 
 from pyramid.httpexceptions import HTTPBadRequest, HTTPSeeOther
 from pyramid.view import view_config
-from sqlalchemy.sql import func
 
 from floof import model
+from floof.lib.comments import CommentPage, load_subtrees
+from floof.lib.helpers import render_comment
 
 log = logging.getLogger(__name__)
 
@@ -24,7 +25,9 @@ def view_discussion(discussion, request):
         discussion=discussion,
 
         comment_ancestors=None,
-        comment_descendants=discussion.comments,
+        comment_descendants=None,
+        comment_hidden_counts=None,
+        comment_page=CommentPage(model.session, discussion, request.GET),
         comment_form=CommentForm(),
     )
 
@@ -35,15 +38,35 @@ def view_discussion(discussion, request):
 def view_single_thread(comment, request):
     """Show the comment thread starting at a single comment."""
     # TODO show all ancestors + entire tree + discussee somehow
+    comments, hidden_counts = load_subtrees(
+        model.session, comment.discussion, [comment])
     return dict(
         comment=comment,
         discussion=comment.discussion,
 
         comment_ancestors=comment.ancestors_query.all(),
-        comment_descendants=comment.descendants_query.all(),
+        comment_descendants=comments,
+        comment_hidden_counts=hidden_counts,
+        comment_page=None,
         comment_form=CommentForm(),
     )
 
+@view_config(
+    route_name='comments.replies',
+    request_method='GET',
+    renderer='comments/replies.mako')
+def view_replies(comment, request):
+    """Show the replies below a single comment, as an HTML fragment, for
+    filling in a collapsed branch of a thread."""
+    comments, hidden_counts = load_subtrees(
+        model.session, comment.discussion, [comment])
+    return dict(
+        comment=comment,
+        # The comment itself is already on the page
+        comment_descendants=comments[1:],
+        comment_hidden_counts=hidden_counts,
+    )
+
 
 @view_config(
     route_name='comments.write',
@@ -60,7 +83,6 @@ def reply_to_discussion(discussion, request):
         discussion=discussion,
 
         comment_ancestors=None,
-        comment_descendants=discussion.comments,
         comment_form=CommentForm(),
     )
 
@@ -79,7 +101,6 @@ def reply_to_comment(comment, request):
         discussion=comment.discussion,
 
         comment_ancestors=comment.ancestors_query.all(),
-        comment_descendants=comment.descendants_query.all(),
         comment_form=CommentForm(),
     )
 
@@ -108,52 +129,27 @@ def reply_to_discussion_commit(discussion_or_comment, request):
         # TODO
         return HTTPBadRequest()
 
-    # Re-get the discussion with a separate query for locking purposes
-    # XXX necessary?
-    discussion = model.session.query(model.Discussion) \
-        .with_lockmode('update') \
-        .get(discussion.id)
-
-    # XXX put this all in the Comment constructor?
-    if comment:
-        righter_comments = model.session.query(model.Comment) \
-            .with_parent(discussion)
-        righter_comments \
-            .filter(model.Comment.left > comment.right) \
-            .update({ 'left': model.Comment.left + 2 })
-        righter_comments \
-            .filter(model.Comment.right > comment.right) \
-            .update({ 'right': model.Comment.right + 2 })
-
-        new_comment_left = comment.right
-        new_comment_right = comment.right + 1
-
-        comment.right += 2
-        model.session.add(comment)
-
-    else:
-        max_right, = model.session.query(func.max(model.Comment.right)) \
-            .with_parent(discussion) \
-            .one()
-
-        if max_right is None:
-            # FIRST POST LOLOL no seriously default to 1 and 2.
-            max_right = 0
-
-        new_comment_left = max_right + 1
-        new_comment_right = max_right + 2
+    if comment and comment.depth + 1 >= model.MAX_COMMENT_DEPTH:
+        request.session.flash(
+            u"This thread is too deep to reply to; try replying further up.",
+            level=u'error')
+        return HTTPSeeOther(location=request.route_url(
+            'comments.view', comment=comment,
+            _anchor="comment-{0}".format(comment.id)))
 
+    # Posting only adds a row, so nothing else needs locking; even the count
+    # is bumped in the database, to not step on anyone else posting
     new_comment = model.Comment(
         discussion=discussion,
+        parent=comment,
         author=request.user,
         content=comment_form.message.data,
-        left=new_comment_left,
-        right=new_comment_right,
     )
+    discussion.comment_count = model.Discussion.comment_count + 1
+
+    render_comment(new_comment)
 
-    discussion.comment_count += 1
     model.session.add(new_comment)
-    model.session.add(discussion)
     model.session.flush()  # Need to get the new comment's id
 
     # Redirect to the new comment
@@ -171,7 +167,6 @@ def edit_comment(comment, request):
         discussion=comment.discussion,
 
         comment_ancestors=comment.ancestors_query.all(),
-        comment_descendants=comment.descendants_query.all(),
         comment_form=CommentForm(message=comment.content),
     )
 
@@ -188,6 +183,8 @@ def edit_comment_commit(comment, request):
         return HTTPBadRequest()
 
     comment.content = comment_form.message.data
+    # Render the new content now, rather than on the next view
+    render_comment(comment)
 
     # Redirect to the comment in context
     return HTTPSeeOther(
@@ -1,12 +1,19 @@
 import logging
+import os
 import urllib2
 
-from sqlalchemy.orm.exc import NoResultFound
+from pkg_resources import resource_string
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import and_
 from pyramid.exceptions import NotFound
+from pyramid.httpexceptions import HTTPFound
 from pyramid.response import Response
 from pyramid.view import view_config
+import transaction
 
 from floof import model
+from floof.lib import derivatives
+from floof.lib import fileinfo
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +36,178 @@ def wsgi_reproxy(url):
             break
         yield buf
 
+class FileIter(object):
+    """A WSGI response iterator over part or all of an open file.  Unlike a
+    server's `wsgi.file_wrapper`, it knows how to seek straight to a byte
+    range, which WebOb will ask for with :meth:`app_iter_range`.
+    """
+    block_size = 512 * 1024
+
+    def __init__(self, fileobj, start=0, stop=None):
+        self.fileobj = fileobj
+        self.fileobj.seek(start)
+        self.remaining = None if stop is None else stop - start
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        size = self.block_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        if size <= 0:
+            raise StopIteration
+
+        buf = self.fileobj.read(size)
+        if not buf:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(buf)
+        return buf
+
+    def app_iter_range(self, start, stop):
+        return FileIter(self.fileobj, start, stop)
+
+    def close(self):
+        self.fileobj.close()
+
+def local_file_response(request, path, headerlist, etag):
+    """Returns a response that sends the file at `path` straight off the
+    disk, using the server's `wsgi.file_wrapper` (i.e. sendfile) if it has
+    one.
+
+    WebOb takes care of `Range`, `If-Range`, `If-None-Match` and
+    `If-Modified-Since`, given the ETag and modification time set here.
+    """
+    try:
+        fileobj = open(path, 'rb')
+    except IOError:
+        log.warn("File {0} is missing".format(path))
+        raise NotFound()
+
+    stat = os.fstat(fileobj.fileno())
+
+    # file_wrapper can only send the whole file
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper and not request.range:
+        app_iter = file_wrapper(fileobj, FileIter.block_size)
+    else:
+        app_iter = FileIter(fileobj)
+
+    response = Response(
+        app_iter=app_iter,
+        headerlist=headerlist,
+        conditional_response=True,
+    )
+    response.content_length = stat.st_size
+    response.accept_ranges = 'bytes'
+    response.etag = etag
+    response.last_modified = stat.st_mtime
+    return response
+
+def derivative_pending_response():
+    """Returns a placeholder image, for a thumbnail or other rendition that's
+    queued to be made in the background.  It's a 202, so nothing should hang onto it.
+    """
+    response = Response(
+        status=202,
+        body=resource_string('floof', 'assets/images/derivative-pending.svg'),
+        content_type='image/svg+xml',
+    )
+    response.headers['Retry-After'] = '5'
+    response.cache_control.no_cache = True
+    # Don't let http_cache below make this cacheable
+    response.cache_control.prevent_auto = True
+    return response
+
+def _find_file(request, class_, key):
+    """Looks up the file in the database and the storage, and returns its
+    :class:`floof.lib.fileinfo.FileInfo`.  Renditions that don't exist yet are
+    made or waited for, which is a whole response instead.
+    """
+    storage = request.storage
+
+    if class_ == u'artwork':
+        artwork = model.session.query(model.Artwork) \
+            .filter_by(hash=key) \
+            .first()
+        if not artwork:
+            raise NotFound()
+
+        storage_key = key
+        mime_type = artwork.mime_type
+
+    else:
+        rendition = request.registry.settings['renditions'].get(class_)
+        if not rendition:
+            # Unknown class
+            raise NotFound()
+
+        # Find the artwork, whether this rendition exists yet, and whether
+        # it's waiting to be made in the background
+        row = model.session.query(
+                model.Artwork,
+                model.ArtworkRendition,
+                model.DerivativeJob.state) \
+            .outerjoin((model.ArtworkRendition, and_(
+                model.ArtworkRendition.artwork_id == model.Artwork.id,
+                model.ArtworkRendition.name == rendition.name,
+                model.ArtworkRendition.fingerprint == rendition.fingerprint,
+            ))) \
+            .outerjoin((model.DerivativeJob, and_(
+                model.DerivativeJob.artwork_id == model.Artwork.id,
+                model.DerivativeJob.class_ == rendition.name,
+            ))) \
+            .filter(model.Artwork.hash == key) \
+            .first()
+        if not row:
+            raise NotFound()
+
+        artwork, artwork_rendition, job_state = row
+        if not artwork_rendition:
+            if job_state in (u'queued', u'running'):
+                return derivative_pending_response()
+
+            # Make it now.  It won't be in storage until the end of the
+            # request, so serve it directly this once.  If another request
+            # beat us to it, it's storing the same file, so just let ours go
+            artwork_rendition, data = derivatives.generate_rendition(
+                model.session, storage, artwork, rendition)
+            content_type = artwork_rendition.mime_type.encode('utf8')
+            try:
+                model.session.flush()
+            except IntegrityError:
+                transaction.doom()
+            return Response(body=data, content_type=content_type)
+
+        storage_key = rendition.storage_key(artwork)
+        mime_type = artwork_rendition.mime_type
+
+    # Don't bother setting disposition for thumbnails and such
+    disposition = None
+    if class_ == u'artwork':
+        mtime_rfc822 = artwork.uploaded_time.strftime(
+            "%a, %d %b %Y %H:%M:%S %Z")
+        disposition = 'inline; filename={0}; modification-date="{1}";'.format(
+            artwork.filename.encode('utf8'), mtime_rfc822)
+
+    # Storages that clients are redirected to have to send these headers
+    # themselves
+    content_type = mime_type.encode('utf8')
+    storage_url = storage.url(class_, storage_key,
+        content_type=content_type, disposition=disposition)
+    if not storage_url:
+        # No such file, oh dear
+        log.warn("File {0}:{1} is missing".format(class_, storage_key))
+        raise NotFound()
+
+    return fileinfo.FileInfo(
+        content_type=content_type,
+        disposition=disposition,
+        storage_url=storage_url,
+        etag=storage_key,
+    )
+
 @view_config(
     route_name='filestore',
     request_method='GET',
@@ -36,47 +215,49 @@ def wsgi_reproxy(url):
 def filestore(context, request):
     """Serve a file from storage.
 
-    If we appear to be downstream from a proxy and the storage supports it,
-    this method will return an empty response body with headers indicating
-    the "real" location of the file.  Otherwise, we'll respond with the
-    whole file.  The latter puts a terrible strain on the app and will spew
-    warnings if not in debug mode.
+    Storages that hand out URLs clients can use, like S3's presigned ones,
+    are simply redirected to.  If we appear to be downstream from a proxy and
+    the storage supports it, this method will return an empty response body
+    with headers indicating the "real" location of the file.  Otherwise,
+    we'll respond with the whole file.  Local files are sent efficiently,
+    with support for ranges and conditional requests, but anything else puts
+    a terrible strain on the app and will spew warnings if not in debug mode.
+
+    Renditions (thumbnails and so forth) that don't exist yet are made on the
+    spot, unless they're already queued up for the derivative worker.  What's
+    learned about files that do exist is cached; see :mod:`floof.lib.fileinfo`.
     """
     class_ = request.matchdict['class_']
     key = request.matchdict['key']
 
-    storage = request.storage
-    storage_url = storage.url(class_, key)
-    if not storage_url:
-        # No such file, oh dear
-        log.warn("File {0}:{1} is missing".format(class_, key))
-        raise NotFound()
+    storage_factory = request.registry.settings['filestore_factory']
 
-    # Get the MIME type and a filename
-    # TODO this is surely not the most reliable way of doing this.
-    headerlist = []
-    if class_ in (u'thumbnail', u'artwork'):
-        try:
-            artwork = model.session.query(model.Artwork) \
-                .filter_by(hash=key) \
-                .one()
-        except NoResultFound:
-            raise NotFound()
+    # Most requests are for thumbnails the gallery just warmed the cache for.
+    # The storage may have moved the file since, though
+    info = fileinfo.lookup(request, class_, key)
+    if info is not None and \
+            not storage_factory.storage_class.check_url(info.storage_url):
+        fileinfo.forget(request, class_, key)
+        info = None
 
-        headerlist.append(('Content-Type', artwork.mime_type.encode('utf8')))
-
-        # Don't bother setting disposition for thumbnails
-        if class_ == u'artwork':
-            mtime_rfc822 = artwork.uploaded_time.strftime(
-                "%a, %d %b %Y %H:%M:%S %Z")
-            headerlist.append((
-                'Content-Disposition',
-                'inline; filename={0}; modification-date="{1}";'.format(
-                    artwork.filename.encode('utf8'), mtime_rfc822),
-            ))
-    else:
-        # Unknown class
-        raise NotFound()
+    if info is None:
+        info = _find_file(request, class_, key)
+        if isinstance(info, Response):
+            return info
+        fileinfo.remember(request, class_, key, info)
+
+    headerlist = [('Content-Type', info.content_type)]
+    if info.disposition:
+        headerlist.append(('Content-Disposition', info.disposition))
+    storage_url = info.storage_url
+
+    if storage_factory.storage_class.redirect:
+        # Clients can fetch it themselves, and the URL has the headers above
+        # baked in.  The URL may expire, so don't let http_cache above make
+        # the redirect cacheable
+        response = HTTPFound(location=storage_url)
+        response.cache_control.prevent_auto = True
+        return response
 
     if 'X-Forwarded-For' in request.headers or \
             'FORWARDED_FOR' in request.environ:
@@ -96,7 +277,13 @@ def filestore(context, request):
         return Response(headerlist=headerlist)
 
 
-    # Otherwise, we need to stream the whole file ourselves.  Ick.
+    # Otherwise, we need to stream the whole file ourselves.  That's not so
+    # bad if it's right here on disk
+    if storage_url.startswith('file://'):
+        return local_file_response(
+            request, storage_url[len('file://'):], headerlist, info.etag)
+
+    # But going through some other server is.  Ick.
     if not request.registry.settings['debug']:
         log.warn("Manually serving a file from storage; "
             "this is not what you want in production!")
@@ -0,0 +1,69 @@
+# encoding: utf8
+import logging
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+
+from floof import model
+from floof.lib import search
+
+log = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = 20
+
+@view_config(
+    route_name='api:search',
+    request_method='GET',
+    renderer='json')
+def api_search(context, request):
+    """Full-text search over art and users.
+
+    Takes the words to look for in `q`, and optionally a `type` (`artwork`
+    or `users`) and a `page`.  Results are ranked best first.
+    """
+    resource_type = request.GET.get('type') or None
+    if resource_type not in (None, u'artwork', u'users'):
+        return HTTPBadRequest()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        return HTTPBadRequest()
+    if page < 1:
+        return HTTPBadRequest()
+
+    hits = search.search(model.session, request.GET.get('q', u''),
+        resource_type=resource_type,
+        limit=SEARCH_PAGE_SIZE,
+        offset=(page - 1) * SEARCH_PAGE_SIZE)
+    resource_ids = [resource_id for resource_id, rank in hits]
+
+    # Fetch everything found with one query per type, rather than one per hit
+    found = {}
+    if resource_ids:
+        for artwork in model.session.query(model.Artwork) \
+                .filter(model.Artwork.resource_id.in_(resource_ids)):
+            found[artwork.resource_id] = dict(
+                type=u'artwork',
+                id=artwork.id,
+                title=artwork.title,
+                url=request.route_url('art.view', artwork=artwork),
+            )
+        for user in model.session.query(model.User) \
+                .filter(model.User.resource_id.in_(resource_ids)):
+            found[user.resource_id] = dict(
+                type=u'users',
+                id=user.id,
+                name=user.name,
+                display_name=user.display_name,
+                url=request.route_url('users.view', user=user),
+            )
+
+    results = []
+    for resource_id, rank in hits:
+        if resource_id in found:
+            results.append(dict(found[resource_id], rank=rank))
+
+    return {
+        'status': 'success',
+        'results': results,
+    }
@@ -1,9 +1,11 @@
 # encoding: utf8
 import logging
 
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.view import view_config
 
 from floof import model
+from floof.lib.autocomplete import MAX_COMPLETIONS
 from floof.lib.gallery import GallerySieve
 
 log = logging.getLogger(__name__)
@@ -40,3 +42,26 @@ def artwork(tag, request):
         tag=tag,
         gallery_sieve=gallery_sieve,
     )
+
+
+@view_config(
+    route_name='api:tags.list',
+    renderer='json',
+)
+def api_tag_list(request):
+    """Autocompletes tag names.  Takes the start of a tag in `name`; returns
+    the most used tags that match, up to `limit` of them, and never more than
+    `MAX_COMPLETIONS`."""
+    try:
+        limit = int(request.GET.get('limit', MAX_COMPLETIONS))
+    except ValueError:
+        return HTTPBadRequest()
+
+    autocompleter = request.registry.settings['autocompleter']
+    tags = autocompleter.complete_tags(
+        model.session, request.GET.get('name', u''), limit)
+
+    return {
+        'status': 'success',
+        'results': tags,
+    }
@@ -1,8 +1,10 @@
 # encoding: utf8
 import logging
 
+from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.view import view_config
 
+from floof.lib.autocomplete import MAX_COMPLETIONS
 from floof.lib.gallery import GallerySieve
 from floof import model
 
@@ -79,24 +81,19 @@ def art_by_album(target_user, request):
     renderer='json',
 )
 def api_user_list(request):
-    q = model.session.query(model.User)
+    """Autocompletes user names.  Takes the start of a name or display name
+    in `name`; returns the users with the most art that match, up to
+    `limit` of them, and never more than `MAX_COMPLETIONS`."""
+    try:
+        limit = int(request.GET.get('limit', MAX_COMPLETIONS))
+    except ValueError:
+        return HTTPBadRequest()
+
+    autocompleter = request.registry.settings['autocompleter']
+    users = autocompleter.complete_users(
+        model.session, request.GET.get('name', u''), limit)
 
-    if request.GET.get('name'):
-        # TODO escape LIKE syntax, and maybe also search display name
-        q = q.filter(model.User.name.like('%' + request.GET['name'] + '%'))
-
-    users = q.all()
-
-    # TODO need a more better way to define the api repr of an orm object
-    data = []
-    for user in users:
-        data.append(dict(
-            id=user.id,
-            name=user.name,
-        ))
-
-    # TODO and a wrapper for this kind of common thing
     return {
         'status': 'success',
-        'results': data,
+        'results': users,
     }